@@ -0,0 +1,169 @@
+# app/aio_server.py
+import asyncio
+import logging
+import time
+from concurrent.futures import Future
+from datetime import datetime
+from html import escape
+from typing import Callable, Optional
+from urllib.parse import urlencode
+
+from aiohttp import web
+from aiogram import types
+
+from app import profiler
+from app.db import run_db
+from app.ingress import UpdateQueue
+from app.metrics import CONTENT_TYPE, WEBHOOK_SECONDS, render as render_metrics
+from app.payments import signature_check_is_local, verify_signature
+
+log = logging.getLogger(__name__)
+
+
+def create_aiohttp_app(
+    updates: UpdateQueue,
+    accept_payment: Callable[[bytes], None],
+    grant: Optional[Callable[[Optional[int], Optional[str], Optional[str]], Optional[Future]]] = None,
+) -> web.Application:
+    """
+    Нативный async-режим: webhook Telegram, webhook WATA и health работают
+    прямо на loop диспетчера — без Flask-потоков и run_coroutine_threadsafe.
+
+    updates — очередь апдейтов (консьюмеры на этом же loop);
+    accept_payment — синхронная запись проверенного события оплаты в inbox
+    (один INSERT в БД, поэтому выполняется в пуле app.db);
+    grant — выдача подписки (user_id, plan, order_id) для тестовой оплаты
+    /testpay (mock-счета ведут туда); None — /testpay не регистрируется.
+    """
+    async def telegram_webhook(request: web.Request) -> web.Response:
+        with WEBHOOK_SECONDS.time("telegram"):
+            return await _telegram_webhook(request)
+
+    async def _telegram_webhook(request: web.Request) -> web.Response:
+        try:
+            payload = await request.json()
+            update = types.Update(**(payload or {}))
+        except Exception:
+            log.exception("Bad Telegram update payload")
+            return web.json_response({"ok": False})
+
+        if not updates.offer(update):
+            # очередь полна — пусть Telegram доставит апдейт повторно позже
+            log.warning("Update queue full, rejecting update %s", update.update_id)
+            return web.json_response({"ok": False}, status=503)
+        return web.json_response({"ok": True})
+
+    async def payment_webhook(request: web.Request) -> web.Response:
+        with WEBHOOK_SECONDS.time("payment"):
+            return await _payment_webhook(request)
+
+    async def _payment_webhook(request: web.Request) -> web.Response:
+        raw = await request.read()
+        sig = request.headers.get("X-Signature")
+        if not sig:
+            ok = False
+        elif signature_check_is_local():
+            # ключ закэширован и распарсен — проверка чисто CPU, loop не блокирует
+            ok = verify_signature(raw, sig)
+        else:
+            # холодный или протухший кэш: загрузка ключа — блокирующий HTTP
+            ok = await asyncio.get_running_loop().run_in_executor(None, verify_signature, raw, sig)
+        if not ok:
+            log.warning("Invalid signature on /payment_webhook")
+            raise web.HTTPBadRequest(text="Invalid signature")
+
+        await run_db(accept_payment, raw)
+        return web.json_response({"ok": True})
+
+    async def health(request: web.Request) -> web.Response:
+        return web.json_response({
+            "ok": True,
+            "ts": datetime.utcnow().isoformat() + "Z",
+            "updates": updates.stats(),
+        })
+
+    async def metrics(request: web.Request) -> web.Response:
+        # GaugeFunc могут ходить в БД (глубина inbox) — рендер не на loop
+        body = await asyncio.get_running_loop().run_in_executor(None, render_metrics)
+        return web.Response(body=body.encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    async def root(request: web.Request) -> web.Response:
+        return web.Response(text="ok")
+
+    async def debug_profile(request: web.Request) -> web.Response:
+        if not profiler.authorized(request.headers.get("X-Profile-Token")):
+            raise web.HTTPNotFound()
+        try:
+            seconds, hz, thread = profiler.parse_params(request.query)
+        except ValueError:
+            raise web.HTTPBadRequest()
+        # сэмплер спит между снимками — в отдельном потоке, loop продолжает работать
+        try:
+            stacks = await asyncio.get_running_loop().run_in_executor(
+                None, profiler.sample_stacks, seconds, hz, thread)
+        except profiler.ProfilerBusy:
+            return web.Response(text="profiler busy\n", status=409)
+        return web.Response(text=stacks)
+
+    # ── тестовая заглушка оплаты (/testpay), как в Flask-режиме ──────────────
+    async def testpay_page(request: web.Request) -> web.Response:
+        q = request.query
+        user_id, plan = q.get("user_id", ""), q.get("plan") or "Не указан"
+        amount = q.get("amount") or "?"
+        order_id = q.get("orderId") or f"tg-{user_id}-{int(time.time())}"
+        success = "/testpay/success?" + urlencode({"user_id": user_id, "plan": plan, "orderId": order_id})
+        return web.Response(content_type="text/html", text=f"""
+    <!doctype html><meta charset="utf-8">
+    <title>Тестовая оплата</title>
+    <h2>Тестовая оплата</h2>
+    <p>Пользователь: <b>{escape(user_id)}</b></p>
+    <p>План: <b>{escape(plan)}</b> — сумма: <b>{escape(amount)} ₽</b></p>
+    <p>orderId: <code>{escape(order_id)}</code></p>
+    <p>
+      <a href="{escape(success)}">✅ Оплатить (успех)</a>
+      &nbsp;&nbsp;
+      <a href="/testpay/fail">❌ Отмена</a>
+    </p>
+    """)
+
+    async def testpay_success(request: web.Request) -> web.Response:
+        q = request.query
+        user_id = int(q["user_id"]) if q.get("user_id", "").isdigit() else None
+        try:
+            delivery = await run_db(grant, user_id, q.get("plan"), q.get("orderId"))
+            if delivery is not None:
+                await asyncio.wrap_future(delivery)
+        except Exception:
+            log.exception("testpay: grant failed user_id=%s orderId=%s", user_id, q.get("orderId"))
+            return web.Response(content_type="text/html", status=500,
+                                text="<h3>Оплата записана, но ссылку отправить не удалось.</h3>")
+        return web.Response(content_type="text/html",
+                            text="<h3>Оплата смоделирована как УСПЕШНАЯ. Вернитесь в бота.</h3>")
+
+    async def testpay_fail(request: web.Request) -> web.Response:
+        return web.Response(content_type="text/html", text="<h3>Оплата смоделирована как ОТМЕНЁННАЯ.</h3>")
+
+    app = web.Application()
+    app.router.add_post("/telegram_webhook", telegram_webhook)
+    app.router.add_post("/payment_webhook", payment_webhook)
+    app.router.add_get("/health", health)
+    app.router.add_get("/metrics", metrics)
+    app.router.add_get("/", root)
+    app.router.add_get("/debug/profile", debug_profile)
+    if grant is not None:
+        app.router.add_get("/testpay", testpay_page)
+        app.router.add_get("/testpay/success", testpay_success)
+        app.router.add_get("/testpay/fail", testpay_fail)
+    return app
+
+
+async def serve(app: web.Application, host: str, port: int) -> web.AppRunner:
+    """
+    Поднимает aiohttp-сайт на текущем loop (не блокирует, в отличие от web.run_app).
+    """
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    log.info("aiohttp server listening on %s:%s", host, port)
+    return runner
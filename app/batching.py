@@ -0,0 +1,35 @@
+# app/batching.py
+import asyncio
+import logging
+from typing import Awaitable, Callable, Iterable, TypeVar
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+async def run_bounded(
+    func: Callable[[T], Awaitable[None]],
+    items: Iterable[T],
+    limit: int = 8,
+) -> int:
+    """
+    Выполняет func(item) для всех items, не более limit корутин одновременно.
+    Фиксированный пул воркеров тянет элементы из общего итератора, поэтому
+    волна из 50k элементов не создаёт 50k задач разом.
+    Возвращает число упавших вызовов (ошибки логируются, но не прерывают пачку).
+    """
+    it = iter(items)
+    failed = 0
+
+    async def _worker() -> None:
+        nonlocal failed
+        for item in it:
+            try:
+                await func(item)
+            except Exception as e:
+                failed += 1
+                log.warning("batch item %r failed: %s", item, e)
+
+    await asyncio.gather(*(_worker() for _ in range(max(1, limit))))
+    return failed
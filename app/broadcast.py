@@ -0,0 +1,267 @@
+# app/broadcast.py
+import asyncio
+import logging
+import os
+import time
+from concurrent.futures import Future
+from datetime import datetime
+from typing import Callable, Coroutine, List, Optional, Tuple
+
+from aiogram import Bot
+from sqlalchemy import insert, update
+
+from app.batching import run_bounded
+from app.db import run_db
+from app.metrics import BROADCAST_MESSAGES
+from app.models import Broadcast, BroadcastFailure, Entitlement, SessionLocal
+from app.outbound import PRIORITY_BULK, priority
+
+log = logging.getLogger(__name__)
+
+BROADCAST_PAGE          = int(os.getenv("BROADCAST_PAGE", "500"))        # user_id на страницу и чекпойнт
+BROADCAST_CONCURRENCY   = int(os.getenv("BROADCAST_CONCURRENCY", "32"))  # одновременных send_message
+BROADCAST_POLL_INTERVAL = int(os.getenv("BROADCAST_POLL_INTERVAL", "10"))
+
+STATUS_PENDING   = "pending"
+STATUS_RUNNING   = "running"
+STATUS_DONE      = "done"
+STATUS_CANCELLED = "cancelled"
+
+_MIN_USER_ID = -(2 ** 63)
+
+
+# ── синхронная часть (пул app.db) ─────────────────────────────────────────────
+def create_broadcast(text: str, created_by: Optional[int] = None) -> int:
+    session = SessionLocal()
+    try:
+        row = Broadcast(text=text, status=STATUS_PENDING, created_by=created_by,
+                        created_at=datetime.utcnow(), sent=0, failed=0)
+        session.add(row)
+        session.commit()
+        return row.id
+    finally:
+        session.close()
+
+
+def get_broadcast(broadcast_id: Optional[int] = None) -> Optional[Broadcast]:
+    """
+    Рассылка по id, без id — последняя созданная.
+    """
+    session = SessionLocal()
+    try:
+        if broadcast_id is None:
+            return session.query(Broadcast).order_by(Broadcast.id.desc()).first()
+        return session.get(Broadcast, broadcast_id)
+    finally:
+        session.close()
+
+
+def cancel_broadcast(broadcast_id: int) -> bool:
+    # идущая рассылка заметит отмену на ближайшем чекпойнте
+    session = SessionLocal()
+    try:
+        result = session.execute(
+            update(Broadcast)
+            .where(Broadcast.id == broadcast_id, Broadcast.status.in_((STATUS_PENDING, STATUS_RUNNING)))
+            .values(status=STATUS_CANCELLED, finished_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+        return result.rowcount > 0
+    finally:
+        session.close()
+
+
+def _next_broadcast_sync() -> Optional[int]:
+    # прерванная рестартом (running) раньше новых: порядок — по id
+    session = SessionLocal()
+    try:
+        return (
+            session.query(Broadcast.id)
+            .filter(Broadcast.status.in_((STATUS_PENDING, STATUS_RUNNING)))
+            .order_by(Broadcast.id)
+            .limit(1)
+            .scalar()
+        )
+    finally:
+        session.close()
+
+
+def _begin_sync(broadcast_id: int) -> Optional[Tuple[str, int]]:
+    session = SessionLocal()
+    try:
+        row = session.get(Broadcast, broadcast_id)
+        if row is None or row.status not in (STATUS_PENDING, STATUS_RUNNING):
+            return None
+        if row.status == STATUS_PENDING:
+            row.status = STATUS_RUNNING
+            row.started_at = datetime.utcnow()
+        text, after = row.text, row.cursor_user_id
+        session.commit()
+        return text, after if after is not None else _MIN_USER_ID
+    finally:
+        session.close()
+
+
+def _page_sync(after: int, limit: int) -> List[int]:
+    # keyset по первичному ключу: каждая страница — короткий индексный запрос,
+    # без транзакции, открытой на всё время рассылки
+    session = SessionLocal()
+    try:
+        rows = (
+            session.query(Entitlement.user_id)
+            .filter(Entitlement.user_id > after, Entitlement.expires_at > datetime.utcnow())
+            .order_by(Entitlement.user_id)
+            .limit(limit)
+            .all()
+        )
+        return [uid for (uid,) in rows]
+    finally:
+        session.close()
+
+
+def _checkpoint_sync(broadcast_id: int, last_user_id: int, sent: int,
+                     failures: List[Tuple[int, str]]) -> bool:
+    """
+    Курсор, счётчики и ошибки страницы — одной транзакцией.
+    False — рассылку отменили, продолжать не нужно.
+    """
+    now = datetime.utcnow()
+    session = SessionLocal()
+    try:
+        result = session.execute(
+            update(Broadcast)
+            .where(Broadcast.id == broadcast_id, Broadcast.status == STATUS_RUNNING)
+            .values(
+                cursor_user_id=last_user_id,
+                sent=Broadcast.sent + sent,
+                failed=Broadcast.failed + len(failures),
+            )
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount == 0:
+            session.rollback()
+            return False
+        if failures:
+            session.execute(insert(BroadcastFailure), [
+                {"broadcast_id": broadcast_id, "user_id": uid, "error": error[:500], "failed_at": now}
+                for uid, error in failures
+            ])
+        session.commit()
+        return True
+    finally:
+        session.close()
+
+
+def _finish_sync(broadcast_id: int) -> None:
+    session = SessionLocal()
+    try:
+        session.execute(
+            update(Broadcast)
+            .where(Broadcast.id == broadcast_id, Broadcast.status == STATUS_RUNNING)
+            .values(status=STATUS_DONE, finished_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
+    finally:
+        session.close()
+
+
+# ── движок ────────────────────────────────────────────────────────────────────
+class BroadcastEngine:
+    """
+    Рассылка всем активным подписчикам на loop'е бота.
+
+    Получатели читаются страницами по page_size (keyset по entitlements.user_id),
+    следующая страница подгружается, пока рассылается текущая. Сообщения идут
+    через общий лимитер бота с PRIORITY_BULK: темп упирается в TG_GLOBAL_RATE,
+    а оплаты и ответы на кнопки проходят вперёд рассылки. После каждой страницы —
+    чекпойнт (курсор, счётчики, ошибки), поэтому рестарт продолжает рассылку
+    с места остановки; повторно может уйти не больше одной страницы.
+
+    Работает только у лидера: tick() из планировщика подхватывает очередную
+    рассылку, если текущая не идёт.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        submit: Callable[[Coroutine], Future],
+        page_size: int = BROADCAST_PAGE,
+        concurrency: int = BROADCAST_CONCURRENCY,
+    ):
+        self._bot = bot
+        self._submit = submit
+        self._page_size = page_size
+        self._concurrency = concurrency
+        self._current: Optional[Future] = None
+
+    def tick(self) -> None:
+        if self._current is not None:
+            if not self._current.done():
+                return
+            if not self._current.cancelled() and self._current.exception() is not None:
+                # статус остался running — эта же рассылка продолжится с чекпойнта ниже
+                log.error("Broadcast failed, will resume: %r", self._current.exception())
+            self._current = None
+        broadcast_id = _next_broadcast_sync()
+        if broadcast_id is not None:
+            self._current = self._submit(self.run(broadcast_id))
+
+    def stop(self) -> None:
+        # чекпойнт уже сохранён — новый лидер продолжит с него
+        if self._current is not None:
+            self._current.cancel()
+            self._current = None
+
+    async def run(self, broadcast_id: int) -> None:
+        begun = await run_db(_begin_sync, broadcast_id)
+        if begun is None:
+            return
+        text, after = begun
+        log.info("Broadcast %s started (after user_id=%s)", broadcast_id, after)
+
+        started = time.perf_counter()
+        total_sent = total_failed = 0
+        next_page = asyncio.ensure_future(run_db(_page_sync, after, self._page_size))
+        try:
+            while True:
+                user_ids = await next_page
+                if not user_ids:
+                    break
+                next_page = asyncio.ensure_future(run_db(_page_sync, user_ids[-1], self._page_size))
+
+                failures = await self._send_page(text, user_ids)
+                sent = len(user_ids) - len(failures)
+                total_sent += sent
+                total_failed += len(failures)
+                alive = await run_db(_checkpoint_sync, broadcast_id, user_ids[-1], sent, failures)
+                if not alive:
+                    log.info("Broadcast %s cancelled after user_id=%s", broadcast_id, user_ids[-1])
+                    return
+                log.debug("Broadcast %s checkpoint: user_id=%s sent=%d failed=%d",
+                          broadcast_id, user_ids[-1], total_sent, total_failed)
+        finally:
+            next_page.cancel()
+
+        await run_db(_finish_sync, broadcast_id)
+        elapsed = time.perf_counter() - started
+        log.info("Broadcast %s done: sent=%d failed=%d in %.1fs (%.1f msg/s)", broadcast_id,
+                 total_sent, total_failed, elapsed, (total_sent + total_failed) / max(elapsed, 1e-9))
+
+    async def _send_page(self, text: str, user_ids: List[int]) -> List[Tuple[int, str]]:
+        failures: List[Tuple[int, str]] = []
+
+        async def _send(user_id: int) -> None:
+            try:
+                await self._bot.send_message(chat_id=user_id, text=text, parse_mode="HTML")
+            except Exception as e:
+                # бот заблокирован, пользователь удалён, исчерпаны RetryAfter и т.п.
+                failures.append((user_id, f"{type(e).__name__}: {e}"))
+                BROADCAST_MESSAGES.inc(1, "failed")
+            else:
+                BROADCAST_MESSAGES.inc(1, "sent")
+
+        with priority(PRIORITY_BULK):
+            await run_bounded(_send, user_ids, limit=self._concurrency)
+        return failures
@@ -0,0 +1,31 @@
+# app/db.py
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TypeVar
+
+from app.metrics import DB_SECONDS
+
+T = TypeVar("T")
+
+# отдельный ограниченный пул для БД: запросы хендлеров не конкурируют
+# с default executor и не могут открыть больше соединений, чем потоков
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))
+
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+
+
+async def run_db(fn: Callable[..., T], *args, **kwargs) -> T:
+    """
+    Выполняет синхронную функцию работы с БД (SessionLocal и т.п.) в пуле "db"
+    и ждёт результат, не блокируя event loop:
+        subs = await run_db(load_subscriptions, user_id)
+    """
+    site = getattr(fn, "__qualname__", None) or repr(fn)
+
+    def _call():
+        with DB_SECONDS.time(site):
+            return fn(*args, **kwargs)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, _call)
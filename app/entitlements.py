@@ -0,0 +1,76 @@
+# app/entitlements.py
+import os
+from datetime import datetime, timedelta
+from typing import List, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.models import Entitlement, SessionLocal, Subscription, engine
+
+SUBS_HISTORY_LIMIT = int(os.getenv("SUBS_HISTORY_LIMIT", "10"))  # сколько покупок показывают «Мои подписки»
+
+
+def _upsert_stmt(user_id: int, plan: str, delta: timedelta, now: datetime):
+    values = dict(user_id=user_id, plan=plan, expires_at=now + delta, updated_at=now)
+
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+
+        stmt = insert(Entitlement).values(**values)
+        new_expires = func.greatest(Entitlement.expires_at, now) + delta
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+
+        # SQLite хранит DateTime строкой — считаем через julianday (точность до секунды)
+        stmt = insert(Entitlement).values(**values)
+        new_expires = func.datetime(
+            func.max(func.julianday(Entitlement.expires_at), func.julianday(now))
+            + delta.total_seconds() / 86400.0
+        )
+
+    return stmt.on_conflict_do_update(
+        index_elements=[Entitlement.user_id],
+        set_={"plan": plan, "expires_at": new_expires, "updated_at": now},
+    ).returning(Entitlement.expires_at)
+
+
+def extend_entitlement(session: Session, user_id: int, plan: str, delta: timedelta, now: datetime) -> datetime:
+    """
+    Атомарно продлевает доступ: expires_at = max(текущий, now) + delta
+    (новый пользователь получает now + delta). Возвращает новый expires_at.
+    """
+    return session.execute(_upsert_stmt(user_id, plan, delta, now)).scalar_one()
+
+
+def has_access(user_id: int) -> bool:
+    """
+    Действует ли доступ прямо сейчас: lookup по первичному ключу entitlements.
+    Перепроверка перед киком — пока кик ждал очереди, пользователь мог продлиться.
+    """
+    session = SessionLocal()
+    try:
+        row = session.get(Entitlement, user_id)
+        return row is not None and row.expires_at > datetime.utcnow()
+    finally:
+        session.close()
+
+
+def load_subscriptions(user_id: int) -> List[Tuple[str, datetime]]:
+    """
+    «Мои подписки»: последние SUBS_HISTORY_LIMIT покупок пользователя из
+    subscriptions, новые первыми — [(plan, expires_at)]. Первая строка —
+    текущий срок доступа (его же хранит entitlements); истёкшие покупки
+    остаются в истории. Один range-scan по индексу (user_id, expires_at).
+    """
+    session = SessionLocal()
+    try:
+        return [
+            (plan, expires_at)
+            for plan, expires_at in session.query(Subscription.plan, Subscription.expires_at)
+            .filter(Subscription.user_id == user_id)
+            .order_by(Subscription.expires_at.desc())
+            .limit(SUBS_HISTORY_LIMIT)
+        ]
+    finally:
+        session.close()
@@ -0,0 +1,139 @@
+# app/ephemeral.py
+import logging
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Optional
+
+from app.db import run_db
+from app.models import SessionLocal, LastInfoMessage
+
+log = logging.getLogger(__name__)
+
+EPHEMERAL_STORE     = os.getenv("EPHEMERAL_STORE", "memory").lower()  # 'memory' | 'db'
+EPHEMERAL_MAX_USERS = int(os.getenv("EPHEMERAL_MAX_USERS", "50000"))
+# бот может удалять свои сообщения только в течение 48 часов — дольше хранить незачем
+EPHEMERAL_TTL       = float(os.getenv("EPHEMERAL_TTL", str(48 * 3600)))
+
+
+class LastInfoStore(ABC):
+    """
+    Хранилище user_id -> message_id последнего служебного сообщения.
+    API асинхронный, чтобы бэкенды с БД не блокировали loop.
+    """
+
+    @abstractmethod
+    async def get(self, user_id: int) -> Optional[int]:
+        ...
+
+    @abstractmethod
+    async def set(self, user_id: int, message_id: int) -> None:
+        ...
+
+    @abstractmethod
+    async def pop(self, user_id: int) -> None:
+        ...
+
+
+class _Entry:
+    __slots__ = ("message_id", "ts")
+
+    def __init__(self, message_id: int, ts: float):
+        self.message_id = message_id
+        self.ts = ts
+
+
+class MemoryLastInfoStore(LastInfoStore):
+    """
+    In-process LRU + TTL: память ограничена max_size записями со __slots__,
+    сколько бы пользователей ни прошло через бота.
+    """
+
+    def __init__(self, max_size: int = EPHEMERAL_MAX_USERS, ttl: float = EPHEMERAL_TTL):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._data: "OrderedDict[int, _Entry]" = OrderedDict()
+
+    async def get(self, user_id: int) -> Optional[int]:
+        entry = self._data.get(user_id)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.ts > self._ttl:
+            del self._data[user_id]
+            return None
+        return entry.message_id
+
+    async def set(self, user_id: int, message_id: int) -> None:
+        self._data[user_id] = _Entry(message_id, time.monotonic())
+        self._data.move_to_end(user_id)
+        while len(self._data) > self._max_size:
+            self._data.popitem(last=False)
+
+    async def pop(self, user_id: int) -> None:
+        self._data.pop(user_id, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class DbLastInfoStore(LastInfoStore):
+    """
+    Общий для всех процессов бэкенд на таблице last_info_messages.
+    Строки старше TTL не читаются и периодически удаляются.
+    """
+
+    def __init__(self, ttl: float = EPHEMERAL_TTL, cleanup_every: int = 1000):
+        self._ttl = timedelta(seconds=ttl)
+        self._cleanup_every = cleanup_every
+        self._writes = 0
+
+    def _get_sync(self, user_id: int) -> Optional[int]:
+        session = SessionLocal()
+        try:
+            row = session.get(LastInfoMessage, user_id)
+            if row is None or row.updated_at < datetime.utcnow() - self._ttl:
+                return None
+            return row.message_id
+        finally:
+            session.close()
+
+    def _set_sync(self, user_id: int, message_id: int, cleanup: bool) -> None:
+        session = SessionLocal()
+        try:
+            now = datetime.utcnow()
+            session.merge(LastInfoMessage(user_id=user_id, message_id=message_id, updated_at=now))
+            if cleanup:
+                session.query(LastInfoMessage).filter(
+                    LastInfoMessage.updated_at < now - self._ttl
+                ).delete(synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+
+    def _pop_sync(self, user_id: int) -> None:
+        session = SessionLocal()
+        try:
+            session.query(LastInfoMessage).filter(LastInfoMessage.user_id == user_id).delete()
+            session.commit()
+        finally:
+            session.close()
+
+    async def get(self, user_id: int) -> Optional[int]:
+        return await run_db(self._get_sync, user_id)
+
+    async def set(self, user_id: int, message_id: int) -> None:
+        self._writes += 1
+        cleanup = self._writes % self._cleanup_every == 0
+        await run_db(self._set_sync, user_id, message_id, cleanup)
+
+    async def pop(self, user_id: int) -> None:
+        await run_db(self._pop_sync, user_id)
+
+
+def create_last_info_store() -> LastInfoStore:
+    if EPHEMERAL_STORE == "db":
+        log.info("Ephemeral messages store: db")
+        return DbLastInfoStore()
+    return MemoryLastInfoStore()
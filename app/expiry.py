@@ -0,0 +1,233 @@
+# app/expiry.py
+import heapq
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from apscheduler.schedulers.base import BaseScheduler
+from sqlalchemy import BigInteger, DateTime, String, bindparam, text
+
+from app.models import SessionLocal, Entitlement, engine
+from app.logs import dump
+from app.metrics import DB_SECONDS, SCHEDULER_ROWS, SCHEDULER_TICK_SECONDS
+from app.subs_cache import subscriptions_cache
+
+log = logging.getLogger(__name__)
+
+WAKEUP_JOB_ID = "expiry_wakeup"
+
+_MIN_USER_ID = -(2 ** 63)
+
+# Пачка просроченных (keyset по user_id): одна строка entitlements на пользователя,
+# поэтому DELETE ... RETURNING сразу отдаёт и user_id, и последний план.
+# Повторное условие expires_at <= :now во внешнем WHERE защищает от гонки с
+# продлением (Postgres перепроверяет его на новой версии строки).
+_EXPIRE_SQL = text("""
+DELETE FROM entitlements
+WHERE expires_at <= :now
+  AND user_id IN (
+      SELECT user_id FROM entitlements
+      WHERE expires_at <= :now AND user_id > :after
+      ORDER BY user_id
+      LIMIT :chunk
+  )
+RETURNING user_id, plan, expires_at
+""").bindparams(bindparam("now", type_=DateTime)).columns(
+    user_id=BigInteger, plan=String, expires_at=DateTime,
+)
+
+
+def _utcnow_naive() -> datetime:
+    # Храним и сравниваем naive UTC
+    return datetime.utcnow()
+
+
+class ExpiryEngine:
+    """
+    Событийный движок истечения подписок.
+
+    Держит min-heap ближайших дедлайнов (expires_at, user_id) и ставит в
+    планировщик одноразовую задачу ровно на ближайший из них. Из БД читаются
+    только строки entitlements, истекающие в пределах горизонта (range-scan по
+    индексу expires_at), а новые дедлайны из _grant_subscription приходят через push().
+    """
+
+    def __init__(
+        self,
+        scheduler: BaseScheduler,
+        on_expire_batch: Callable[[List[Tuple[int, str]]], None],
+        horizon_seconds: int = 600,
+        chunk_size: int = 1000,
+    ):
+        self._scheduler = scheduler
+        self._on_expire_batch = on_expire_batch
+        self._horizon = timedelta(seconds=horizon_seconds)
+        self._chunk_size = chunk_size
+
+        self._heap: List[Tuple[datetime, int]] = []
+        # user_id -> актуальный дедлайн; записи heap с другим значением — устаревшие
+        self._deadline: Dict[int, datetime] = {}
+        # до какого момента heap гарантированно полон (покрыт refill'ом)
+        self._loaded_until: Optional[datetime] = None
+        self._armed_at: Optional[datetime] = None
+
+        self._lock = threading.Lock()
+        self._process_lock = threading.Lock()
+
+    # ── наполнение heap ───────────────────────────────────────────────────────
+    def _push_locked(self, user_id: int, expires_at: datetime) -> None:
+        known = self._deadline.get(user_id)
+        if known is not None and known >= expires_at:
+            return
+        self._deadline[user_id] = expires_at
+        heapq.heappush(self._heap, (expires_at, user_id))
+
+    def push(self, user_id: int, expires_at: datetime) -> None:
+        """
+        Новый дедлайн пользователя (naive UTC). Дедлайны за горизонтом
+        не держим в памяти — их подберёт следующий refill().
+        """
+        with self._lock:
+            if self._loaded_until is not None and expires_at > self._loaded_until:
+                return
+            self._push_locked(user_id, expires_at)
+        self._arm()
+
+    def refill(self) -> None:
+        """
+        Подгружает дедлайны, наступающие в пределах горизонта.
+        Запрос идёт по индексу expires_at и не трогает «дальние» строки.
+        """
+        with SCHEDULER_TICK_SECONDS.time("refill"):
+            self._refill()
+
+    def refill_near(self, window_seconds: float) -> None:
+        """
+        Частый узкий refill: дедлайны ближайших window_seconds. push() работает
+        только в процессе лидера, а выдачи идут в любом воркере — короткий план,
+        выданный не у лидера, иначе ждал бы следующего полного refill().
+        """
+        with SCHEDULER_TICK_SECONDS.time("refill_near"):
+            self._refill(_utcnow_naive() + timedelta(seconds=window_seconds), near=True)
+
+    def _load(self, until: datetime) -> Optional[List[Tuple[int, datetime]]]:
+        session = SessionLocal()
+        try:
+            with DB_SECONDS.time("expiry.refill"):
+                return (
+                    session.query(Entitlement.user_id, Entitlement.expires_at)
+                    .filter(Entitlement.expires_at <= until)
+                    .all()
+                )
+        except Exception:
+            log.exception("[EXPIRY] refill query failed")
+            return None
+        finally:
+            session.close()
+
+    def _refill(self, until: Optional[datetime] = None, near: bool = False) -> None:
+        until = until or _utcnow_naive() + self._horizon
+        rows = self._load(until)
+        if rows is None:
+            return
+
+        SCHEDULER_ROWS.inc(len(rows), "refill_near" if near else "refill")
+        with self._lock:
+            pending_before = len(self._deadline)
+            for uid, exp in rows:
+                self._push_locked(uid, exp)
+            if not near:
+                self._loaded_until = until
+            # выкидываем устаревшие записи, если их накопилось много
+            if len(self._heap) > 2 * len(self._deadline) + 64:
+                self._heap = [(exp, uid) for uid, exp in self._deadline.items()]
+                heapq.heapify(self._heap)
+            pending = len(self._deadline)
+
+        if not near:
+            log.info("[EXPIRY] Refill: window_rows=%d pending=%d until=%s",
+                     len(rows), pending, until.isoformat())
+        elif pending > pending_before:
+            log.info("[EXPIRY] Near refill: new deadlines=%d until=%s", pending - pending_before, until.isoformat())
+        self._arm()
+
+    # ── пробуждение ───────────────────────────────────────────────────────────
+    def _arm(self) -> None:
+        # add_job — под локом: иначе параллельный _arm() с более ранним сроком
+        # мог бы отработать первым и быть перезаписан более поздним, а
+        # _armed_at остался бы на раннем, и дальнейшие push() его бы не чинили
+        with self._lock:
+            if not self._heap:
+                return
+            next_at = self._heap[0][0]
+            if self._armed_at is not None and self._armed_at <= next_at:
+                return
+            self._armed_at = next_at
+            self._scheduler.add_job(
+                self._fire,
+                trigger="date",
+                run_date=max(next_at, _utcnow_naive()),
+                id=WAKEUP_JOB_ID,
+                replace_existing=True,
+                max_instances=1,
+                coalesce=True,
+                misfire_grace_time=None,
+            )
+        log.debug("[EXPIRY] Wakeup armed at %s", next_at.isoformat())
+
+    def _pop_due(self, now: datetime) -> List[int]:
+        # сами user_id нужны только для счёта: снимает их _expire_due целиком по БД
+        due: List[int] = []
+        with self._lock:
+            self._armed_at = None
+            while self._heap and self._heap[0][0] <= now:
+                exp, uid = heapq.heappop(self._heap)
+                if self._deadline.get(uid) != exp:
+                    continue  # устаревшая запись — дедлайн был продлён
+                del self._deadline[uid]
+                due.append(uid)
+        return due
+
+    def _fire(self) -> None:
+        with self._process_lock, SCHEDULER_TICK_SECONDS.time("wakeup"):
+            now = _utcnow_naive()
+            due = self._pop_due(now)
+            if due:
+                total = self._expire_due(now)
+                log.info("[EXPIRY] Wakeup: due=%d expired=%d", len(due), total)
+        self._arm()
+
+    def _expire_due(self, now: datetime) -> int:
+        """
+        Снимает всех просроченных пользователей set-based запросами:
+        один DELETE ... RETURNING на пачку из chunk_size user_id (keyset по user_id),
+        так что память ограничена размером пачки, а не волной истечений.
+        """
+        after = _MIN_USER_ID
+        total = 0
+        while True:
+            try:
+                with DB_SECONDS.time("expiry.expire_chunk"), engine.begin() as conn:
+                    rows = conn.execute(_EXPIRE_SQL, {"now": now, "after": after, "chunk": self._chunk_size}).all()
+            except Exception:
+                log.exception("[EXPIRY] expire chunk failed after user_id=%s", after)
+                break
+            if not rows:
+                break
+
+            batch = sorted((uid, plan) for uid, plan, _exp in rows)
+            subscriptions_cache.invalidate_many(uid for uid, _plan in batch)
+            total += len(batch)
+            SCHEDULER_ROWS.inc(len(batch), "expire")
+            after = batch[-1][0]
+            log.info("[EXPIRY] Expired chunk: users=%d last_user_id=%s", len(batch), after)
+            log.debug("[EXPIRY] Expired users: %s", dump(batch))
+            try:
+                self._on_expire_batch(batch)  # внутри — планирование корутин в общий loop
+            except Exception:
+                log.exception("[EXPIRY] on_expire_batch failed for %d users", len(batch))
+
+            if len(batch) < self._chunk_size:
+                break
+        return total
@@ -2,29 +2,31 @@
 import os
 import logging
 from datetime import datetime
-from typing import Dict, Optional, Union  # <-- берём Union здесь
+from typing import Awaitable, Callable, Dict, Optional, Union  # <-- берём Union здесь
 from requests.exceptions import HTTPError
 
 from aiogram import types, Dispatcher
-from app.payments import create_invoice
+from app.payments import create_invoice_async
 from app.keyboards import main_menu, plans_menu
-from app.models import SessionLocal, Subscription
+from app.plans import PLANS_BY_CODE
+from app.broadcast import cancel_broadcast, create_broadcast, get_broadcast
+from app.db import run_db
+from app.entitlements import load_subscriptions
+from app.ephemeral import LastInfoStore, create_last_info_store
+from app.invoices import open_invoices
+from app.subs_cache import subscriptions_cache
+from app.timing import HandlerTimingMiddleware
 
 log = logging.getLogger("handlers")
 
-PLAN_MAP = {
-    "plan_week":   ("Неделя", 100.0, 7),
-    "plan_month":  ("Месяц",  300.0, 30),
-    "plan_chat":   ("Чат",     50.0, 1),
-    "plan_test1m": ("Тест1м",   1.0, 0),
-}
-
 APP_BASE_URL  = os.getenv("APP_BASE_URL", os.getenv("BASE_URL", "")).rstrip("/")
 ADMIN_CONTACT = os.getenv("ADMIN_CONTACT", "@YourAdmin")
 CLUB_NAME     = os.getenv("CLUB_NAME", "FOOT SECRET CLUB")
+# Telegram ID администраторов через запятую: им доступны /broadcast и др.
+ADMIN_IDS     = [int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x]
 
-# user_id -> last info message_id
-_LAST_INFO_MSG: Dict[int, int] = {}
+# user_id -> last info message_id (LRU+TTL в памяти или общая таблица — см. app.ephemeral)
+_LAST_INFO_MSG: LastInfoStore = create_last_info_store()
 
 
 def _admin_contact_text() -> str:
@@ -66,7 +68,7 @@ async def _send_ephemeral(
         user_id = cb_or_msg.from_user.id
         bot = cb_or_msg.bot
 
-    prev_id = _LAST_INFO_MSG.get(user_id)
+    prev_id = await _LAST_INFO_MSG.get(user_id)
     if prev_id:
         try:
             await bot.delete_message(chat_id=chat_id, message_id=prev_id)
@@ -74,24 +76,40 @@ async def _send_ephemeral(
             log.debug("delete previous info msg failed user=%s: %s", user_id, e)
 
     sent = await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode, reply_markup=reply_markup)
-    _LAST_INFO_MSG[user_id] = sent.message_id
+    await _LAST_INFO_MSG.set(user_id, sent.message_id)
 
 
 def register_handlers(dp: Dispatcher):
+    # wall/CPU/Bot API по каждому хендлеру -> /metrics, медленные — в лог
+    dp.middleware.setup(HandlerTimingMiddleware(_handler_name))
     dp.register_message_handler(cmd_start, commands=['start'])
+    # один хендлер на все кнопки: callback_data -> обработчик через dict, без цепочки фильтров
+    dp.register_callback_query_handler(route_callback)
+    if ADMIN_IDS:
+        dp.register_message_handler(cmd_broadcast, commands=['broadcast'], user_id=ADMIN_IDS)
+        dp.register_message_handler(cmd_broadcast_status, commands=['broadcast_status'], user_id=ADMIN_IDS)
+        dp.register_message_handler(cmd_broadcast_cancel, commands=['broadcast_cancel'], user_id=ADMIN_IDS)
+
 
-    dp.register_callback_query_handler(cb_buy,      lambda c: c.data == 'buy')
-    dp.register_callback_query_handler(cb_my_subs,  lambda c: c.data == 'my_subs')
-    dp.register_callback_query_handler(cb_bonuses,  lambda c: c.data == 'bonuses')
-    dp.register_callback_query_handler(cb_help,     lambda c: c.data == 'help')
-    dp.register_callback_query_handler(cb_back,     lambda c: c.data == 'back')
+def _handler_name(handler, event) -> str:
+    # за роутером кнопок стоит конкретный обработчик — его и меряем
+    if handler is route_callback:
+        handler = _CALLBACK_ROUTES.get(event.data, handler)
+    return getattr(handler, "__name__", repr(handler))
 
-    dp.register_callback_query_handler(process_plan, lambda c: c.data in PLAN_MAP)
+
+async def route_callback(callback: types.CallbackQuery):
+    handler = _CALLBACK_ROUTES.get(callback.data)
+    if handler is None:
+        log.debug("unknown callback data=%r from user=%s", callback.data, callback.from_user.id)
+        await callback.answer()
+        return
+    await handler(callback)
 
 
 async def cmd_start(message: types.Message):
     await message.answer(_welcome_text(), reply_markup=main_menu(), parse_mode="HTML")
-    _LAST_INFO_MSG.pop(message.from_user.id, None)
+    await _LAST_INFO_MSG.pop(message.from_user.id)
 
 
 async def cb_buy(callback: types.CallbackQuery):
@@ -102,31 +120,29 @@ async def cb_buy(callback: types.CallbackQuery):
 
 async def cb_my_subs(callback: types.CallbackQuery):
     log.info("cb_my_subs from user=%s", callback.from_user.id)
-    session = SessionLocal()
+    user_id = callback.from_user.id
     try:
-        now = datetime.utcnow()
-        subs = (
-            session.query(Subscription)
-            .filter(Subscription.user_id == callback.from_user.id)
-            .order_by(Subscription.expires_at.desc())
-            .all()
-        )
+        subs = subscriptions_cache.get(user_id)
+        if subs is None:
+            # история покупок одним индексным запросом, в пуле БД — чтобы не блокировать loop
+            generation = subscriptions_cache.generation()
+            subs = await run_db(load_subscriptions, user_id)
+            subscriptions_cache.put(user_id, subs, generation)
 
+        now = datetime.utcnow()
         if not subs:
             text = "У вас нет оформленных подписок."
         else:
             lines = []
-            for sub in subs:
-                status = "✅ Активна" if sub.expires_at > now else "⏰ Истекла"
-                lines.append(f"• {sub.plan} — до {sub.expires_at:%d.%m.%Y %H:%M} UTC ({status})")
+            for plan, expires_at in subs:
+                status = "✅ Активна" if expires_at > now else "⏰ Истекла"
+                lines.append(f"• {plan} — до {expires_at:%d.%m.%Y %H:%M} UTC ({status})")
             text = "Ваши подписки:\n\n" + "\n".join(lines)
 
         await _send_ephemeral(callback, text, parse_mode=None)
     except Exception:
-        log.exception("Failed to fetch subscriptions for user=%s", callback.from_user.id)
+        log.exception("Failed to fetch subscriptions for user=%s", user_id)
         await _send_ephemeral(callback, "Ошибка при получении данных о подписках.", parse_mode=None)
-    finally:
-        session.close()
     await callback.answer()
 
 
@@ -157,14 +173,9 @@ async def cb_back(callback: types.CallbackQuery):
     await callback.answer()
 
 
-async def _create_invoice_async(*args, **kwargs):
-    import asyncio
-    loop = asyncio.get_running_loop()
-    return await loop.run_in_executor(None, lambda: create_invoice(*args, **kwargs))
-
-
 async def process_plan(callback: types.CallbackQuery):
-    name, amount, _days = PLAN_MAP[callback.data]
+    plan = PLANS_BY_CODE[callback.data]
+    name, amount = plan.name, plan.amount
     log.info("process_plan user=%s data=%r", callback.from_user.id, callback.data)
 
     order_id = f"tg-{callback.from_user.id}-{callback.id}"
@@ -172,13 +183,17 @@ async def process_plan(callback: types.CallbackQuery):
     fail_url    = f"{APP_BASE_URL}/paid/fail"    if APP_BASE_URL else None
 
     try:
-        invoice = await _create_invoice_async(
-            user_id=callback.from_user.id,
-            amount=amount,
-            plan=name,
-            success_url=success_url,
-            fail_url=fail_url,
-            order_id=order_id,
+        # повторные и одновременные нажатия на тот же план — та же ссылка, один запрос к WATA
+        invoice = await open_invoices.get_or_create(
+            callback.from_user.id, name,
+            lambda: create_invoice_async(
+                user_id=callback.from_user.id,
+                amount=amount,
+                plan=name,
+                success_url=success_url,
+                fail_url=fail_url,
+                order_id=order_id,
+            ),
         )
         pay_url = invoice.get("url")
     except HTTPError as e:
@@ -196,3 +211,51 @@ async def process_plan(callback: types.CallbackQuery):
 
     await _send_ephemeral(callback, f"Счёт на {amount:.2f}₽:\n{pay_url}", parse_mode=None)
     await callback.answer()
+
+
+# ── админ: рассылка всем активным подписчикам ─────────────────────────────────
+async def cmd_broadcast(message: types.Message):
+    # текст после команды — с форматированием (HTML), как его набрал админ
+    parts = message.html_text.split(None, 1)
+    if len(parts) < 2:
+        await message.answer("Использование: /broadcast текст сообщения (можно с форматированием)")
+        return
+    broadcast_id = await run_db(create_broadcast, parts[1], message.from_user.id)
+    log.info("broadcast %s created by admin=%s", broadcast_id, message.from_user.id)
+    await message.answer(
+        f"📣 Рассылка #{broadcast_id} поставлена в очередь.\n"
+        f"Статус: /broadcast_status {broadcast_id}\nОтмена: /broadcast_cancel {broadcast_id}"
+    )
+
+
+async def cmd_broadcast_status(message: types.Message):
+    arg = message.get_args().strip()
+    row = await run_db(get_broadcast, int(arg) if arg.isdigit() else None)
+    if row is None:
+        await message.answer("Рассылок нет.")
+        return
+    await message.answer(
+        f"📣 Рассылка #{row.id}: {row.status}\n"
+        f"Доставлено: {row.sent}, ошибок: {row.failed}\n"
+        f"Последний user_id: {row.cursor_user_id or '—'}"
+    )
+
+
+async def cmd_broadcast_cancel(message: types.Message):
+    arg = message.get_args().strip()
+    if not arg.isdigit():
+        await message.answer("Использование: /broadcast_cancel <id>")
+        return
+    cancelled = await run_db(cancel_broadcast, int(arg))
+    await message.answer(f"Рассылка #{arg} отменена." if cancelled else f"Рассылка #{arg} уже завершена или не найдена.")
+
+
+# callback_data -> обработчик; кнопки планов берутся из каталога
+_CALLBACK_ROUTES: Dict[str, Callable[[types.CallbackQuery], Awaitable[None]]] = {
+    "buy":     cb_buy,
+    "my_subs": cb_my_subs,
+    "bonuses": cb_bonuses,
+    "help":    cb_help,
+    "back":    cb_back,
+    **{code: process_plan for code in PLANS_BY_CODE},
+}
@@ -0,0 +1,234 @@
+# app/inbox.py
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy import delete, select, update
+
+from app.metrics import PAYMENT_INBOX_FAILURES, PAYMENT_INBOX_LAG_SECONDS
+from app.models import PaymentInboxEvent, SessionLocal, engine
+
+log = logging.getLogger(__name__)
+
+PAYMENT_INBOX_WORKERS      = int(os.getenv("PAYMENT_INBOX_WORKERS", "2"))
+PAYMENT_INBOX_BATCH        = int(os.getenv("PAYMENT_INBOX_BATCH", "20"))
+PAYMENT_INBOX_POLL         = float(os.getenv("PAYMENT_INBOX_POLL", "1"))        # опрос чужих вставок, сек
+PAYMENT_INBOX_LEASE        = float(os.getenv("PAYMENT_INBOX_LEASE", "60"))      # строка занята воркером, сек
+PAYMENT_INBOX_MAX_ATTEMPTS = int(os.getenv("PAYMENT_INBOX_MAX_ATTEMPTS", "10"))
+PAYMENT_INBOX_BACKOFF      = float(os.getenv("PAYMENT_INBOX_BACKOFF", "2"))     # первая пауза retry, сек
+PAYMENT_INBOX_BACKOFF_MAX  = float(os.getenv("PAYMENT_INBOX_BACKOFF_MAX", "600"))
+PAYMENT_INBOX_RESULT_TIMEOUT = float(os.getenv("PAYMENT_INBOX_RESULT_TIMEOUT", "30"))  # ждать Future от handle, сек
+
+Claimed = Tuple[int, str, int, datetime]  # id, payload, attempts, received_at
+
+
+class PaymentInbox:
+    """
+    Acknowledge-then-process для webhook'ов WATA.
+
+    add() — один INSERT проверенного тела: webhook отвечает 200, не дожидаясь
+    БД-транзакции выдачи и Telegram. Пул потоков (в каждом процессе) забирает
+    события пачками под аренду (lease): claim сдвигает next_attempt_at на
+    now + lease, поэтому упавший процесс не теряет события — после аренды их
+    заберёт другой воркер. Опрос сначала читает, есть ли что забрать, и только
+    тогда пишет. Успех — строка удаляется; ошибка — повтор с
+    экспоненциальной паузой; после max_attempts строка остаётся с
+    next_attempt_at = NULL и last_error для разбора.
+    handle() может вернуть Future (доставка ссылки на loop бота): событие
+    считается обработанным, когда он успешно завершился, ошибка или таймаут
+    — такой же повод для повтора, как исключение.
+    Повтор безопасен: выдача идемпотентна по orderId (processed_payments),
+    а повтор уже выданного, но не доставленного заказа только заново шлёт
+    ссылку (payment_deliveries).
+    """
+
+    def __init__(
+        self,
+        handle: Callable[[dict], Optional[Future]],
+        workers: int = PAYMENT_INBOX_WORKERS,
+        batch_size: int = PAYMENT_INBOX_BATCH,
+        poll_interval: float = PAYMENT_INBOX_POLL,
+        lease: float = PAYMENT_INBOX_LEASE,
+        max_attempts: int = PAYMENT_INBOX_MAX_ATTEMPTS,
+        result_timeout: float = PAYMENT_INBOX_RESULT_TIMEOUT,
+    ):
+        self._handle = handle
+        self._workers = workers
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+        self._lease = timedelta(seconds=lease)
+        self._max_attempts = max_attempts
+        self._result_timeout = result_timeout
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+
+    def add(self, raw: bytes) -> None:
+        """
+        Сохраняет событие (синхронно, один INSERT) и будит воркеры этого процесса.
+        Исключение — значит, событие не сохранено и webhook должен ответить ошибкой.
+        """
+        session = SessionLocal()
+        try:
+            now = datetime.utcnow()
+            session.add(PaymentInboxEvent(
+                payload=raw.decode("utf-8", errors="replace"),
+                received_at=now,
+                attempts=0,
+                next_attempt_at=now,
+            ))
+            session.commit()
+        finally:
+            session.close()
+        self._wakeup.set()
+
+    def start(self) -> None:
+        if self._threads:
+            return
+        for i in range(self._workers):
+            t = threading.Thread(target=self._run, name=f"payment-inbox-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        log.info("Payment inbox started: workers=%d batch=%d", self._workers, self._batch_size)
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._wakeup.set()
+
+    def depth(self) -> int:
+        """Сколько событий ждёт обработки (все процессы); COUNT в БД — не звать на loop."""
+        session = SessionLocal()
+        try:
+            return session.query(PaymentInboxEvent).filter(PaymentInboxEvent.next_attempt_at.isnot(None)).count()
+        finally:
+            session.close()
+
+    # ── воркеры ─────────────────────────────────────────────────────────────
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                batch = self._claim()
+            except Exception:
+                log.exception("Payment inbox: claim failed")
+                batch = []
+            if not batch:
+                # пусто: ждём add() в этом процессе или следующий опрос (вставки других воркеров)
+                self._wakeup.wait(self._poll_interval)
+                self._wakeup.clear()
+                continue
+            self._process_batch(batch)
+
+    def _has_due(self, now: datetime) -> bool:
+        # только чтение: пустой inbox не берёт writer-лок SQLite на каждом опросе
+        with engine.connect() as conn:
+            return conn.execute(
+                select(PaymentInboxEvent.id).where(PaymentInboxEvent.next_attempt_at <= now).limit(1)
+            ).first() is not None
+
+    def _claim(self) -> List[Claimed]:
+        now = datetime.utcnow()
+        if not self._has_due(now):
+            return []
+        due = (
+            select(PaymentInboxEvent.id)
+            .where(PaymentInboxEvent.next_attempt_at <= now)
+            .order_by(PaymentInboxEvent.id)
+            .limit(self._batch_size)
+        )
+        if engine.dialect.name == "postgresql":
+            due = due.with_for_update(skip_locked=True)
+        stmt = (
+            update(PaymentInboxEvent)
+            .where(PaymentInboxEvent.id.in_(due.scalar_subquery()))
+            .values(next_attempt_at=now + self._lease, attempts=PaymentInboxEvent.attempts + 1)
+            .returning(
+                PaymentInboxEvent.id, PaymentInboxEvent.payload,
+                PaymentInboxEvent.attempts, PaymentInboxEvent.received_at,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        session = SessionLocal()
+        try:
+            rows = session.execute(stmt).all()
+            session.commit()
+        finally:
+            session.close()
+        return sorted((tuple(r) for r in rows), key=lambda r: r[0])
+
+    def _process_batch(self, batch: List[Claimed]) -> None:
+        # сначала все handle() (БД) по порядку, потом ожидание их Future —
+        # доставки пачки идут параллельно, а не одна за другой
+        waiting: List[Tuple[Claimed, Future]] = []
+        for event in batch:
+            try:
+                result = self._handle(json.loads(event[1]) or {})
+            except Exception as e:
+                self._failed(event, e)
+                continue
+            if isinstance(result, Future):
+                waiting.append((event, result))
+            else:
+                self._done(event)
+
+        deadline = time.monotonic() + self._result_timeout
+        for event, future in waiting:
+            try:
+                future.result(timeout=max(0.0, deadline - time.monotonic()))
+            except Exception as e:
+                future.cancel()
+                self._failed(event, e)
+                continue
+            self._done(event)
+
+    def _done(self, event: Claimed) -> None:
+        event_id, _payload, _attempts, received_at = event
+        PAYMENT_INBOX_LAG_SECONDS.observe((datetime.utcnow() - received_at).total_seconds())
+        self._finish(event_id)
+
+    def _failed(self, event: Claimed, error: Exception) -> None:
+        event_id, _payload, attempts, _received_at = event
+        PAYMENT_INBOX_FAILURES.inc()
+        self._reschedule(event_id, attempts, error)
+
+    def _finish(self, event_id: int) -> None:
+        session = SessionLocal()
+        try:
+            session.execute(
+                delete(PaymentInboxEvent)
+                .where(PaymentInboxEvent.id == event_id)
+                .execution_options(synchronize_session=False)
+            )
+            session.commit()
+        finally:
+            session.close()
+
+    def _reschedule(self, event_id: int, attempts: int, error: Exception) -> None:
+        message = str(error) or type(error).__name__  # у таймаута и отмены пустой текст
+        next_at: Optional[datetime] = None
+        if attempts < self._max_attempts:
+            pause = min(PAYMENT_INBOX_BACKOFF * 2 ** (attempts - 1), PAYMENT_INBOX_BACKOFF_MAX)
+            next_at = datetime.utcnow() + timedelta(seconds=random.uniform(pause / 2, pause))
+            log.warning("Payment inbox: event %s failed (attempt %d), retry at %s: %s",
+                        event_id, attempts, next_at.isoformat(), message)
+        else:
+            log.error("Payment inbox: event %s failed %d times, giving up: %s", event_id, attempts, message)
+        session = SessionLocal()
+        try:
+            session.execute(
+                update(PaymentInboxEvent)
+                .where(PaymentInboxEvent.id == event_id)
+                .values(next_attempt_at=next_at, last_error=message[:500])
+                .execution_options(synchronize_session=False)
+            )
+            session.commit()
+        except Exception:
+            # не записали — строка вернётся после окончания аренды
+            log.exception("Payment inbox: failed to reschedule event %s", event_id)
+        finally:
+            session.close()
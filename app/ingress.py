@@ -0,0 +1,147 @@
+# app/ingress.py
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Set, Tuple
+
+from aiogram import types
+
+from app.metrics import UPDATE_QUEUE_WAIT_SECONDS, UPDATES_REJECTED
+
+log = logging.getLogger(__name__)
+
+UPDATE_WORKERS    = int(os.getenv("UPDATE_WORKERS", "64"))  # апдейтов в обработке одновременно
+UPDATE_QUEUE_SIZE = int(os.getenv("UPDATE_QUEUE_SIZE", "1000"))
+
+
+def _update_user_id(update: types.Update) -> int:
+    for part in (update.message, update.callback_query, update.edited_message):
+        if part is not None and part.from_user is not None:
+            return part.from_user.id
+    return update.update_id or 0
+
+
+Queued = Tuple[types.Update, float]  # апдейт, monotonic постановки
+
+
+class UpdateQueue:
+    """
+    Ограниченная очередь входящих апдейтов.
+
+    Апдейты одного пользователя выстраиваются в цепочку и обрабатываются
+    строго по порядку; цепочки разных пользователей идут параллельно, но не
+    больше workers апдейтов одновременно (семафор). Медленный хендлер (счёт
+    WATA, пауза per-chat лимита) задерживает только своего пользователя.
+    Общая глубина ограничена max_size — при переполнении offer() возвращает
+    False, и webhook отвечает не-2xx, чтобы Telegram доставил апдейт позже.
+    """
+
+    def __init__(
+        self,
+        process: Callable[[types.Update], Awaitable[None]],
+        workers: int = UPDATE_WORKERS,
+        max_size: int = UPDATE_QUEUE_SIZE,
+    ):
+        self._process = process
+        self._workers = max(1, workers)
+        self._max_size = max_size
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        # user_id -> ещё не обработанные апдейты; первый — тот, что в работе
+        self._chains: Dict[int, Deque[Queued]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+
+        self._lock = threading.Lock()
+        self._depth = 0
+        self._enqueued = 0
+        self._rejected = 0
+        self._processed = 0
+        self._wait_sum = 0.0
+        self._wait_max = 0.0
+
+    async def start(self) -> None:
+        """Привязывает очередь к текущему loop (вызывать на loop диспетчера)."""
+        if self._loop is not None:
+            return
+        self._slots = asyncio.Semaphore(self._workers)
+        self._loop = asyncio.get_running_loop()
+        log.info("Update queue started: workers=%d max_size=%d", self._workers, self._max_size)
+
+    def offer(self, update: types.Update) -> bool:
+        """
+        Потокобезопасная постановка апдейта. False — очередь полна или не запущена.
+        """
+        if self._loop is None:
+            return False
+        with self._lock:
+            if self._depth >= self._max_size:
+                self._rejected += 1
+                UPDATES_REJECTED.inc()
+                return False
+            self._depth += 1
+            self._enqueued += 1
+
+        item = (update, time.monotonic())
+        try:
+            self._loop.call_soon_threadsafe(self._enqueue, _update_user_id(update), item)
+        except RuntimeError:
+            # loop уже закрыт
+            with self._lock:
+                self._depth -= 1
+            return False
+        return True
+
+    def free_slots(self) -> int:
+        """Сколько апдейтов ещё примет offer() (для polling: не тянуть лишнего)."""
+        with self._lock:
+            return max(0, self._max_size - self._depth)
+
+    def _enqueue(self, user_id: int, item: Queued) -> None:
+        # на loop: цепочка пользователя уже идёт — встаём в её конец, иначе запускаем новую
+        chain = self._chains.get(user_id)
+        if chain is not None:
+            chain.append(item)
+            return
+        self._chains[user_id] = deque([item])
+        task = asyncio.ensure_future(self._run_chain(user_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_chain(self, user_id: int) -> None:
+        chain = self._chains[user_id]
+        while chain:
+            update, enqueued_at = chain[0]
+            async with self._slots:
+                wait = time.monotonic() - enqueued_at
+                UPDATE_QUEUE_WAIT_SECONDS.observe(wait)
+                try:
+                    await self._process(update)
+                except Exception:
+                    log.exception("Update %s processing failed", update.update_id)
+                finally:
+                    with self._lock:
+                        self._depth -= 1
+                        self._processed += 1
+                        self._wait_sum += wait
+                        if wait > self._wait_max:
+                            self._wait_max = wait
+            chain.popleft()
+        # между проверкой и удалением нет await — _enqueue не вклинится
+        del self._chains[user_id]
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            processed = self._processed
+            return {
+                "depth": self._depth,
+                "max_size": self._max_size,
+                "enqueued": self._enqueued,
+                "rejected": self._rejected,
+                "processed": processed,
+                "users": len(self._chains),
+                "wait_avg_ms": round(self._wait_sum / processed * 1000, 3) if processed else 0.0,
+                "wait_max_ms": round(self._wait_max * 1000, 3),
+            }
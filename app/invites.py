@@ -0,0 +1,221 @@
+# app/invites.py
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Union
+
+from aiogram import Bot
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.orm import Session
+
+from app.db import run_db
+from app.models import Entitlement, InviteLink, SessionLocal, engine
+from app.outbound import PRIORITY_BULK, priority
+
+log = logging.getLogger(__name__)
+
+INVITE_POOL_SIZE     = int(os.getenv("INVITE_POOL_SIZE", "20"))                  # свободных ссылок на план
+INVITE_LINK_TTL      = float(os.getenv("INVITE_LINK_TTL", str(7 * 86400)))       # expire_date новой ссылки
+INVITE_LINK_MIN_TTL  = float(os.getenv("INVITE_LINK_MIN_TTL", str(3 * 86400)))   # сколько ссылка должна жить после выдачи
+INVITE_MINT_PER_TICK = int(os.getenv("INVITE_MINT_PER_TICK", "20"))              # createChatInviteLink за один refill
+INVITE_POOL_REFILL_INTERVAL = int(os.getenv("INVITE_POOL_REFILL_INTERVAL", "30"))
+
+
+class InvitePool:
+    """
+    Пул одноразовых (member_limit=1) ссылок в канал — по пулу на план.
+
+    Ссылки создаются заранее фоновым refill (у лидера, приоритет BULK), так что
+    оплата обходится одним UPDATE ... RETURNING в своей транзакции и одной
+    отправкой сообщения — без createChatInviteLink на критическом пути.
+    Свободные ссылки, которым осталось жить меньше min_ttl, отзываются и
+    заменяются новыми; строки выданных ссылок удаляются после их expire_date.
+
+    Ссылка пула живёт дольше короткого плана, поэтому выданная ссылка
+    отзывается, когда доступ кончился: сразу при кике (revoke_issued) и,
+    на случай сбоя, в каждом refill — у всех, у кого нет действующего доступа.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        chat_id: Union[int, str],
+        plans: Iterable[str],
+        size: int = INVITE_POOL_SIZE,
+        ttl: float = INVITE_LINK_TTL,
+        min_ttl: float = INVITE_LINK_MIN_TTL,
+        mint_per_tick: int = INVITE_MINT_PER_TICK,
+    ):
+        self._bot = bot
+        self._chat_id = chat_id
+        self._plans = list(plans)
+        self._size = size
+        self._ttl = timedelta(seconds=ttl)
+        self._min_ttl = timedelta(seconds=min(min_ttl, ttl / 2))
+        self._mint_per_tick = mint_per_tick
+
+    def claim(self, session: Session, plan: str, user_id: int, now: datetime) -> Optional[str]:
+        """
+        Забирает свободную ссылку плана в рамках транзакции вызывающего
+        (откатится вместе с ней). None — пул пуст, нужен запасной путь.
+        """
+        if plan not in self._plans:
+            return None
+        free = (
+            select(InviteLink.link)
+            .where(
+                InviteLink.plan == plan,
+                InviteLink.issued_to.is_(None),
+                InviteLink.expires_at > now + self._min_ttl,
+            )
+            .order_by(InviteLink.created_at)
+            .limit(1)
+        )
+        if engine.dialect.name == "postgresql":
+            # параллельные оплаты берут разные строки, а не ждут друг друга
+            free = free.with_for_update(skip_locked=True)
+        stmt = (
+            update(InviteLink)
+            .where(InviteLink.link == free.scalar_subquery(), InviteLink.issued_to.is_(None))
+            .values(issued_to=user_id, issued_at=now)
+            .returning(InviteLink.link)
+            .execution_options(synchronize_session=False)
+        )
+        return session.execute(stmt).scalar_one_or_none()
+
+    # ── отзыв выданных ссылок ───────────────────────────────────────────────
+    def _issued_sync(self, user_id: Optional[int], now: datetime) -> List[str]:
+        # ещё живые выданные ссылки user_id; None — всех без действующего доступа
+        stmt = select(InviteLink.link).where(InviteLink.issued_to.isnot(None), InviteLink.expires_at > now)
+        if user_id is not None:
+            stmt = stmt.where(InviteLink.issued_to == user_id)
+        else:
+            stmt = stmt.where(~select(Entitlement.user_id).where(
+                Entitlement.user_id == InviteLink.issued_to, Entitlement.expires_at > now,
+            ).exists())
+        session = SessionLocal()
+        try:
+            return list(session.execute(stmt).scalars())
+        finally:
+            session.close()
+
+    def _forget_sync(self, links: List[str]) -> None:
+        session = SessionLocal()
+        try:
+            session.execute(
+                delete(InviteLink).where(InviteLink.link.in_(links)).execution_options(synchronize_session=False)
+            )
+            session.commit()
+        finally:
+            session.close()
+
+    async def _revoke(self, links: List[str]) -> List[str]:
+        revoked = []
+        for link in links:
+            try:
+                await self._bot.revoke_chat_invite_link(chat_id=self._chat_id, invite_link=link)
+                revoked.append(link)
+            except Exception as e:
+                log.debug("revoke invite link failed: %s", e)
+        return revoked
+
+    async def revoke_issued(self, user_id: int) -> int:
+        """
+        Отзывает ещё не истёкшие ссылки, выданные user_id: доступ кончился, и
+        неиспользованная ссылка не должна пускать в канал. Неудачные остаются
+        в таблице — их подберёт следующий refill. Возвращает число отозванных.
+        """
+        links = await run_db(self._issued_sync, user_id, datetime.utcnow())
+        revoked = await self._revoke(links)
+        if revoked:
+            await run_db(self._forget_sync, revoked)
+        return len(revoked)
+
+    # ── фоновое пополнение ──────────────────────────────────────────────────
+    def _recycle_sync(self, now: datetime) -> List[str]:
+        session = SessionLocal()
+        try:
+            # DELETE ... RETURNING: ссылка уходит из пула до revoke, claim её уже не получит
+            stale = session.execute(
+                delete(InviteLink)
+                .where(InviteLink.issued_to.is_(None), InviteLink.expires_at <= now + self._min_ttl)
+                .returning(InviteLink.link)
+                .execution_options(synchronize_session=False)
+            ).scalars().all()
+            session.execute(
+                delete(InviteLink)
+                .where(InviteLink.issued_to.isnot(None), InviteLink.expires_at <= now)
+                .execution_options(synchronize_session=False)
+            )
+            session.commit()
+            return list(stale)
+        finally:
+            session.close()
+
+    def _free_counts_sync(self) -> Dict[str, int]:
+        session = SessionLocal()
+        try:
+            rows = session.execute(
+                select(InviteLink.plan, func.count())
+                .where(InviteLink.issued_to.is_(None))
+                .group_by(InviteLink.plan)
+            ).all()
+            return {plan: n for plan, n in rows}
+        finally:
+            session.close()
+
+    def _store_sync(self, links: List[InviteLink]) -> None:
+        session = SessionLocal()
+        try:
+            session.add_all(links)
+            session.commit()
+        finally:
+            session.close()
+
+    async def refill(self) -> int:
+        """
+        Отзывает устаревшие свободные ссылки и выданные ссылки без действующего
+        доступа, досоздаёт недостающие
+        (не больше mint_per_tick за вызов). Возвращает число новых ссылок.
+        """
+        now = datetime.utcnow()
+        stale = await run_db(self._recycle_sync, now)
+        orphaned = await run_db(self._issued_sync, None, now)
+
+        with priority(PRIORITY_BULK):
+            await self._revoke(stale)
+            orphaned = await self._revoke(orphaned)
+            if orphaned:
+                await run_db(self._forget_sync, orphaned)
+
+            counts = await run_db(self._free_counts_sync)
+            expires = now + self._ttl
+            expire_ts = int(expires.replace(tzinfo=timezone.utc).timestamp())
+            minted: List[InviteLink] = []
+            # по одной ссылке на план по кругу: бюджет тика делится между планами поровну
+            missing = {plan: self._size - counts.get(plan, 0) for plan in self._plans}
+            try:
+                while len(minted) < self._mint_per_tick and any(n > 0 for n in missing.values()):
+                    for plan in self._plans:
+                        if missing[plan] <= 0 or len(minted) >= self._mint_per_tick:
+                            continue
+                        invite = await self._bot.create_chat_invite_link(
+                            chat_id=self._chat_id,
+                            name=f"{plan} pool"[:32],
+                            expire_date=expire_ts,
+                            member_limit=1,
+                        )
+                        minted.append(InviteLink(
+                            link=invite.invite_link, plan=plan, created_at=now, expires_at=expires,
+                        ))
+                        missing[plan] -= 1
+            except Exception as e:
+                # скорее всего 429 — добьём пул на следующем тике
+                log.warning("Invite pool: create_chat_invite_link failed after %d links: %s", len(minted), e)
+
+        if minted:
+            await run_db(self._store_sync, minted)
+        if stale or orphaned or minted:
+            log.info("Invite pool refill: revoked=%d expired_access=%d minted=%d",
+                     len(stale), len(orphaned), len(minted))
+        return len(minted)
@@ -0,0 +1,126 @@
+# app/invoices.py
+import asyncio
+import json
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from sqlalchemy import delete
+from sqlalchemy.orm import Session
+
+from app.db import run_db
+from app.metrics import INVOICE_CACHE
+from app.models import OpenInvoice, SessionLocal, engine
+
+log = logging.getLogger(__name__)
+
+INVOICE_REUSE_TTL    = float(os.getenv("INVOICE_REUSE_TTL", "900"))   # сколько отдаём ту же ссылку, сек
+INVOICE_REUSE_MARGIN = float(os.getenv("INVOICE_REUSE_MARGIN", "120"))  # запас до expirationDateTime WATA
+
+Key = Tuple[int, str]  # (user_id, plan)
+
+
+def _invoice_ttl(invoice: dict, ttl: float) -> float:
+    # не дольше, чем живёт сама ссылка WATA (если она это сообщает)
+    expires = invoice.get("expirationDateTime")
+    if not expires:
+        return ttl
+    try:
+        expires_at = datetime.fromisoformat(str(expires).replace("Z", "+00:00"))
+    except ValueError:
+        return ttl
+    if expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+    left = (expires_at - datetime.now(timezone.utc)).total_seconds() - INVOICE_REUSE_MARGIN
+    return max(0.0, min(ttl, left))
+
+
+def _load_sync(user_id: int, plan: str) -> Optional[dict]:
+    session = SessionLocal()
+    try:
+        row = session.get(OpenInvoice, (user_id, plan))
+        if row is None or row.expires_at <= datetime.utcnow():
+            return None
+        return json.loads(row.payload)
+    finally:
+        session.close()
+
+
+def _store_sync(user_id: int, plan: str, invoice: dict, expires_at: datetime) -> None:
+    if engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+
+    values = dict(user_id=user_id, plan=plan, payload=json.dumps(invoice), expires_at=expires_at)
+    stmt = insert(OpenInvoice).values(**values).on_conflict_do_update(
+        index_elements=[OpenInvoice.user_id, OpenInvoice.plan],
+        set_={"payload": values["payload"], "expires_at": expires_at},
+    )
+    with engine.begin() as conn:
+        conn.execute(stmt)
+
+
+class OpenInvoiceCache:
+    """
+    Открытые счета WATA по (user_id, plan): повторное нажатие на план в
+    пределах TTL отдаёт ту же ссылку без запроса к WATA, а одновременные
+    нажатия (двойной клик) ждут один create_invoice (single-flight).
+
+    Счета лежат в таблице open_invoices, общей для всех воркеров: оплата
+    обрабатывается в том процессе, который взял событие из inbox, и
+    invalidate_user() в её транзакции убирает ссылку для всех сразу.
+    Single-flight — в пределах процесса (loop бота).
+    Ошибки и ответы без url не сохраняются.
+    """
+
+    def __init__(self, ttl: float = INVOICE_REUSE_TTL):
+        self._ttl = ttl
+        self._inflight: Dict[Key, asyncio.Future] = {}
+
+    async def get_or_create(self, user_id: int, plan: str, create: Callable[[], Awaitable[dict]]) -> dict:
+        key = (user_id, plan)
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            INVOICE_CACHE.inc(1, "coalesced")
+            # shield: отмена одного ожидающего не отменяет общий запрос
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            invoice = await run_db(_load_sync, user_id, plan)
+            if invoice is not None:
+                INVOICE_CACHE.inc(1, "hit")
+                log.debug("invoice reused user=%s plan=%s", user_id, plan)
+            else:
+                INVOICE_CACHE.inc(1, "miss")
+                invoice = await create()
+                ttl = _invoice_ttl(invoice, self._ttl)
+                if invoice.get("url") and ttl > 0:
+                    expires_at = datetime.utcnow() + timedelta(seconds=ttl)
+                    await run_db(_store_sync, user_id, plan, invoice, expires_at)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # ожидающих может не быть — не логировать "never retrieved"
+            raise
+        else:
+            future.set_result(invoice)
+            return invoice
+        finally:
+            self._inflight.pop(key, None)
+
+    @staticmethod
+    def invalidate_user(session: Session, user_id: int) -> None:
+        """
+        Удаляет открытые счета пользователя в транзакции session (выдача
+        подписки): после коммита оплаченную ссылку не получит ни один процесс.
+        """
+        session.execute(delete(OpenInvoice).where(OpenInvoice.user_id == user_id))
+
+
+open_invoices = OpenInvoiceCache()
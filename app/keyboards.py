@@ -1,9 +1,16 @@
 # app/keyboards.py
 import os
+from functools import lru_cache
+
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
+from app.plans import PLANS
+
 NEWS_URL = os.getenv("NEWS_URL")  # ссылка на ваш новостной канал/чат
 
+# разметка не зависит от пользователя: собираем один раз и переиспользуем
+# (объекты общие — не изменять после возврата)
+@lru_cache(maxsize=None)
 def main_menu() -> InlineKeyboardMarkup:
     """
     Красивое главное меню в 2 колонки + блок "Наши новости" отдельной строкой.
@@ -27,14 +34,13 @@ def main_menu() -> InlineKeyboardMarkup:
     return kb
 
 
+@lru_cache(maxsize=None)
 def plans_menu() -> InlineKeyboardMarkup:
     """
-    Меню выбора тарифного плана (один столбец) + назад.
+    Меню выбора тарифного плана (один столбец, из каталога app.plans) + назад.
     """
     kb = InlineKeyboardMarkup(row_width=1)
-    kb.insert(InlineKeyboardButton('Неделя — 100₽', callback_data='plan_week'))
-    kb.insert(InlineKeyboardButton('Месяц — 300₽', callback_data='plan_month'))
-    kb.insert(InlineKeyboardButton('Чат 1 день — 50₽', callback_data='plan_chat'))
-    kb.insert(InlineKeyboardButton('Тест 1 мин — 1₽', callback_data='plan_test1m'))
+    for plan in PLANS:
+        kb.insert(InlineKeyboardButton(plan.button, callback_data=plan.code))
     kb.insert(InlineKeyboardButton('⬅️ Назад', callback_data='back'))
     return kb
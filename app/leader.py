@@ -0,0 +1,165 @@
+# app/leader.py
+import logging
+import os
+import threading
+from typing import Callable, Optional
+
+from app.models import engine
+
+log = logging.getLogger(__name__)
+
+LEADER_CHECK_INTERVAL = float(os.getenv("LEADER_CHECK_INTERVAL", "5"))
+# ключ pg advisory lock: "Foot" в ASCII
+LEADER_LOCK_KEY = int(os.getenv("LEADER_LOCK_KEY", str(0x466F6F74)))
+
+
+class _PgAdvisoryLock:
+    """
+    Сессионный pg_try_advisory_lock на выделенном соединении вне пула.
+    Если процесс умер или соединение оборвалось — Postgres сам снимает лок.
+    """
+
+    def __init__(self, key: int):
+        self._key = key
+        self._conn = None
+
+    def try_acquire(self) -> bool:
+        conn = engine.raw_connection()
+        conn.detach()  # соединение не вернётся в пул: close() действительно закроет сессию
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT pg_try_advisory_lock(%s)", (self._key,))
+            acquired = bool(cur.fetchone()[0])
+            conn.commit()
+            cur.close()
+        except Exception:
+            conn.close()
+            raise
+        if acquired:
+            self._conn = conn
+        else:
+            conn.close()
+        return acquired
+
+    def check(self) -> bool:
+        # соединение живо — значит, лок всё ещё наш
+        try:
+            cur = self._conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            self._conn.commit()
+            cur.close()
+            return True
+        except Exception:
+            self.release()
+            return False
+
+    def release(self) -> None:
+        if self._conn is not None:
+            try:
+                self._conn.close()  # закрытие сессии снимает advisory lock
+            except Exception:
+                pass
+            self._conn = None
+
+
+class _FileLock:
+    """
+    flock на файле рядом с SQLite-базой: снимается ядром при смерти процесса.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._fd: Optional[int] = None
+
+    def try_acquire(self) -> bool:
+        import fcntl
+
+        fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, str(os.getpid()).encode())
+        self._fd = fd
+        return True
+
+    def check(self) -> bool:
+        return self._fd is not None
+
+    def release(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+def _make_lock():
+    if engine.dialect.name == "postgresql":
+        return _PgAdvisoryLock(LEADER_LOCK_KEY)
+    db_path = engine.url.database if engine.dialect.name == "sqlite" else None
+    if not db_path or db_path == ":memory:":
+        db_path = "footbot"
+    return _FileLock(os.path.abspath(db_path) + ".leader.lock")
+
+
+class LeaderElector:
+    """
+    Выбор лидера среди воркеров gunicorn: ровно один процесс держит лок
+    и выполняет on_elected (планировщик, установка вебхука). Остальные
+    раз в interval секунд пытаются взять лок — так лидер переизбирается,
+    если его процесс умер.
+    """
+
+    def __init__(
+        self,
+        on_elected: Callable[[], None],
+        on_demoted: Optional[Callable[[], None]] = None,
+        interval: float = LEADER_CHECK_INTERVAL,
+    ):
+        self._on_elected = on_elected
+        self._on_demoted = on_demoted
+        self._interval = interval
+        self._lock = _make_lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.is_leader = False
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._tick()  # первая попытка синхронно: одиночный воркер стартует сразу лидером
+        self._thread = threading.Thread(target=self._run, name="leader-elector", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self.is_leader:
+            self._demote()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self._interval):
+            self._tick()
+
+    def _tick(self) -> None:
+        try:
+            if self.is_leader:
+                if not self._lock.check():
+                    log.warning("Leadership lost (pid=%s)", os.getpid())
+                    self._demote()
+            elif self._lock.try_acquire():
+                log.info("Elected as leader (pid=%s, db=%s)", os.getpid(), engine.dialect.name)
+                self.is_leader = True
+                self._on_elected()
+        except Exception:
+            log.exception("Leader election tick failed")
+
+    def _demote(self) -> None:
+        self.is_leader = False
+        self._lock.release()
+        if self._on_demoted:
+            try:
+                self._on_demoted()
+            except Exception:
+                log.exception("on_demoted failed")
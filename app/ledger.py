@@ -0,0 +1,41 @@
+# app/ledger.py
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+PAYMENT_RECENT_ORDERS = int(os.getenv("PAYMENT_RECENT_ORDERS", "10000"))
+
+
+class RecentOrders:
+    """
+    In-memory LRU недавно обработанных orderId — быстрый O(1) отсев ретраев
+    до любых обращений к БД и Telegram. Источник истины — таблица
+    processed_payments: LRU лишь срезает повторные попытки.
+    """
+
+    def __init__(self, max_size: int = PAYMENT_RECENT_ORDERS):
+        self._max_size = max_size
+        self._data: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, order_id: Optional[str]) -> bool:
+        if not order_id:
+            return False
+        with self._lock:
+            if order_id in self._data:
+                self._data.move_to_end(order_id)
+                return True
+            return False
+
+    def add(self, order_id: Optional[str]) -> None:
+        if not order_id:
+            return
+        with self._lock:
+            self._data[order_id] = None
+            self._data.move_to_end(order_id)
+            while len(self._data) > self._max_size:
+                self._data.popitem(last=False)
+
+
+recent_orders = RecentOrders()
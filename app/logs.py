@@ -0,0 +1,153 @@
+# app/logs.py
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+from app.metrics import LOG_DROPPED
+
+LOG_LEVEL      = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT     = os.getenv("LOG_FORMAT", "%(asctime)s %(levelname)s %(name)s: %(message)s")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# категория (имя логгера, действует и на дочерние) = доля INFO/DEBUG, которая пишется,
+# например "handlers=0.1,app.outbound=0.1"; пусто — пишется всё.
+# WARNING и выше не сэмплируются никогда
+LOG_SAMPLE     = os.getenv("LOG_SAMPLE", "")
+LOG_DUMP_MAX   = int(os.getenv("LOG_DUMP_MAX", "512"))  # символов на дамп (payload, строки БД)
+LOG_FULL_DUMPS = os.getenv("LOG_FULL_DUMPS", "0") == "1"  # отладка: дампы целиком
+
+_listener: Optional[QueueListener] = None
+_configured_pid: Optional[int] = None
+
+
+def _parse_rates(spec: str) -> Dict[str, float]:
+    rates = {}
+    for part in spec.split(","):
+        name, _, rate = part.strip().partition("=")
+        if name and rate:
+            rates[name] = max(0.0, min(1.0, float(rate)))
+    return rates
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Пропускает INFO/DEBUG категории с заданной долей. Категория ищется по имени
+    логгера и его родителям ("app.outbound" покрывает "app.outbound.x"),
+    результат поиска кэшируется — на горячем пути только dict lookup и random().
+    """
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self._rates = rates
+        self._cache: Dict[str, Optional[float]] = {}
+
+    def _rate(self, name: str) -> Optional[float]:
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+        rate, prefix = None, name
+        while prefix:
+            if prefix in self._rates:
+                rate = self._rates[prefix]
+                break
+            prefix = prefix.rpartition(".")[0]
+        self._cache[name] = rate
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate(record.name)
+        return rate is None or random.random() < rate
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """
+    Кладёт запись в ограниченную очередь и сразу возвращается: форматирование
+    и запись в stdout — в потоке QueueListener. Очередь полна — запись
+    отбрасывается (footbot_log_dropped_total), вызывающий поток не ждёт.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # без self.format(): msg % args считается в потоке listener'а, и только для записанных
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_DROPPED.inc()
+
+
+class _Dump:
+    __slots__ = ("obj", "limit")
+
+    def __init__(self, obj, limit: Optional[int]):
+        self.obj = obj
+        self.limit = limit
+
+    def __str__(self) -> str:
+        try:
+            text = json.dumps(self.obj, ensure_ascii=False, default=str)
+        except (TypeError, ValueError):
+            text = repr(self.obj)
+        limit = None if LOG_FULL_DUMPS else self.limit
+        if limit and len(text) > limit:
+            return f"{text[:limit]}…(+{len(text) - limit} chars)"
+        return text
+
+
+def dump(obj, limit: Optional[int] = None) -> _Dump:
+    """
+    Ленивый и ограниченный дамп для аргумента лога:
+        log.info("Payment webhook: %s", dump(data))
+    Сериализация — только если запись действительно пишется, не длиннее
+    LOG_DUMP_MAX символов (LOG_FULL_DUMPS=1 — целиком).
+    """
+    return _Dump(obj, limit or LOG_DUMP_MAX)
+
+
+def _stop_listener() -> None:
+    # дописываем очередь при выходе процесса
+    if _listener is not None and _configured_pid == os.getpid():
+        try:
+            _listener.stop()
+        except queue.Full:
+            pass
+
+
+def setup_logging() -> None:
+    """
+    Корневой логгер -> неблокирующий QueueHandler (+ сэмплирование) -> поток
+    QueueListener -> StreamHandler. Один раз на процесс; после fork вызывается
+    заново — поток listener'а родителя в дочерний процесс не переходит.
+    """
+    global _listener, _configured_pid
+    if _configured_pid == os.getpid():
+        return
+
+    log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    handler = _NonBlockingQueueHandler(log_queue)
+    rates = _parse_rates(LOG_SAMPLE)
+    if rates:
+        handler.addFilter(SamplingFilter(rates))
+
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+
+    _listener = QueueListener(log_queue, stream, respect_handler_level=True)
+    _listener.start()
+    if _configured_pid is None:
+        atexit.register(_stop_listener)
+    _configured_pid = os.getpid()
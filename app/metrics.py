@@ -0,0 +1,430 @@
+# app/metrics.py
+import atexit
+import bisect
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+log = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# снимки метрик воркеров (по файлу на pid) — /metrics любого воркера отдаёт сумму
+# по всем; пусто — только свой процесс. Каталог чистит мастер gunicorn при старте
+METRICS_DIR   = os.getenv("METRICS_DIR", os.path.join(tempfile.gettempdir(), "footbot-metrics"))
+METRICS_FLUSH = float(os.getenv("METRICS_FLUSH", "5"))  # как часто воркер пишет свой снимок, сек
+
+# секунды: от сотен микросекунд (verify_signature) до десятков секунд (пачки истечений)
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+LabelValues = Tuple[str, ...]
+Samples = Dict[LabelValues, object]  # labels -> число (counter, gauge) или [бакеты, сумма, количество]
+
+
+def _merge(kind: str, into: Samples, items: Iterable[Tuple[LabelValues, object]]) -> None:
+    # сложение shard'ов потоков и снимков процессов: одинаково для всех видов
+    for key, value in items:
+        if kind == "histogram":
+            counts, s, n = value
+            acc = into.get(key)
+            if acc is None:
+                into[key] = [list(counts), s, n]
+            else:
+                acc[0] = [a + b for a, b in zip(acc[0], counts)]
+                acc[1] += s
+                acc[2] += n
+        else:
+            into[key] = into.get(key, 0.0) + value
+
+
+class _Metric(ABC):
+    """
+    Общая часть метрик с per-thread агрегацией: каждый поток пишет только
+    в свой shard (без блокировок на горячем пути), а collect() суммирует shard'ы.
+    Лок берётся лишь при первом обращении потока — чтобы зарегистрировать shard.
+    Shard завершившегося потока (wata-pubkey, Timer обновления ключа...)
+    при сборе вливается в общий _retired и больше не хранится.
+    """
+    kind = ""
+    shared = False  # значение одно на все процессы — в снимки не пишется
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards: List[Tuple[threading.Thread, Samples]] = []
+        self._retired: Samples = {}
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _shard(self) -> Samples:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = {}
+            self._local.shard = shard
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _collect_shards(self) -> Samples:
+        total: Samples = {}
+        with self._lock:
+            alive = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    _merge(self.kind, self._retired, list(shard.items()))
+            self._shards = alive
+            _merge(self.kind, total, self._retired.items())
+            for _thread, shard in alive:
+                _merge(self.kind, total, list(shard.items()))
+        return total
+
+    def _reset_after_fork(self) -> None:
+        # значения мастера не должны попасть в сумму каждого воркера
+        self._lock = threading.Lock()
+        for _thread, shard in self._shards:
+            shard.clear()
+        self._retired.clear()
+
+    def _label_str(self, values: LabelValues, extra: str = "") -> str:
+        pairs = [f'{k}="{_escape(v)}"' for k, v in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    @abstractmethod
+    def collect(self) -> Samples:
+        """Текущие значения этого процесса: labels -> значение."""
+
+    @abstractmethod
+    def expose(self, samples: Samples) -> List[str]:
+        """Строки экспозиции Prometheus (без # HELP/# TYPE — их пишет Registry)."""
+
+    def render(self) -> List[str]:
+        return self.expose(self.collect())
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, *labels: str) -> None:
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0.0) + amount
+
+    def collect(self) -> Samples:
+        return self._collect_shards()
+
+    def expose(self, samples: Samples) -> List[str]:
+        return [f"{self.name}{self._label_str(k)} {v}" for k, v in sorted(samples.items())]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels: str) -> None:
+        shard = self._shard()
+        cell = shard.get(labels)
+        if cell is None:
+            # [счётчики по бакетам (+Inf последним), сумма, количество]
+            cell = shard[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        cell[0][bisect.bisect_left(self.buckets, value)] += 1
+        cell[1] += value
+        cell[2] += 1
+
+    @contextmanager
+    def time(self, *labels: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def collect(self) -> Samples:
+        return self._collect_shards()
+
+    def expose(self, samples: Samples) -> List[str]:
+        lines = []
+        for key, (counts, s, n) in sorted(samples.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{self._label_str(key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{self._label_str(key, le)} {n}")
+            lines.append(f"{self.name}_sum{self._label_str(key)} {s}")
+            lines.append(f"{self.name}_count{self._label_str(key)} {n}")
+        return lines
+
+
+class GaugeFunc(_Metric):
+    """
+    Gauge, значение которого читается колбэком в момент скрейпа
+    (глубина очередей и т.п.). fn возвращает число или {labels: число}.
+    Значения воркеров складываются; shared=True — величина общая для всех
+    процессов (COUNT в БД): её считает только отвечающий на скрейп процесс.
+    """
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, fn: Callable[[], object], labelnames: Sequence[str] = (),
+                 shared: bool = False):
+        self._fn = fn
+        self.shared = shared
+        super().__init__(name, help_text, labelnames)
+
+    def collect(self) -> Samples:
+        try:
+            value = self._fn()
+        except Exception:
+            return {}
+        if isinstance(value, dict):
+            return dict(value)
+        return {(): value}
+
+    def expose(self, samples: Samples) -> List[str]:
+        return [f"{self.name}{self._label_str(k)} {v}" for k, v in sorted(samples.items())]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> None:
+        with self._lock:
+            self._metrics[metric.name] = metric
+
+    def metrics(self) -> List[_Metric]:
+        with self._lock:
+            return list(self._metrics.values())
+
+    def render(self) -> str:
+        metrics = self.metrics()
+        samples = {m.name: m.collect() for m in metrics}
+        if METRICS_DIR:
+            try:
+                samples = _merge_processes(metrics, samples)
+            except OSError as e:
+                log.warning("metrics: per-process snapshots unavailable, serving this worker only: %s", e)
+        out = []
+        for m in metrics:
+            out.append(f"# HELP {m.name} {m.help}")
+            out.append(f"# TYPE {m.name} {m.kind}")
+            out.extend(m.expose(samples[m.name]))
+        return "\n".join(out) + "\n"
+
+    def _reset_after_fork(self) -> None:
+        self._lock = threading.Lock()
+        for m in self._metrics.values():
+            m._reset_after_fork()
+
+
+REGISTRY = Registry()
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+# ── несколько процессов (gunicorn -w N) ───────────────────────────────────────
+# Каждый воркер пишет свой снимок в METRICS_DIR/<pid>.json (раз в METRICS_FLUSH
+# и на каждом скрейпе), /metrics складывает все снимки. Счётчики и гистограммы
+# умерших воркеров переносятся в dead.json, чтобы суммы не шли назад; их
+# gauge'и просто отбрасываются.
+_ARCHIVE = "dead.json"
+_flusher_pid: Optional[int] = None
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _dump(samples: Dict[str, Samples], kinds: Dict[str, str]) -> dict:
+    return {name: {"kind": kinds[name], "samples": [[list(k), v] for k, v in s.items()]}
+            for name, s in samples.items()}
+
+
+def _write_json(path: str, data: dict) -> None:
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)  # читатели видят либо старый снимок, либо новый целиком
+
+
+def _read_json(path: str) -> Optional[dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        log.warning("metrics: corrupt snapshot %s ignored", path)
+        return None
+
+
+def _write_snapshot(metrics: List[_Metric], samples: Dict[str, Samples]) -> None:
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    own = {m.name: samples[m.name] for m in metrics if not m.shared}
+    _write_json(os.path.join(METRICS_DIR, f"{os.getpid()}.json"),
+                _dump(own, {m.name: m.kind for m in metrics}))
+
+
+@contextmanager
+def _dir_lock():
+    import fcntl
+
+    fd = os.open(os.path.join(METRICS_DIR, ".lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)  # закрытие снимает flock
+
+
+def _merge_processes(metrics: List[_Metric], local: Dict[str, Samples]) -> Dict[str, Samples]:
+    _write_snapshot(metrics, local)
+    merged: Dict[str, Samples] = {m.name: (local[m.name] if m.shared else {}) for m in metrics}
+    kinds = {m.name: m.kind for m in metrics if not m.shared}
+
+    def _add(data: dict, with_gauges: bool) -> None:
+        for name, entry in data.items():
+            if name in kinds and (with_gauges or entry["kind"] != "gauge"):
+                _merge(entry["kind"], merged[name], ((tuple(k), v) for k, v in entry["samples"]))
+
+    # под локом каталога: перенос умершего снимка в архив и чтение — атомарно
+    # для соседних воркеров, ни одно значение не посчитается дважды
+    with _dir_lock():
+        archive_path = os.path.join(METRICS_DIR, _ARCHIVE)
+        archive = _read_json(archive_path) or {}
+        folded = False
+        for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+            stem = os.path.basename(path)[:-len(".json")]
+            if not stem.isdigit():
+                continue
+            data = _read_json(path)
+            if data is None:
+                continue
+            if _pid_alive(int(stem)):
+                _add(data, with_gauges=True)
+                continue
+            for name, entry in data.items():
+                if entry["kind"] == "gauge":
+                    continue
+                dead = archive.setdefault(name, {"kind": entry["kind"], "samples": []})
+                acc: Samples = {tuple(k): v for k, v in dead["samples"]}
+                _merge(entry["kind"], acc, ((tuple(k), v) for k, v in entry["samples"]))
+                dead["samples"] = [[list(k), v] for k, v in acc.items()]
+            os.remove(path)
+            folded = True
+        if folded:
+            _write_json(archive_path, archive)
+        _add(archive, with_gauges=False)
+    return merged
+
+
+def flush() -> None:
+    """Пишет снимок метрик этого процесса (фоновый поток и выход процесса)."""
+    if not METRICS_DIR:
+        return
+    metrics = REGISTRY.metrics()
+    try:
+        _write_snapshot(metrics, {m.name: m.collect() for m in metrics if not m.shared})
+    except OSError as e:
+        log.warning("metrics: snapshot write failed: %s", e)
+
+
+def start_flusher(interval: float = METRICS_FLUSH) -> None:
+    """Фоновая запись снимка: соседние воркеры видят значения не старше interval."""
+    global _flusher_pid
+    if not METRICS_DIR or _flusher_pid == os.getpid():
+        return
+    _flusher_pid = os.getpid()
+
+    def _run():
+        while True:
+            time.sleep(interval)
+            flush()
+
+    threading.Thread(target=_run, name="metrics-flush", daemon=True).start()
+    atexit.register(flush)
+
+
+def reset_dir() -> None:
+    """Удаляет снимки прошлого запуска (мастер gunicorn до fork воркеров)."""
+    if not METRICS_DIR:
+        return
+    for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+        os.remove(path)
+
+
+os.register_at_fork(after_in_child=REGISTRY._reset_after_fork)
+
+
+# ── инструменты горячих путей ─────────────────────────────────────────────────
+WEBHOOK_SECONDS = Histogram(
+    "footbot_webhook_seconds", "HTTP webhook handling time", ["endpoint"])
+UPDATE_QUEUE_WAIT_SECONDS = Histogram(
+    "footbot_update_queue_wait_seconds", "Time an update waited in the queue before processing")
+UPDATES_REJECTED = Counter(
+    "footbot_updates_rejected_total", "Updates rejected because the queue was full")
+BOT_API_SECONDS = Histogram(
+    "footbot_bot_api_seconds", "Telegram Bot API call time (including rate limiter wait)", ["method"])
+BOT_API_ERRORS = Counter(
+    "footbot_bot_api_errors_total", "Telegram Bot API call errors", ["method", "error"])
+WATA_SECONDS = Histogram(
+    "footbot_wata_seconds", "WATA HTTP call time", ["op"])
+VERIFY_SIGNATURE_SECONDS = Histogram(
+    "footbot_verify_signature_seconds", "WATA webhook signature verification time")
+SCHEDULER_TICK_SECONDS = Histogram(
+    "footbot_scheduler_tick_seconds", "Expiry scheduler job duration", ["job"])
+SCHEDULER_ROWS = Counter(
+    "footbot_scheduler_rows_total", "Rows processed by the expiry scheduler", ["job"])
+DB_SECONDS = Histogram(
+    "footbot_db_seconds", "Database call time per call site", ["site"])
+LOG_DROPPED = Counter(
+    "footbot_log_dropped_total", "Log records dropped because the log queue was full")
+PAYMENT_INBOX_LAG_SECONDS = Histogram(
+    "footbot_payment_inbox_lag_seconds", "Time from payment webhook receipt to successful processing")
+PAYMENT_INBOX_FAILURES = Counter(
+    "footbot_payment_inbox_failures_total", "Failed attempts to process payment inbox events")
+BROADCAST_MESSAGES = Counter(
+    "footbot_broadcast_messages_total", "Broadcast messages by delivery result", ["result"])
+POLLING_BATCH_SIZE = Histogram(
+    "footbot_polling_batch_size", "Updates per getUpdates response in polling mode",
+    buckets=(0, 1, 5, 10, 25, 50, 100))
+INVOICE_CACHE = Counter(
+    "footbot_invoice_cache_total", "Plan taps by open-invoice cache outcome (hit, coalesced, miss)", ["result"])
+HANDLER_SECONDS = Histogram(
+    "footbot_handler_seconds", "aiogram handler wall time", ["handler"])
+HANDLER_CPU_SECONDS = Histogram(
+    "footbot_handler_cpu_seconds", "aiogram handler CPU time on the bot loop", ["handler"])
+HANDLER_BOT_API_SECONDS = Histogram(
+    "footbot_handler_bot_api_seconds", "Bot API time spent inside a handler", ["handler", "method"])
@@ -1,14 +1,118 @@
 # app/models.py
 import os
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, BigInteger
+import logging
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import create_engine, event, inspect, text, Column, Integer, String, DateTime, BigInteger, Index, Text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+log = logging.getLogger(__name__)
+
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///subscriptions.db")
+if DATABASE_URL.startswith("postgres://"):
+    # Railway/Heroku отдают postgres://, SQLAlchemy 2 понимает только postgresql://
+    DATABASE_URL = "postgresql://" + DATABASE_URL[len("postgres://"):]
+
+# auto — профиль по диалекту (ниже); off — create_engine по умолчанию, как раньше
+DB_ENGINE_PROFILE = os.getenv("DB_ENGINE_PROFILE", "auto").lower()
+
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_MMAP_SIZE       = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_WAL             = os.getenv("SQLITE_WAL", "1") == "1"  # 0 — для сетевых ФС, где WAL не работает
+
+DB_POOL_OVERFLOW    = int(os.getenv("DB_POOL_OVERFLOW", "4"))
+DB_POOL_RECYCLE     = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # сек; раньше idle-таймаутов прокси/PG
+DB_POOL_TIMEOUT     = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_MAX_CONNECTIONS  = int(os.getenv("DB_MAX_CONNECTIONS", "0"))  # бюджет соединений на все воркеры; 0 — без лимита
+
+# ключ pg advisory lock на init_db (лидер — LEADER_LOCK_KEY в app.leader): "Foou" в ASCII
+SCHEMA_LOCK_KEY = int(os.getenv("SCHEMA_LOCK_KEY", str(0x466F6F75)))
+
+
+# ── профили движка ────────────────────────────────────────────────────────────
+def _db_threads() -> int:
+    """
+    Сколько потоков процесса одновременно ходят в БД: потоки gunicorn
+    (GUNICORN_THREADS), пул app.db (DB_POOL_SIZE), воркеры payment inbox и
+    пул планировщика. Читаем те же переменные, что и владельцы потоков.
+    """
+    return (
+        int(os.getenv("GUNICORN_THREADS", "8"))
+        + int(os.getenv("DB_POOL_SIZE", "4"))
+        + int(os.getenv("PAYMENT_INBOX_WORKERS", "2"))
+        + 2  # ThreadPoolExecutor APScheduler (app.scheduler)
+    )
+
+
+def _pool_kwargs() -> dict:
+    # по соединению на поток, плюс немного на всплески; без ожидания пула в норме
+    pool_size, overflow = _db_threads(), DB_POOL_OVERFLOW
+    if DB_MAX_CONNECTIONS:
+        workers = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+        # минус 1 — выделенное соединение advisory-лока лидера (app.leader)
+        budget = max(1, DB_MAX_CONNECTIONS // workers - 1)
+        if pool_size + overflow > budget:
+            log.warning("DB pool %d+%d exceeds DB_MAX_CONNECTIONS/%d workers, capped to %d",
+                        pool_size, overflow, workers, budget)
+            pool_size, overflow = min(pool_size, budget), max(0, budget - pool_size)
+    return {"pool_size": pool_size, "max_overflow": overflow, "pool_timeout": DB_POOL_TIMEOUT}
+
+
+def _postgres_profile() -> dict:
+    return {
+        # Railway Postgres обычно требует sslmode=require
+        "connect_args": {"sslmode": "require"},
+        "pool_pre_ping": True,  # соединение, оборванное прокси/рестартом PG, не уходит в запрос
+        "pool_recycle": DB_POOL_RECYCLE,
+        **_pool_kwargs(),
+    }
+
+
+def _sqlite_profile() -> dict:
+    return {
+        # busy-handler драйвера: ждать чужую запись, а не падать "database is locked"
+        "connect_args": {"timeout": SQLITE_BUSY_TIMEOUT_MS / 1000},
+        **_pool_kwargs(),
+    }
+
+
+def _apply_sqlite_pragmas(dbapi_conn, _record) -> None:
+    """
+    WAL: читатели не блокируют писателя и наоборот (rollback journal держит
+    SHARED-локи читателей до конца запроса, и COMMIT ждёт их всех).
+    synchronous=NORMAL в WAL — fsync только на checkpoint, без риска порчи БД.
+    """
+    cur = dbapi_conn.cursor()
+    try:
+        if SQLITE_WAL:
+            cur.execute("PRAGMA journal_mode=WAL")
+            cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cur.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    finally:
+        cur.close()
+
 
-# Railway Postgres обычно требует sslmode=require
-connect_args = {"sslmode": "require"} if DATABASE_URL.startswith(("postgres://", "postgresql://")) else {}
-engine = create_engine(DATABASE_URL, connect_args=connect_args)
+def _create_engine(url: str):
+    dialect = url.split(":", 1)[0].split("+", 1)[0]
+    if DB_ENGINE_PROFILE == "off":
+        connect_args = {"sslmode": "require"} if dialect == "postgresql" else {}
+        return create_engine(url, connect_args=connect_args)
+
+    if dialect == "postgresql":
+        return create_engine(url, **_postgres_profile())
+    if dialect == "sqlite":
+        in_memory = url in ("sqlite://", "sqlite:///:memory:")
+        if in_memory:
+            return create_engine(url)  # одно соединение на поток, WAL неприменим
+        sqlite_engine = create_engine(url, **_sqlite_profile())
+        event.listen(sqlite_engine, "connect", _apply_sqlite_pragmas)
+        return sqlite_engine
+    return create_engine(url)
+
+
+engine = _create_engine(DATABASE_URL)
 
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -16,13 +120,247 @@ Base = declarative_base()
 
 
 class Subscription(Base):
+    """
+    История покупок (только append): по строке на каждую оплату.
+    Текущий доступ пользователя — в Entitlement.
+    """
     __tablename__ = "subscriptions"
+    # «Мои подписки»: последние покупки пользователя (app.entitlements.load_subscriptions)
+    __table_args__ = (Index("ix_subscriptions_user_expires", "user_id", "expires_at"),)
 
     id         = Column(Integer, primary_key=True, index=True)
     user_id    = Column(BigInteger, index=True, nullable=False)  # TG ID может быть > int32
     plan       = Column(String, nullable=False)
-    expires_at = Column(DateTime, nullable=False)  # UTC naive
+    expires_at = Column(DateTime, nullable=False)  # UTC naive; срок доступа после этой покупки
+
+
+class Entitlement(Base):
+    """
+    Текущий доступ: ровно одна строка на пользователя, продлевается upsert'ом
+    на месте (app.entitlements.extend_entitlement). Чтение «Моих подписок» и
+    проверка истечения — одиночные индексные lookup'ы без агрегаций.
+    """
+    __tablename__ = "entitlements"
+
+    user_id    = Column(BigInteger, primary_key=True, autoincrement=False)
+    plan       = Column(String, nullable=False)  # план последней покупки
+    expires_at = Column(DateTime, nullable=False, index=True)  # UTC naive; индекс — для ExpiryEngine
+    updated_at = Column(DateTime, nullable=False)
+
+
+class ProcessedPayment(Base):
+    """
+    Журнал обработанных оплат: уникальный order_id не даёт выдать подписку
+    повторно на ретрай webhook'а WATA (в том числе после рестарта).
+    """
+    __tablename__ = "processed_payments"
+
+    order_id     = Column(String, primary_key=True)
+    user_id      = Column(BigInteger, nullable=False)
+    plan         = Column(String, nullable=False)
+    processed_at = Column(DateTime, nullable=False)  # UTC naive
+
+
+class PaymentDelivery(Base):
+    """
+    Выданная, но ещё не доставленная оплата: пишется в транзакции выдачи
+    вместе с processed_payments и удаляется, когда ссылка в канал дошла до
+    пользователя. Ретрай события из inbox по такому orderId повторяет только
+    доставку (анбан и сообщение), не продлевая доступ второй раз; пока идёт
+    текущая попытка (next_attempt_at в будущем), дубли её не повторяют.
+    """
+    __tablename__ = "payment_deliveries"
+
+    order_id        = Column(String, primary_key=True)
+    user_id         = Column(BigInteger, nullable=False)
+    plan            = Column(String, nullable=False)
+    invite_link     = Column(String, nullable=True)  # из пула; NULL — создать ссылку при доставке
+    expires_at      = Column(DateTime, nullable=False)  # UTC naive; срок доступа для текста и ссылки
+    next_attempt_at = Column(DateTime, nullable=False)  # UTC naive; до него доставка идёт — повтор не начинать
+
+
+class SubsCacheInvalidation(Base):
+    """
+    Журнал инвалидаций кэша «Моих подписок» (app.subs_cache): запись пишется
+    в транзакции выдачи, каждый процесс раз в SUBS_CACHE_SYNC секунд читает
+    свежие строки и сбрасывает у себя этих пользователей. Старые строки
+    удаляет лидер.
+    """
+    __tablename__ = "subs_cache_invalidations"
+
+    id         = Column(Integer, primary_key=True, autoincrement=True)
+    user_id    = Column(BigInteger, nullable=False)
+    created_at = Column(DateTime, nullable=False, index=True)  # UTC naive
+
+
+class PaymentInboxEvent(Base):
+    """
+    Входящие события WATA (app.inbox.PaymentInbox): webhook только вставляет
+    проверенное тело и отвечает 200, обработку делают воркеры. Успешно
+    обработанные строки удаляются; next_attempt_at IS NULL — исчерпаны попытки.
+    """
+    __tablename__ = "payment_inbox"
+
+    id              = Column(Integer, primary_key=True, autoincrement=True)
+    payload         = Column(Text, nullable=False)  # тело webhook'а как пришло (подпись уже проверена)
+    received_at     = Column(DateTime, nullable=False)  # UTC naive
+    attempts        = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=True, index=True)  # UTC naive; до него строка занята/отложена
+    last_error      = Column(String, nullable=True)
+
+
+class Broadcast(Base):
+    """
+    Рассылка всем активным подписчикам (app.broadcast.BroadcastEngine).
+    cursor_user_id — последний user_id, чья страница уже разослана и сохранена:
+    после рестарта рассылка продолжается с него.
+    """
+    __tablename__ = "broadcasts"
+
+    id             = Column(Integer, primary_key=True, autoincrement=True)
+    text           = Column(Text, nullable=False)  # HTML
+    status         = Column(String, nullable=False, index=True)  # pending/running/done/cancelled
+    created_by     = Column(BigInteger, nullable=True)
+    created_at     = Column(DateTime, nullable=False)  # UTC naive
+    started_at     = Column(DateTime, nullable=True)
+    finished_at    = Column(DateTime, nullable=True)
+    cursor_user_id = Column(BigInteger, nullable=True)
+    sent           = Column(Integer, nullable=False, default=0)
+    failed         = Column(Integer, nullable=False, default=0)
+
+
+class BroadcastFailure(Base):
+    """
+    Недоставленные сообщения рассылки: бот заблокирован, чат не найден и т.п.
+    """
+    __tablename__ = "broadcast_failures"
+
+    id           = Column(Integer, primary_key=True, autoincrement=True)
+    broadcast_id = Column(Integer, nullable=False, index=True)
+    user_id      = Column(BigInteger, nullable=False)
+    error        = Column(String, nullable=False)
+    failed_at    = Column(DateTime, nullable=False)  # UTC naive
+
+
+class PollingOffset(Base):
+    """
+    Следующий offset getUpdates (app.polling.UpdatePoller): после рестарта
+    уже принятые в очередь апдейты не запрашиваются повторно.
+    """
+    __tablename__ = "polling_offsets"
+
+    bot_id      = Column(BigInteger, primary_key=True, autoincrement=False)
+    next_offset = Column(BigInteger, nullable=False)
+    updated_at  = Column(DateTime, nullable=False)  # UTC naive
+
+
+class LastInfoMessage(Base):
+    """
+    Последнее «служебное» сообщение пользователя (общий для процессов бэкенд
+    app.ephemeral.DbLastInfoStore).
+    """
+    __tablename__ = "last_info_messages"
+
+    user_id    = Column(BigInteger, primary_key=True, autoincrement=False)
+    message_id = Column(BigInteger, nullable=False)
+    updated_at = Column(DateTime, nullable=False, index=True)  # UTC naive
+
+
+class InviteLink(Base):
+    """
+    Пул заранее созданных одноразовых ссылок в канал (app.invites.InvitePool).
+    issued_to IS NULL — ссылка свободна; выдача — UPDATE этой строки в транзакции оплаты.
+    """
+    __tablename__ = "invite_links"
+    __table_args__ = (Index("ix_invite_links_plan_free", "plan", "issued_to", "created_at"),)
+
+    link       = Column(String, primary_key=True)
+    plan       = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False)  # UTC naive
+    expires_at = Column(DateTime, nullable=False)  # expire_date ссылки в Telegram, UTC naive
+    issued_to  = Column(BigInteger, nullable=True)
+    issued_at  = Column(DateTime, nullable=True)
+
+
+class OpenInvoice(Base):
+    """
+    Неоплаченный счёт WATA по (user_id, plan) — app.invoices.OpenInvoiceCache.
+    Общий для всех процессов: строки пользователя удаляются в транзакции выдачи
+    подписки, поэтому оплаченную ссылку не отдаёт повторно ни один воркер.
+    """
+    __tablename__ = "open_invoices"
+
+    user_id    = Column(BigInteger, primary_key=True, autoincrement=False)
+    plan       = Column(String, primary_key=True)
+    payload    = Column(Text, nullable=False)  # ответ WATA (JSON): url, orderId, ...
+    expires_at = Column(DateTime, nullable=False)  # UTC naive; позже — создаём новый счёт
+
+
+def _migrate_subscriptions_to_entitlements(conn) -> int:
+    """
+    Однократная миграция со старой схемы: для каждого пользователя берём строку
+    subscriptions с максимальным expires_at и переносим её в entitlements.
+    Сами строки subscriptions остаются как история покупок. Уже перенесённых
+    пользователей пропускает — повторный запуск ничего не ломает.
+    """
+    result = conn.execute(
+        text("""
+            INSERT INTO entitlements (user_id, plan, expires_at, updated_at)
+            SELECT s.user_id, MIN(s.plan), s.expires_at, :now
+            FROM subscriptions s
+            JOIN (
+                SELECT user_id, MAX(expires_at) AS max_exp
+                FROM subscriptions
+                GROUP BY user_id
+            ) last ON last.user_id = s.user_id AND last.max_exp = s.expires_at
+            WHERE NOT EXISTS (SELECT 1 FROM entitlements e WHERE e.user_id = s.user_id)
+            GROUP BY s.user_id, s.expires_at
+            ON CONFLICT (user_id) DO NOTHING
+        """).bindparams(now=datetime.utcnow())
+    )
+    return result.rowcount
+
+
+@contextmanager
+def _schema_lock():
+    """
+    Соединение в транзакции под межпроцессным локом: воркеры gunicorn
+    выполняют init_db одновременно (post_fork), а create_all и миграция
+    гонок не переживают. Postgres — pg_advisory_xact_lock (снимается с
+    транзакцией), SQLite — flock на файле рядом с базой.
+    """
+    if engine.dialect.name == "postgresql":
+        with engine.begin() as conn:
+            conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+            yield conn
+        return
+
+    db_path = engine.url.database if engine.dialect.name == "sqlite" else None
+    if not db_path or db_path == ":memory:":
+        with engine.begin() as conn:
+            yield conn
+        return
+
+    import fcntl
+
+    fd = os.open(os.path.abspath(db_path) + ".init.lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        with engine.begin() as conn:
+            yield conn
+    finally:
+        os.close(fd)  # закрытие снимает flock
 
 
 def init_db():
-    Base.metadata.create_all(bind=engine)
+    with _schema_lock() as conn:
+        had_entitlements = inspect(conn).has_table(Entitlement.__tablename__)
+        Base.metadata.create_all(bind=conn)
+        if not had_entitlements:
+            migrated = _migrate_subscriptions_to_entitlements(conn)
+            log.info("Migrated %s users from subscriptions to entitlements", migrated)
+
+        # create_all не добавляет индексы в уже существующие таблицы — досоздаём
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
@@ -0,0 +1,231 @@
+# app/outbound.py
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter
+
+from app.metrics import BOT_API_ERRORS, BOT_API_SECONDS
+from app.timing import record_bot_api_call
+
+log = logging.getLogger(__name__)
+
+# ── приоритеты исходящих сообщений (меньше — важнее) ─────────────────────────
+PRIORITY_PAYMENT     = 0   # подтверждения оплаты, инвайты
+PRIORITY_INTERACTIVE = 1   # ответы на нажатия кнопок
+PRIORITY_NOTICE      = 2   # уведомления об истечении
+PRIORITY_BULK        = 3   # массовые рассылки
+
+GLOBAL_RATE    = float(os.getenv("TG_GLOBAL_RATE", "30"))     # сообщений/сек на бота
+PRIVATE_RATE   = float(os.getenv("TG_PRIVATE_RATE", "1"))     # сообщений/сек в один личный чат
+GROUP_RATE     = float(os.getenv("TG_GROUP_RATE", str(20 / 60)))  # в группу/канал
+RETRY_ATTEMPTS = int(os.getenv("TG_RETRY_ATTEMPTS", "3"))
+
+# лимиты Telegram считаются по отправленным сообщениям; остальные методы
+# (ban/unban, deleteMessage, answerCallbackQuery...) идут без очереди:
+# их RetryAfter задерживает и повторяет только сам вызов
+_LIMITED_METHODS = ("send", "copyMessage", "forwardMessage")
+
+_priority: ContextVar[int] = ContextVar("outbound_priority", default=PRIORITY_INTERACTIVE)
+
+
+@contextmanager
+def priority(level: int):
+    """
+    Задаёт приоритет всех вызовов Bot API внутри блока:
+        with priority(PRIORITY_PAYMENT):
+            await bot.send_message(...)
+    """
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+async def with_priority(level: int, coro):
+    """Выполняет корутину с заданным приоритетом исходящих вызовов."""
+    with priority(level):
+        return await coro
+
+
+class TokenBucket:
+    """
+    Token bucket с резервированием: reserve() сразу забирает токен
+    (уходя в минус) и возвращает, сколько ждать до его «оплаты».
+    """
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def reserve(self, now: float) -> float:
+        self._refill(now)
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def penalize(self, now: float, seconds: float) -> None:
+        # RetryAfter: ближайшие seconds секунд токенов нет. Не суммируется:
+        # несколько 429 из одного окна flood control дают одну паузу
+        self._refill(now)
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class OutboundLimiter:
+    """
+    Общая очередь исходящих сообщений: глобальный token bucket с очередью
+    по приоритетам и per-chat bucket'ы (LRU, чтобы не копить все чаты навсегда).
+    Работает только на одном event loop — том, где живёт бот.
+    """
+
+    def __init__(
+        self,
+        global_rate: float = GLOBAL_RATE,
+        private_rate: float = PRIVATE_RATE,
+        group_rate: float = GROUP_RATE,
+        max_chats: int = 10000,
+    ):
+        self._global = TokenBucket(global_rate, max(1.0, global_rate))
+        self._private_rate = private_rate
+        self._group_rate = group_rate
+        self._max_chats = max_chats
+        self._chats: "OrderedDict[int, TokenBucket]" = OrderedDict()
+
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._pump: Optional[asyncio.Task] = None
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is not None:
+            self._chats.move_to_end(chat_id)
+            return bucket
+
+        rate = self._private_rate if chat_id > 0 else self._group_rate
+        bucket = TokenBucket(rate, 1.0)
+        self._chats[chat_id] = bucket
+        if len(self._chats) > self._max_chats:
+            now = time.monotonic()
+            # выбрасываем самые старые bucket'ы, которые уже полностью восстановились
+            for cid in list(itertools.islice(self._chats, 0, len(self._chats) - self._max_chats)):
+                if self._chats[cid].is_full(now):
+                    del self._chats[cid]
+        return bucket
+
+    async def acquire(self, chat_id: Optional[int], prio: int) -> None:
+        if chat_id is not None:
+            delay = self._chat_bucket(chat_id).reserve(time.monotonic())
+            if delay:
+                await asyncio.sleep(delay)
+
+        # быстрый путь: очередь пуста и токен есть
+        if not self._waiters and self._global.wait_time(time.monotonic()) == 0:
+            self._global.reserve(time.monotonic())
+            return
+
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (prio, next(self._seq), fut))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.ensure_future(self._run_pump())
+        await fut
+
+    async def _run_pump(self) -> None:
+        while self._waiters:
+            wait = self._global.wait_time(time.monotonic())
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+            _prio, _seq, fut = heapq.heappop(self._waiters)
+            if fut.done():
+                continue  # ожидающий отменён
+            self._global.reserve(time.monotonic())
+            fut.set_result(None)
+
+    def penalize(self, chat_id: Optional[int], seconds: float) -> None:
+        now = time.monotonic()
+        if chat_id is None:
+            self._global.penalize(now, seconds)
+        else:
+            self._chat_bucket(chat_id).penalize(now, seconds)
+
+    def stats(self) -> Dict[str, int]:
+        return {"waiting": len(self._waiters), "chats": len(self._chats)}
+
+
+def _chat_id_of(data: Optional[dict]) -> Optional[int]:
+    chat_id = (data or {}).get("chat_id")
+    try:
+        return int(chat_id)
+    except (TypeError, ValueError):
+        return None  # @username каналов и т.п. — только глобальный лимит
+
+
+class RateLimitedBot(Bot):
+    """
+    Bot, все исходящие вызовы которого проходят через OutboundLimiter.
+    Сообщения ждут токены (глобальный + per-chat) в порядке приоритета,
+    RetryAfter от Telegram приводит к паузе и повтору, а не к потере сообщения.
+    """
+
+    def __init__(self, *args, limiter: Optional[OutboundLimiter] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limiter = limiter or OutboundLimiter()
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await self._request_limited(method, data, files, **kwargs)
+        except Exception as e:
+            BOT_API_ERRORS.inc(1, method, type(e).__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            BOT_API_SECONDS.observe(elapsed, method)
+            record_bot_api_call(method, elapsed)
+
+    async def _request_limited(self, method, data=None, files=None, **kwargs):
+        limited = method.startswith(_LIMITED_METHODS)
+        chat_id = _chat_id_of(data) if limited else None
+        prio = _priority.get()
+
+        attempt = 0
+        while True:
+            if limited:
+                await self.limiter.acquire(chat_id, prio)
+            try:
+                return await super().request(method, data, files, **kwargs)
+            except RetryAfter as e:
+                attempt += 1
+                if limited:
+                    self.limiter.penalize(chat_id, e.timeout)
+                if attempt > RETRY_ATTEMPTS:
+                    log.warning("%s: RetryAfter %ss, giving up after %d attempts (chat=%s)",
+                                method, e.timeout, attempt, chat_id)
+                    raise
+                log.info("%s: RetryAfter %ss (chat=%s, attempt=%d)", method, e.timeout, chat_id, attempt)
+                if not limited:
+                    # ждёт только этот вызов: общая очередь сообщений от него не зависит
+                    await asyncio.sleep(e.timeout)
@@ -2,8 +2,19 @@
 import os
 import time
 import base64
+import random
+import asyncio
+import logging
+import threading
 import requests
+import aiohttp
 from typing import Optional
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from app.metrics import VERIFY_SIGNATURE_SECONDS, WATA_SECONDS
+
+log = logging.getLogger(__name__)
 
 WATA_BASE_URL = os.getenv("WATA_BASE_URL", "https://api-sandbox.wata.pro/api/h2h").rstrip("/")
 WATA_TOKEN    = os.getenv("WATA_TOKEN")
@@ -12,78 +23,203 @@ MODE          = os.getenv("PAYMENTS_MODE", "real").lower()  # 'real' | 'mock'
 
 PUBLIC_KEY_URL = os.getenv("WATA_PUBLIC_KEY_URL", f"{WATA_BASE_URL}/public-key")
 
+# ── HTTP-пул к WATA ───────────────────────────────────────────────────────────
+WATA_POOL_SIZE       = int(os.getenv("WATA_POOL_SIZE", "10"))
+WATA_CONNECT_TIMEOUT = float(os.getenv("WATA_CONNECT_TIMEOUT", "5"))
+WATA_READ_TIMEOUT    = float(os.getenv("WATA_READ_TIMEOUT", "15"))
+WATA_RETRIES         = int(os.getenv("WATA_RETRIES", "2"))
+WATA_BACKOFF         = float(os.getenv("WATA_BACKOFF", "0.3"))  # базовая пауза retry, сек
+WATA_KEEPALIVE       = float(os.getenv("WATA_KEEPALIVE", "60"))  # сколько держать idle-соединение
+
+# повторяем только то, что безопасно: обрывы и временные ответы.
+# Дедупликация WATA по orderId не гарантирована, поэтому POST /links повторяется,
+# только если запрос точно не дошёл: не удалось соединиться или 429
+_RETRY_STATUSES      = (429, 502, 503, 504)
+_POST_RETRY_STATUSES = (429,)
+
+_http_session: Optional[requests.Session] = None
+_http_lock = threading.Lock()
+
+
+def _http() -> requests.Session:
+    """
+    Долгоживущая requests.Session с keep-alive пулом для синхронных вызовов.
+    """
+    global _http_session
+    if _http_session is None:
+        with _http_lock:
+            if _http_session is None:
+                retry = Retry(
+                    total=WATA_RETRIES,
+                    connect=WATA_RETRIES,
+                    read=WATA_RETRIES,
+                    status=WATA_RETRIES,
+                    status_forcelist=_RETRY_STATUSES,
+                    allowed_methods=frozenset({"GET"}),  # POST — только ошибки соединения
+                    backoff_factor=WATA_BACKOFF,
+                    backoff_jitter=WATA_BACKOFF,
+                    raise_on_status=False,
+                )
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=WATA_POOL_SIZE, max_retries=retry)
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _http_session = session
+    return _http_session
+
 # ── Public key cache ──────────────────────────────────────────────────────────
-_PUBKEY_CACHE = {"pem": None, "ts": 0.0}
-_PUBKEY_TTL   = 600.0  # 10 минут
+_PUBKEY_TTL       = float(os.getenv("WATA_PUBKEY_TTL", "600"))         # 10 минут
+_PUBKEY_MAX_STALE = float(os.getenv("WATA_PUBKEY_MAX_STALE", "86400"))  # сколько отдаём старый ключ, если WATA недоступна
+_PUBKEY_PREFETCH  = 0.8  # доля TTL, после которой ключ обновляется в фоне
 
 
 def _fetch_public_key_pem() -> str:
-    now = time.time()
-    if _PUBKEY_CACHE["pem"] and (now - _PUBKEY_CACHE["ts"] < _PUBKEY_TTL):
-        return _PUBKEY_CACHE["pem"]
-
-    resp = requests.get(PUBLIC_KEY_URL, headers={"Content-Type": "application/json"}, timeout=10)
+    with WATA_SECONDS.time("public_key"):
+        resp = _http().get(
+            PUBLIC_KEY_URL,
+            headers={"Content-Type": "application/json"},
+            timeout=(WATA_CONNECT_TIMEOUT, 10),
+        )
     resp.raise_for_status()
     data = resp.json()
     pem = data.get("value") or ""
     if not pem.startswith("-----BEGIN PUBLIC KEY-----"):
         raise ValueError("Invalid public key PEM from WATA")
-    _PUBKEY_CACHE["pem"] = pem
-    _PUBKEY_CACHE["ts"] = now
     return pem
 
 
-def verify_signature(raw_body: bytes, signature_b64: str) -> bool:
+class _PublicKeyCache:
     """
-    Проверка X-Signature (RSA+SHA512) входящего webhook’а WATA.
-    В mock-режиме всегда True.
+    Кэш уже распарсенного ключа WATA (вместе с padding/hash для verify).
+
+    - обновление single-flight: одновременно идёт не больше одного запроса к WATA;
+    - stale-while-revalidate: устаревший ключ отдаётся сразу, обновление — в фоне;
+    - prefetch: после каждого обновления ставится таймер на _PUBKEY_PREFETCH * TTL,
+      так что в штатном режиме проверка подписи никогда не ждёт сеть.
     """
-    if MODE == "mock":
-        return True
 
-    try:
+    def __init__(self, ttl: float, max_stale: float):
+        self._ttl = ttl
+        self._max_stale = max_stale
+        self._entry = None  # (public_key, padding, hash_algo)
+        self._ts = 0.0
+        self._fetch_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._refreshing = False
+        self._timer: Optional[threading.Timer] = None
+
+    def get(self):
+        entry, age = self._entry, time.monotonic() - self._ts
+        if entry is not None:
+            if age >= self._ttl * _PUBKEY_PREFETCH and age < self._max_stale:
+                self.refresh_in_background()
+            if age < self._max_stale:
+                return entry
+
+        # ключа нет совсем — ждём единственный запрос
+        with self._fetch_lock:
+            if self._entry is not None and time.monotonic() - self._ts < self._ttl:
+                return self._entry  # уже загружен соседним потоком
+            return self._refresh_locked()
+
+    def loaded(self) -> bool:
+        # get() отдаст ключ без сети (в худшем случае — с фоновым обновлением)
+        return self._entry is not None and time.monotonic() - self._ts < self._max_stale
+
+    def _refresh_locked(self):
         from cryptography.hazmat.primitives import hashes, serialization
         from cryptography.hazmat.primitives.asymmetric import padding
 
         pem = _fetch_public_key_pem()
         public_key = serialization.load_pem_public_key(pem.encode("utf-8"))
-        signature  = base64.b64decode(signature_b64)
+        self._entry = (public_key, padding.PKCS1v15(), hashes.SHA512())
+        self._ts = time.monotonic()
+        log.info("WATA public key refreshed")
 
-        public_key.verify(
-            signature,
-            raw_body,
-            padding.PKCS1v15(),
-            hashes.SHA512(),
-        )
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = threading.Timer(self._ttl * _PUBKEY_PREFETCH, self.refresh_in_background)
+        self._timer.daemon = True
+        self._timer.start()
+        return self._entry
+
+    def refresh_in_background(self) -> None:
+        with self._state_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, name="wata-pubkey", daemon=True).start()
+
+    def _background_refresh(self) -> None:
+        try:
+            with self._fetch_lock:
+                if self._entry is not None and time.monotonic() - self._ts < self._ttl * _PUBKEY_PREFETCH:
+                    return
+                self._refresh_locked()
+        except Exception as e:
+            log.warning("WATA public key refresh failed: %s", e)
+        finally:
+            with self._state_lock:
+                self._refreshing = False
+
+
+_pubkey_cache = _PublicKeyCache(_PUBKEY_TTL, _PUBKEY_MAX_STALE)
+
+
+def prefetch_public_key() -> None:
+    """
+    Фоновая загрузка ключа при старте, чтобы первый webhook не ждал WATA.
+    """
+    if MODE != "mock":
+        _pubkey_cache.refresh_in_background()
+
+
+def signature_check_is_local() -> bool:
+    """
+    True — verify_signature не пойдёт в сеть за ключом и её можно звать
+    прямо на event loop; иначе — только в executor'е.
+    """
+    return MODE == "mock" or _pubkey_cache.loaded()
+
+
+def verify_signature(raw_body: bytes, signature_b64: str) -> bool:
+    """
+    Проверка X-Signature (RSA+SHA512) входящего webhook’а WATA.
+    В mock-режиме всегда True.
+    """
+    if MODE == "mock":
+        return True
+
+    started = time.perf_counter()
+    try:
+        public_key, pad, algo = _pubkey_cache.get()
+        signature = base64.b64decode(signature_b64)
+        public_key.verify(signature, raw_body, pad, algo)
         return True
     except Exception:
         return False
+    finally:
+        VERIFY_SIGNATURE_SECONDS.observe(time.perf_counter() - started)
 
 
-def create_invoice(
+def _mock_invoice(user_id: int, amount: float, plan: str, order_id: Optional[str]) -> dict:
+    if not APP_BASE_URL:
+        raise RuntimeError("APP_BASE_URL or BASE_URL is required in mock mode")
+    link = (
+        f"{APP_BASE_URL}/testpay"
+        f"?user_id={user_id}&plan={plan}&amount={amount:.2f}&orderId={order_id or user_id}"
+    )
+    return {"id": "mock", "url": link, "status": "Opened"}
+
+
+def _invoice_payload(
     user_id: int,
     amount: float,
     plan: str,
-    success_url: Optional[str] = None,
-    fail_url: Optional[str] = None,
-    order_id: Optional[str] = None
+    success_url: Optional[str],
+    fail_url: Optional[str],
+    order_id: Optional[str],
 ) -> dict:
-    """
-    Создание платёжной ссылки через WATA.
-    В mock-режиме возвращает ссылку на вашу заглушку /testpay.
-    """
-    # MOCK: без токена или явно включен mock → своя тестовая ссылка
-    if MODE == "mock" or not WATA_TOKEN:
-        if not APP_BASE_URL:
-            raise RuntimeError("APP_BASE_URL or BASE_URL is required in mock mode")
-        link = (
-            f"{APP_BASE_URL}/testpay"
-            f"?user_id={user_id}&plan={plan}&amount={amount:.2f}&orderId={order_id or user_id}"
-        )
-        return {"id": "mock", "url": link, "status": "Opened"}
-
-    # REAL: sandbox/prod WATA
-    url = f"{WATA_BASE_URL}/links"
     payload = {
         "amount": float(f"{amount:.2f}"),
         "currency": "RUB",
@@ -94,13 +230,45 @@ def create_invoice(
         payload["successRedirectUrl"] = success_url
     if fail_url:
         payload["failRedirectUrl"] = fail_url
+    return payload
+
 
-    headers = {
+def _auth_headers() -> dict:
+    return {
         "Authorization": f"Bearer {WATA_TOKEN}",
         "Content-Type": "application/json",
     }
 
-    resp = requests.post(url, json=payload, headers=headers, timeout=15)
+
+def _use_mock() -> bool:
+    # MOCK: без токена или явно включен mock → своя тестовая ссылка
+    return MODE == "mock" or not WATA_TOKEN
+
+
+def create_invoice(
+    user_id: int,
+    amount: float,
+    plan: str,
+    success_url: Optional[str] = None,
+    fail_url: Optional[str] = None,
+    order_id: Optional[str] = None
+) -> dict:
+    """
+    Создание платёжной ссылки через WATA.
+    В mock-режиме возвращает ссылку на вашу заглушку /testpay.
+    """
+    if _use_mock():
+        return _mock_invoice(user_id, amount, plan, order_id)
+
+    # REAL: sandbox/prod WATA
+    url = f"{WATA_BASE_URL}/links"
+    payload = _invoice_payload(user_id, amount, plan, success_url, fail_url, order_id)
+
+    with WATA_SECONDS.time("create_invoice"):
+        resp = _http().post(
+            url, json=payload, headers=_auth_headers(),
+            timeout=(WATA_CONNECT_TIMEOUT, WATA_READ_TIMEOUT),
+        )
     if resp.status_code >= 400:
         try:
             detail = resp.json()
@@ -109,3 +277,94 @@ def create_invoice(
         raise requests.HTTPError(f"{resp.status_code} {resp.reason} at {url} -> {detail}", response=resp)
 
     return resp.json()
+
+
+# ── async-клиент WATA (на loop aiogram) ───────────────────────────────────────
+class WataClient:
+    """
+    Асинхронный клиент WATA поверх aiohttp с долгоживущим keep-alive пулом.
+    Сессия создаётся лениво на том loop, где идёт первый вызов, и живёт до close().
+    Ошибки HTTP поднимаются как requests.HTTPError — тот же контракт, что у create_invoice.
+    """
+
+    def __init__(
+        self,
+        base_url: str = WATA_BASE_URL,
+        pool_size: int = WATA_POOL_SIZE,
+        connect_timeout: float = WATA_CONNECT_TIMEOUT,
+        read_timeout: float = WATA_READ_TIMEOUT,
+        retries: int = WATA_RETRIES,
+        backoff: float = WATA_BACKOFF,
+    ):
+        self._base_url = base_url
+        self._pool_size = pool_size
+        self._timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self._retries = retries
+        self._backoff = backoff
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self._pool_size,
+                keepalive_timeout=WATA_KEEPALIVE,
+                ttl_dns_cache=300,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self._timeout)
+        return self._session
+
+    async def _sleep_backoff(self, attempt: int) -> None:
+        # full jitter: равномерно в [0, backoff * 2^attempt]
+        await asyncio.sleep(random.uniform(0, self._backoff * (2 ** attempt)))
+
+    async def create_invoice(
+        self,
+        user_id: int,
+        amount: float,
+        plan: str,
+        success_url: Optional[str] = None,
+        fail_url: Optional[str] = None,
+        order_id: Optional[str] = None,
+    ) -> dict:
+        if _use_mock():
+            return _mock_invoice(user_id, amount, plan, order_id)
+
+        url = f"{self._base_url}/links"
+        payload = _invoice_payload(user_id, amount, plan, success_url, fail_url, order_id)
+
+        attempt = 0
+        while True:
+            try:
+                async with self._get_session().post(url, json=payload, headers=_auth_headers()) as resp:
+                    if resp.status in _POST_RETRY_STATUSES and attempt < self._retries:
+                        log.info("WATA %s at %s, retry %d", resp.status, url, attempt + 1)
+                    elif resp.status >= 400:
+                        try:
+                            detail = await resp.json(content_type=None)
+                        except Exception:
+                            detail = await resp.text()
+                        raise requests.HTTPError(f"{resp.status} {resp.reason} at {url} -> {detail}")
+                    else:
+                        return await resp.json(content_type=None)
+            except aiohttp.ClientConnectorError as e:  # соединение не установлено — запрос не ушёл
+                if attempt >= self._retries:
+                    raise
+                log.info("WATA connection error at %s: %s, retry %d", url, e, attempt + 1)
+
+            await self._sleep_backoff(attempt)
+            attempt += 1
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+wata_client = WataClient()
+
+
+async def create_invoice_async(**kwargs) -> dict:
+    """
+    Асинхронный create_invoice: тот же контракт, но без executor'а — прямо на loop.
+    """
+    with WATA_SECONDS.time("create_invoice_async"):
+        return await wata_client.create_invoice(**kwargs)
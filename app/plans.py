@@ -0,0 +1,31 @@
+# app/plans.py
+from datetime import timedelta
+from typing import Dict, NamedTuple, Optional, Tuple
+
+
+class Plan(NamedTuple):
+    code: str            # callback_data кнопки
+    name: str            # имя плана: описание счёта WATA, entitlements.plan, пул инвайтов
+    amount: float        # цена, ₽
+    duration: timedelta  # на сколько продлевается доступ
+    button: str          # подпись кнопки в меню планов
+
+
+# единственный источник правды о тарифах: меню, счёт, выдача доступа
+PLANS: Tuple[Plan, ...] = (
+    Plan("plan_week",   "Неделя", 100.0, timedelta(days=7),    "Неделя — 100₽"),
+    Plan("plan_month",  "Месяц",  300.0, timedelta(days=30),   "Месяц — 300₽"),
+    Plan("plan_chat",   "Чат",     50.0, timedelta(days=1),    "Чат 1 день — 50₽"),
+    Plan("plan_test1m", "Тест1м",   1.0, timedelta(minutes=1), "Тест 1 мин — 1₽"),
+)
+
+PLANS_BY_CODE: Dict[str, Plan] = {p.code: p for p in PLANS}
+PLANS_BY_NAME: Dict[str, Plan] = {p.name: p for p in PLANS}
+
+
+def plan_by_code(code: str) -> Optional[Plan]:
+    return PLANS_BY_CODE.get(code)
+
+
+def plan_by_name(name: Optional[str]) -> Optional[Plan]:
+    return PLANS_BY_NAME.get(name) if name else None
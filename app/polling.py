@@ -0,0 +1,127 @@
+# app/polling.py
+import asyncio
+import logging
+import os
+from datetime import datetime
+from typing import List, Optional
+
+from aiogram import Bot
+
+from app.db import run_db
+from app.ingress import UpdateQueue
+from app.metrics import POLLING_BATCH_SIZE
+from app.models import PollingOffset, SessionLocal
+
+log = logging.getLogger(__name__)
+
+POLLING_LIMIT       = int(os.getenv("POLLING_LIMIT", "100"))         # апдейтов на getUpdates (макс. Telegram — 100)
+POLLING_TIMEOUT     = int(os.getenv("POLLING_TIMEOUT", "25"))        # long poll, сек
+POLLING_BACKOFF_MAX = float(os.getenv("POLLING_BACKOFF_MAX", "30"))  # пауза после ошибок, сек
+POLLING_QUEUE_WAIT  = float(os.getenv("POLLING_QUEUE_WAIT", "0.05")) # очередь полна — ждём столько
+
+
+def _load_offset_sync(bot_id: int) -> Optional[int]:
+    session = SessionLocal()
+    try:
+        row = session.get(PollingOffset, bot_id)
+        return row.next_offset if row is not None else None
+    finally:
+        session.close()
+
+
+def _save_offset_sync(bot_id: int, next_offset: int) -> None:
+    session = SessionLocal()
+    try:
+        session.merge(PollingOffset(bot_id=bot_id, next_offset=next_offset, updated_at=datetime.utcnow()))
+        session.commit()
+    finally:
+        session.close()
+
+
+class UpdatePoller:
+    """
+    Получение апдейтов через getUpdates вместо webhook'а (UPDATES_MODE=polling).
+
+    Апдейты забираются пачками до limit и кладутся в ту же UpdateQueue, что и
+    при webhook'е: дальше — пул консьюмеров и dp.process_update с порядком
+    per-user. Пачка не больше свободного места в очереди, а offset сдвигается
+    только за принятые апдейты — непринятые Telegram отдаст ещё раз.
+    Следующий offset сохраняется в БД до того, как getUpdates подтвердит пачку.
+
+    Таймаут long poll адаптивный: после полной пачки (есть бэклог) — 0,
+    чтобы сразу забрать следующую; иначе — timeout (Telegram отвечает, как
+    только появится хоть один апдейт). Ошибки сети и 409 — экспоненциальная пауза.
+    Запускается только у лидера: два getUpdates на один токен конфликтуют.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        updates: UpdateQueue,
+        limit: int = POLLING_LIMIT,
+        timeout: int = POLLING_TIMEOUT,
+        allowed_updates: Optional[List[str]] = None,
+    ):
+        self._bot = bot
+        self._updates = updates
+        self._limit = max(1, min(100, limit))
+        self._timeout = timeout
+        self._allowed_updates = allowed_updates
+        self._stopped = False
+
+    def stop(self) -> None:
+        self._stopped = True
+
+    async def run(self) -> None:
+        bot_id = self._bot.id
+        offset = await run_db(_load_offset_sync, bot_id)
+        log.info("Polling started: limit=%d timeout=%ds offset=%s", self._limit, self._timeout, offset)
+
+        timeout = self._timeout
+        backoff = 0.0
+        webhook_deleted = False
+        while not self._stopped:
+            free = self._updates.free_slots()
+            if free == 0:
+                await asyncio.sleep(POLLING_QUEUE_WAIT)
+                continue
+            limit = min(self._limit, free)
+
+            try:
+                if not webhook_deleted:
+                    # webhook и getUpdates взаимоисключающие; ожидающие апдейты не сбрасываем
+                    await self._bot.delete_webhook(drop_pending_updates=False)
+                    webhook_deleted = True
+                # запас к long poll, чтобы HTTP-таймаут не срабатывал раньше Telegram
+                with self._bot.request_timeout(timeout + 10):
+                    batch = await self._bot.get_updates(
+                        offset=offset, limit=limit, timeout=timeout, allowed_updates=self._allowed_updates,
+                    )
+            except Exception as e:
+                # сеть, 409 (чужой getUpdates или webhook), 5xx Telegram
+                backoff = min(POLLING_BACKOFF_MAX, backoff * 2 or 1.0)
+                log.warning("getUpdates failed (%s), retry in %.0fs", e, backoff)
+                await asyncio.sleep(backoff)
+                continue
+            backoff = 0.0
+            POLLING_BATCH_SIZE.observe(len(batch))
+            if not batch:
+                timeout = self._timeout
+                continue
+
+            accepted = 0
+            for update in batch:
+                if not self._updates.offer(update):
+                    break  # очередь заполнилась — остаток придёт в следующем getUpdates
+                accepted += 1
+            if accepted:
+                offset = batch[accepted - 1].update_id + 1
+                try:
+                    await run_db(_save_offset_sync, bot_id, offset)
+                except Exception:
+                    # не критично: после рестарта пачка придёт повторно
+                    log.exception("Failed to persist polling offset %s", offset)
+            # полная пачка — вероятно, есть ещё: следующий запрос без ожидания
+            timeout = 0 if len(batch) >= limit else self._timeout
+
+        log.info("Polling stopped at offset=%s", offset)
@@ -0,0 +1,71 @@
+# app/profiler.py
+import hmac
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Optional, Tuple
+
+PROFILER_TOKEN       = os.getenv("PROFILER_TOKEN", "")  # пусто — эндпойнт выключен
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", "60"))
+PROFILER_DEFAULT_HZ  = float(os.getenv("PROFILER_HZ", "100"))
+
+_busy = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def authorized(token: Optional[str]) -> bool:
+    return bool(PROFILER_TOKEN) and hmac.compare_digest((token or "").encode(), PROFILER_TOKEN.encode())
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def sample_stacks(seconds: float, hz: float = PROFILER_DEFAULT_HZ, thread_name: Optional[str] = "aiogram-loop") -> str:
+    """
+    Сэмплирующий профайлер: hz раз в секунду снимает стек потока thread_name
+    (None — всех потоков, кроме своего) через sys._current_frames().
+    Процесс не замедляет и не требует перезапуска. Результат — collapsed
+    stacks ("поток;кадр;кадр N" по строке), вход для flamegraph.pl/speedscope.
+    Одновременно — один замер, иначе ProfilerBusy.
+    """
+    seconds = max(0.1, min(seconds, PROFILER_MAX_SECONDS))
+    interval = 1.0 / max(1.0, min(hz, 1000.0))
+    if not _busy.acquire(blocking=False):
+        raise ProfilerBusy()
+    try:
+        own = threading.get_ident()
+        names = {t.ident: t.name for t in threading.enumerate()}
+        targets = {ident for ident, name in names.items()
+                   if ident != own and (thread_name is None or name == thread_name)}
+
+        stacks: Counter = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident not in targets:
+                    continue
+                parts = []
+                while frame is not None:
+                    parts.append(_frame_name(frame))
+                    frame = frame.f_back
+                parts.append(names.get(ident, str(ident)))
+                stacks[";".join(reversed(parts))] += 1
+            time.sleep(interval)
+    finally:
+        _busy.release()
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def parse_params(args) -> Tuple[float, float, Optional[str]]:
+    """?seconds=N&hz=M&thread=имя|all → аргументы sample_stacks; ValueError на мусоре."""
+    seconds = float(args.get("seconds", "10"))
+    hz = float(args.get("hz", PROFILER_DEFAULT_HZ))
+    thread = args.get("thread", "aiogram-loop")
+    return seconds, hz, None if thread == "all" else thread
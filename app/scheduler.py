@@ -1,16 +1,20 @@
 # app/scheduler.py
 import logging
+import os
 from datetime import datetime, timedelta
-from typing import Callable, Optional, List, Tuple
+from typing import Callable, List, Optional, Tuple
 
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.executors.pool import ThreadPoolExecutor
-from sqlalchemy import func
 
-from app.models import SessionLocal, Subscription
+from app.expiry import ExpiryEngine
 
 log = logging.getLogger(__name__)
+
+EXPIRY_NEAR_REFILL = float(os.getenv("EXPIRY_NEAR_REFILL", "5"))  # узкий refill для выдач в других воркерах, сек
+
 _scheduler: Optional[BackgroundScheduler] = None
+_engine: Optional[ExpiryEngine] = None
 
 
 def _utcnow_naive() -> datetime:
@@ -18,103 +22,46 @@ def _utcnow_naive() -> datetime:
     return datetime.utcnow()
 
 
-def _fmt_rows(rows: List[Tuple[int, datetime]]) -> str:
-    return ", ".join(f"{uid}:{(exp.isoformat() if exp else 'None')}" for uid, exp in rows)
-
-
-def _remove_expired_subscriptions(on_expire: Callable[[int, str], None]) -> None:
-    now = _utcnow_naive()
-    log.info("[SCHED] Tick start | now=%s", now.isoformat())
-
-    session = SessionLocal()
-    try:
-        # max(expires_at) по каждому user_id
-        agg_rows: List[Tuple[int, datetime]] = (
-            session.query(
-                Subscription.user_id.label("uid"),
-                func.max(Subscription.expires_at).label("max_exp"),
-            )
-            .group_by(Subscription.user_id)
-            .all()
-        )
-
-        log.info("[SCHED] Max per user (uid:max_exp): %s", _fmt_rows(agg_rows))
-
-        expired_uids: List[int] = []
-        active_uids: List[int] = []
-
-        for uid, max_exp in agg_rows:
-            if max_exp is None:
-                log.warning("[SCHED] user_id=%s has NULL max_exp — skip", uid)
-                continue
-            # Используем строго "<" (а не "<="), чтобы граничные значения не
-            # пролетали между тиками из‑за микросекунд
-            if max_exp < now:
-                expired_uids.append(uid)
-            else:
-                active_uids.append(uid)
-
-        log.info(
-            "[SCHED] Summary: total=%d, active=%d, expired=%d",
-            len(agg_rows), len(active_uids), len(expired_uids)
-        )
-
-        if not expired_uids:
-            log.info("[SCHED] No expired users this tick")
-            return
-
-        # обрабатываем просроченных
-        for uid in expired_uids:
-            last_sub: Subscription = (
-                session.query(Subscription)
-                .filter(Subscription.user_id == uid)
-                .order_by(Subscription.expires_at.desc())
-                .first()
-            )
-
-            last_plan = last_sub.plan if last_sub else "-"
-            last_exp  = last_sub.expires_at if last_sub else None
-
-            log.info(
-                "[SCHED] Expiring user_id=%s | last_plan=%s | last_exp=%s | now=%s",
-                uid, last_plan, last_exp.isoformat() if last_exp else None, now.isoformat()
-            )
-
-            try:
-                on_expire(uid, last_plan)  # внутри — планирование корутины в общий loop
-                log.info("[SCHED] on_expire scheduled for user_id=%s", uid)
-            except Exception as e:
-                log.exception("[SCHED] on_expire call failed for user_id=%s: %s", uid, e)
-
-            deleted = (
-                session.query(Subscription)
-                .filter(
-                    Subscription.user_id == uid,
-                    Subscription.expires_at <= now
-                )
-                .delete(synchronize_session=False)
-            )
-            log.info("[SCHED] Deleted %d expired rows for user_id=%s", deleted, uid)
-
-        session.commit()
-        log.info("[SCHED] Tick committed successfully")
-
-    except Exception:
-        log.exception("[SCHED] remove_expired_subscriptions error — rolling back")
-        session.rollback()
-    finally:
-        session.close()
-        log.info("[SCHED] Tick end")
-
-
-def start_scheduler(on_expire: Callable[[int, str], None], interval_seconds: int = 60) -> BackgroundScheduler:
+def schedule_expiry(user_id: int, expires_at: datetime) -> None:
     """
-    Запускает APScheduler. on_expire(user_id, plan) — колбэк, который кикает пользователя.
+    Сообщает движку о новом дедлайне (naive UTC), чтобы кик случился точно в срок.
+    Вне лидера (и до запуска планировщика) — no-op: дедлайн подхватит refill
+    лидера, ближний — не позже чем через EXPIRY_NEAR_REFILL секунд.
     """
-    global _scheduler
+    if _engine is not None:
+        _engine.push(user_id, expires_at)
+
+
+def start_scheduler(
+    on_expire: Optional[Callable[[int, str], None]] = None,
+    interval_seconds: int = 60,
+    horizon_seconds: int = 600,
+    on_expire_batch: Optional[Callable[[List[Tuple[int, str]]], None]] = None,
+    chunk_size: int = 1000,
+    near_refill_seconds: float = EXPIRY_NEAR_REFILL,
+) -> BackgroundScheduler:
+    """
+    Запускает APScheduler. on_expire(user_id, plan) — колбэк, который кикает пользователя;
+    on_expire_batch([(user_id, plan), ...]) — то же для целой пачки (предпочтительнее).
+
+    Истечения обрабатывает ExpiryEngine: пробуждение ровно к ближайшему дедлайну,
+    а раз в interval_seconds — дешёвый refill дедлайнов на horizon_seconds вперёд.
+    Раз в near_refill_seconds — узкий refill на interval_seconds вперёд: дедлайны
+    выдач в других воркерах (schedule_expiry там no-op), которые наступят раньше
+    следующего полного refill. Кик опаздывает не больше чем на near_refill_seconds.
+    """
+    global _scheduler, _engine
     if _scheduler:
         return _scheduler
 
+    if on_expire_batch is None:
+        if on_expire is None:
+            raise ValueError("on_expire or on_expire_batch is required")
+
+        def on_expire_batch(items: List[Tuple[int, str]]) -> None:
+            for uid, plan in items:
+                on_expire(uid, plan)
+
     # Явные executors — надёжнее в gunicorn gthread
     executors = {
         "default": ThreadPoolExecutor(max_workers=2),
@@ -122,17 +69,32 @@ def start_scheduler(on_expire: Callable[[int, str], None], interval_seconds: int
     _scheduler = BackgroundScheduler(timezone="UTC", executors=executors)
     first_run = _utcnow_naive() + timedelta(seconds=5)  # первый тик через 5 секунд
 
+    _engine = ExpiryEngine(
+        _scheduler, on_expire_batch,
+        horizon_seconds=horizon_seconds,
+        chunk_size=chunk_size,
+    )
+
     _scheduler.add_job(
-        _remove_expired_subscriptions,
+        _engine.refill,
         trigger="interval",
         seconds=interval_seconds,
-        args=[on_expire],
         max_instances=1,
         coalesce=True,
         misfire_grace_time=30,
-        id="remove_expired_subscriptions",
+        id="expiry_refill",
         next_run_time=first_run,  # гарантированно дергаем первый раз
     )
+    _scheduler.add_job(
+        _engine.refill_near,
+        trigger="interval",
+        seconds=near_refill_seconds,
+        args=(interval_seconds + near_refill_seconds,),
+        max_instances=1,
+        coalesce=True,
+        misfire_grace_time=30,
+        id="expiry_refill_near",
+    )
     _scheduler.start()
 
     # Логируем, что реально видит планировщик
@@ -145,3 +107,40 @@ def start_scheduler(on_expire: Callable[[int, str], None], interval_seconds: int
         log.exception("Failed to list scheduler jobs")
 
     return _scheduler
+
+
+def add_interval_job(func: Callable[[], None], seconds: int, job_id: str, first_run_in: float = 0) -> None:
+    """
+    Дополнительная периодическая задача лидера (пул инвайтов и т.п.).
+    Вызывать после start_scheduler; остановится вместе с планировщиком.
+    """
+    if _scheduler is None:
+        raise RuntimeError("Scheduler is not running")
+    _scheduler.add_job(
+        func,
+        trigger="interval",
+        seconds=seconds,
+        max_instances=1,
+        coalesce=True,
+        misfire_grace_time=30,
+        id=job_id,
+        replace_existing=True,
+        next_run_time=_utcnow_naive() + timedelta(seconds=first_run_in),
+    )
+    log.info("Job %s added (interval=%ss)", job_id, seconds)
+
+
+def stop_scheduler() -> None:
+    """
+    Останавливает планировщик (например, когда воркер перестал быть лидером).
+    """
+    global _scheduler, _engine
+    if _scheduler is None:
+        return
+    try:
+        _scheduler.shutdown(wait=False)
+    except Exception:
+        log.exception("Failed to shutdown scheduler")
+    _scheduler = None
+    _engine = None
+    log.info("Scheduler stopped")
@@ -0,0 +1,128 @@
+# app/subs_cache.py
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional, Tuple
+
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+
+from app.models import SubsCacheInvalidation, engine
+
+log = logging.getLogger(__name__)
+
+SUBS_CACHE_TTL  = float(os.getenv("SUBS_CACHE_TTL", "300"))
+SUBS_CACHE_MAX  = int(os.getenv("SUBS_CACHE_MAX", "50000"))
+SUBS_CACHE_SYNC = float(os.getenv("SUBS_CACHE_SYNC", "2"))  # опрос инвалидаций других процессов, сек
+# перекрытие окон опроса: запись, закоммиченная позже своего created_at, не теряется
+_SYNC_OVERLAP = timedelta(seconds=10)
+_INVALIDATIONS_KEEP = timedelta(hours=1)
+
+# (plan, expires_at) по убыванию expires_at — ровно то, что показывает «Мои подписки»
+SubRows = Tuple[Tuple[str, datetime], ...]
+
+
+class SubscriptionCache:
+    """
+    Read-through кэш подписок пользователя (LRU + TTL).
+
+    Пишущие пути (_grant_subscription, удаление истёкших в планировщике)
+    вызывают invalidate() в своём процессе, а выдача ещё и пишет строку в
+    subs_cache_invalidations (record_invalidation): остальные процессы
+    подхватывают её в sync() — устаревание после покупки в другом воркере не
+    дольше SUBS_CACHE_SYNC секунд. TTL — последняя страховка.
+    Статус «активна/истекла» считается при показе, поэтому кэш не устаревает
+    от одного только течения времени.
+    """
+
+    def __init__(self, ttl: float = SUBS_CACHE_TTL, max_size: int = SUBS_CACHE_MAX):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._data: "OrderedDict[int, Tuple[float, SubRows]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # растёт на каждой инвалидации: загрузка, начатая до неё, не попадёт в кэш
+        self._generation = 0
+        self._synced_at: Optional[datetime] = None
+        self._sync_thread: Optional[threading.Thread] = None
+
+    def generation(self) -> int:
+        return self._generation
+
+    def get(self, user_id: int) -> Optional[SubRows]:
+        with self._lock:
+            item = self._data.get(user_id)
+            if item is None:
+                return None
+            ts, rows = item
+            if time.monotonic() - ts > self._ttl:
+                del self._data[user_id]
+                return None
+            self._data.move_to_end(user_id)
+            return rows
+
+    def put(self, user_id: int, rows: List[Tuple[str, datetime]], generation: int) -> None:
+        with self._lock:
+            if generation != self._generation:
+                return  # пока читали БД, данные инвалидировали
+            self._data[user_id] = (time.monotonic(), tuple(rows))
+            self._data.move_to_end(user_id)
+            while len(self._data) > self._max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, user_id: int) -> None:
+        self.invalidate_many((user_id,))
+
+    def invalidate_many(self, user_ids: Iterable[int]) -> None:
+        with self._lock:
+            self._generation += 1
+            for uid in user_ids:
+                self._data.pop(uid, None)
+
+    # ── инвалидации из других процессов ───────────────────────────────────────
+    def sync(self) -> None:
+        """
+        Сбрасывает пользователей, инвалидированных с прошлого опроса (в любом
+        процессе). Только чтение; окна опросов перекрываются на _SYNC_OVERLAP.
+        """
+        now = datetime.utcnow()
+        since = self._synced_at - _SYNC_OVERLAP if self._synced_at is not None else now - _SYNC_OVERLAP
+        with engine.connect() as conn:
+            user_ids = conn.execute(
+                select(SubsCacheInvalidation.user_id).where(SubsCacheInvalidation.created_at >= since)
+            ).scalars().all()
+        self._synced_at = now
+        if user_ids:
+            self.invalidate_many(user_ids)
+
+    def start_sync(self, interval: float = SUBS_CACHE_SYNC) -> None:
+        if self._sync_thread is not None:
+            return
+
+        def _run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.sync()
+                except Exception as e:
+                    log.warning("subs cache sync failed: %s", e)
+
+        self._sync_thread = threading.Thread(target=_run, name="subs-cache-sync", daemon=True)
+        self._sync_thread.start()
+
+
+def record_invalidation(session: Session, user_id: int) -> None:
+    """Инвалидация для всех процессов — в транзакции пишущего пути."""
+    session.add(SubsCacheInvalidation(user_id=user_id, created_at=datetime.utcnow()))
+
+
+def prune_invalidations() -> None:
+    # задача лидера: строки старше часа уже прочитаны всеми живыми процессами
+    with engine.begin() as conn:
+        conn.execute(delete(SubsCacheInvalidation)
+                     .where(SubsCacheInvalidation.created_at < datetime.utcnow() - _INVALIDATIONS_KEEP))
+
+
+subscriptions_cache = SubscriptionCache()
@@ -0,0 +1,158 @@
+# app/timing.py
+import logging
+import os
+import time
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Generator, Optional, TypeVar
+
+from aiogram import types
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from app.metrics import HANDLER_BOT_API_SECONDS, HANDLER_CPU_SECONDS, HANDLER_SECONDS
+
+log = logging.getLogger(__name__)
+
+HANDLER_SLOW_MS = float(os.getenv("HANDLER_SLOW_MS", "500"))  # медленнее — WARNING в лог
+
+T = TypeVar("T")
+
+
+# ── CPU задачи на общем loop ──────────────────────────────────────────────────
+class CpuMeter:
+    """
+    CPU-время одной корутины: thread_time() суммируется только по её шагам,
+    поэтому соседние задачи loop'а в счёт не попадают.
+    """
+
+    __slots__ = ("total", "_slice_started")
+
+    def __init__(self):
+        self.total = 0.0
+        self._slice_started: Optional[float] = None
+
+    def now(self) -> float:
+        # внутри шага: накопленное + текущий, ещё не закрытый шаг
+        if self._slice_started is None:
+            return self.total
+        return self.total + time.thread_time() - self._slice_started
+
+
+_cpu_meter: ContextVar[Optional[CpuMeter]] = ContextVar("cpu_meter", default=None)
+
+
+class _Metered:
+    def __init__(self, coro: Awaitable[T], meter: CpuMeter):
+        self._coro = coro.__await__()
+        self._meter = meter
+
+    def __await__(self) -> Generator[Any, Any, T]:
+        meter, coro = self._meter, self._coro
+        value, error = None, None
+        while True:
+            meter._slice_started = time.thread_time()
+            try:
+                yielded = coro.throw(error) if error is not None else coro.send(value)
+            except StopIteration as e:
+                return e.value
+            finally:
+                meter.total += time.thread_time() - meter._slice_started
+                meter._slice_started = None
+            value, error = None, None
+            try:
+                value = yield yielded
+            except BaseException as e:  # отмена и прочее — пробрасываем внутрь корутины
+                error = e
+
+
+async def run_metered(coro: Awaitable[T]) -> T:
+    """
+    Выполняет coro, считая её CPU в CpuMeter (доступен через _cpu_meter
+    всем, кто выполняется внутри — в т.ч. middleware).
+    """
+    meter = CpuMeter()
+    token = _cpu_meter.set(meter)
+    try:
+        return await _Metered(coro, meter)
+    finally:
+        _cpu_meter.reset(token)
+
+
+# ── Bot API внутри хендлера ───────────────────────────────────────────────────
+class _HandlerStats:
+    __slots__ = ("name", "started", "cpu_started", "api_seconds", "api_by_method")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        meter = _cpu_meter.get()
+        self.cpu_started = meter.now() if meter is not None else None
+        self.api_seconds = 0.0
+        self.api_by_method: Dict[str, float] = {}
+
+
+_current_stats: ContextVar[Optional[_HandlerStats]] = ContextVar("handler_stats", default=None)
+
+
+def record_bot_api_call(method: str, seconds: float) -> None:
+    """Вызывается RateLimitedBot на каждый запрос: время засчитывается текущему хендлеру."""
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.api_seconds += seconds
+        stats.api_by_method[method] = stats.api_by_method.get(method, 0.0) + seconds
+
+
+# ── middleware ────────────────────────────────────────────────────────────────
+class HandlerTimingMiddleware(BaseMiddleware):
+    """
+    Время каждого хендлера сообщений и нажатий: wall, CPU (только этой задачи,
+    если апдейт выполняется через run_metered) и Bot API по методам.
+    Медленнее HANDLER_SLOW_MS — WARNING с разбивкой.
+
+    name_of(handler, event) даёт имя для метрик: для роутера кнопок это
+    конечный обработчик, а не сам роутер.
+    """
+
+    def __init__(self, name_of: Callable[[Callable, Any], str], slow_ms: float = HANDLER_SLOW_MS):
+        super().__init__()
+        self._name_of = name_of
+        self._slow = slow_ms / 1000
+
+    def _start(self, event, data: dict) -> None:
+        stats = _HandlerStats(self._name_of(current_handler.get(), event))
+        data["_timing"] = (stats, _current_stats.set(stats))
+
+    def _finish(self, event, data: dict) -> None:
+        item = data.pop("_timing", None)
+        if item is None:
+            return  # ни один хендлер не подошёл
+        stats, token = item
+        _current_stats.reset(token)
+
+        wall = time.perf_counter() - stats.started
+        meter = _cpu_meter.get()
+        cpu = meter.now() - stats.cpu_started if meter is not None and stats.cpu_started is not None else None
+
+        HANDLER_SECONDS.observe(wall, stats.name)
+        if cpu is not None:
+            HANDLER_CPU_SECONDS.observe(cpu, stats.name)
+        for method, seconds in stats.api_by_method.items():
+            HANDLER_BOT_API_SECONDS.observe(seconds, stats.name, method)
+
+        if wall >= self._slow:
+            api = ", ".join(f"{m}={s * 1000:.0f}" for m, s in sorted(stats.api_by_method.items()))
+            log.warning("Slow handler %s: wall=%.0fms cpu=%sms bot_api=%.0fms (%s) user=%s",
+                        stats.name, wall * 1000, f"{cpu * 1000:.0f}" if cpu is not None else "?",
+                        stats.api_seconds * 1000, api or "-", getattr(event.from_user, "id", None))
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        self._start(message, data)
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        self._finish(message, data)
+
+    async def on_process_callback_query(self, callback: types.CallbackQuery, data: dict):
+        self._start(callback, data)
+
+    async def on_post_process_callback_query(self, callback: types.CallbackQuery, results, data: dict):
+        self._finish(callback, data)
@@ -0,0 +1,131 @@
+# bench/broadcast.py
+"""
+Рассылка на N активных подписчиков через BroadcastEngine против заглушки Bot API.
+
+Меряет темп относительно потолка TG_GLOBAL_RATE, прирост RSS (получатели
+не должны грузиться в память целиком) и возобновление после прерывания:
+с --interrupt-after рассылка отменяется посреди работы и запускается заново
+с чекпойнта — считаются повторные доставки (не больше страницы).
+
+    python bench/broadcast.py --users 100000 --tg-global-rate 500
+    python bench/broadcast.py --users 20000 --tg-global-rate 500 --interrupt-after 10 --tg-403 0.02
+"""
+import argparse
+import asyncio
+import os
+import resource
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def _rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=100000)
+    ap.add_argument("--expired", type=float, default=0.1, help="доля неактивных (истёкших) подписок")
+    ap.add_argument("--tg-global-rate", type=float, default=500, help="потолок бота, сообщений/сек")
+    ap.add_argument("--tg-latency-ms", type=float, default=30)
+    ap.add_argument("--tg-403", type=float, default=0.0, help="доля пользователей, заблокировавших бота")
+    ap.add_argument("--page", type=int, default=None, help="BROADCAST_PAGE")
+    ap.add_argument("--concurrency", type=int, default=None, help="BROADCAST_CONCURRENCY")
+    ap.add_argument("--interrupt-after", type=float, default=None, help="прервать через N сек и продолжить")
+    ap.add_argument("--bot-port", type=int, default=18191)
+    args = ap.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_broadcast_")
+    os.environ["DATABASE_URL"] = f"sqlite:///{workdir}/broadcast.db"
+    os.environ["TG_GLOBAL_RATE"] = str(args.tg_global_rate)
+    if args.page:
+        os.environ["BROADCAST_PAGE"] = str(args.page)
+    if args.concurrency:
+        os.environ["BROADCAST_CONCURRENCY"] = str(args.concurrency)
+
+    # импорт после env: модули читают настройки при импорте
+    from aiogram.bot.api import TelegramAPIServer
+    from sqlalchemy import insert
+
+    from app.broadcast import BroadcastEngine, create_broadcast, get_broadcast
+    from app.models import BroadcastFailure, Entitlement, SessionLocal, engine, init_db
+    from app.outbound import RateLimitedBot
+    from stubs import BotApiStub, start_site
+
+    init_db()
+    now = datetime.utcnow()
+    active = 0
+    for start in range(0, args.users, 10000):
+        rows = []
+        for i in range(start, min(start + 10000, args.users)):
+            expired = (i % 100) < args.expired * 100
+            active += not expired
+            rows.append({
+                "user_id": 10_000_000 + i,
+                "plan": "Месяц",
+                "expires_at": now + (timedelta(days=-1) if expired else timedelta(days=30)),
+                "updated_at": now,
+            })
+        with engine.begin() as conn:
+            conn.execute(insert(Entitlement), rows)
+
+    delivered: Counter = Counter()
+    stub = BotApiStub(
+        latency=args.tg_latency_ms / 1000,
+        rate_403=args.tg_403,
+        on_message=lambda chat_id, method, ts: delivered.update((chat_id,)),
+    )
+
+    async def run() -> float:
+        runner = await start_site(stub.app(), "127.0.0.1", args.bot_port)
+        bot = RateLimitedBot(
+            token="123456:bench",
+            server=TelegramAPIServer.from_base(f"http://127.0.0.1:{args.bot_port}"),
+        )
+        loop = asyncio.get_running_loop()
+        broadcasts = BroadcastEngine(bot, lambda coro: asyncio.run_coroutine_threadsafe(coro, loop))
+        broadcast_id = create_broadcast("<b>Новый эпизод</b> уже в канале!")
+        try:
+            started = time.perf_counter()
+            if args.interrupt_after:
+                task = asyncio.ensure_future(broadcasts.run(broadcast_id))
+                await asyncio.sleep(args.interrupt_after)
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                row = get_broadcast(broadcast_id)
+                print(f"interrupted: status={row.status} cursor={row.cursor_user_id} sent={row.sent}")
+            await broadcasts.run(broadcast_id)
+            return time.perf_counter() - started
+        finally:
+            await (await bot.get_session()).close()
+            await runner.cleanup()
+
+    rss_before = _rss_mb()
+    elapsed = asyncio.run(run())
+
+    row = get_broadcast()
+    session = SessionLocal()
+    try:
+        failure_rows = session.query(BroadcastFailure).count()
+    finally:
+        session.close()
+    attempts = sum(delivered.values()) + stub.blocked
+    duplicates = sum(n - 1 for n in delivered.values() if n > 1)
+    ceiling = active / args.tg_global_rate
+
+    print(f"recipients (active): {active} of {args.users}")
+    print(f"status={row.status} sent={row.sent} failed={row.failed} failure_rows={failure_rows}")
+    print(f"elapsed: {elapsed:.1f}s  ceiling: {ceiling:.1f}s  "
+          f"rate: {attempts / elapsed:.0f} msg/s of {args.tg_global_rate:.0f} ({ceiling / elapsed * 100:.0f}%)")
+    print(f"duplicates after resume: {duplicates}")
+    print(f"peak RSS: {_rss_mb():.0f} MB (before run {rss_before:.0f} MB)")
+
+
+if __name__ == "__main__":
+    main()
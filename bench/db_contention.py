@@ -0,0 +1,127 @@
+# bench/db_contention.py
+"""
+Конкуренция за SQLite из потоков, как в воркере gunicorn: писатели (payment
+inbox: INSERT + DELETE, продление entitlements) и читатели (страницы
+entitlements, как у рассылки и refill истечений) одновременно.
+
+Сравнивает DB_ENGINE_PROFILE=off (rollback journal, пул по умолчанию) и
+auto (WAL, synchronous=NORMAL, busy_timeout, mmap, пул по числу потоков):
+записей/сек, задержка записи p50/p99/max, чтений/сек, ошибки "database is locked".
+
+    python bench/db_contention.py --writers 8 --readers 4 --duration 10
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_CHILD = r"""
+import json, random, sys, threading, time
+from datetime import datetime, timedelta
+sys.path.insert(0, {root!r})
+from sqlalchemy import delete, insert, update
+from sqlalchemy.exc import OperationalError
+from app.models import Entitlement, PaymentInboxEvent, SessionLocal, engine, init_db
+
+init_db()
+now = datetime.utcnow()
+with engine.begin() as conn:
+    conn.execute(insert(Entitlement), [
+        {{"user_id": i, "plan": "Месяц", "expires_at": now + timedelta(days=30), "updated_at": now}}
+        for i in range({users})
+    ])
+
+stop = time.monotonic() + {duration}
+lock = threading.Lock()
+write_lat, reads, locked = [], [0], [0]
+
+def writer():
+    while time.monotonic() < stop:
+        t = time.perf_counter()
+        session = SessionLocal()
+        try:
+            row = PaymentInboxEvent(payload="{{}}", received_at=datetime.utcnow(), attempts=0,
+                                    next_attempt_at=datetime.utcnow())
+            session.add(row)
+            session.commit()
+            session.execute(delete(PaymentInboxEvent).where(PaymentInboxEvent.id == row.id))
+            session.execute(update(Entitlement).where(Entitlement.user_id == random.randrange({users}))
+                            .values(updated_at=datetime.utcnow()))
+            session.commit()
+        except OperationalError:
+            session.rollback()
+            with lock:
+                locked[0] += 1
+            continue
+        finally:
+            session.close()
+        with lock:
+            write_lat.append(time.perf_counter() - t)
+
+def reader():
+    after = -1
+    while time.monotonic() < stop:
+        session = SessionLocal()
+        try:
+            rows = (session.query(Entitlement.user_id)
+                    .filter(Entitlement.user_id > after, Entitlement.expires_at > datetime.utcnow())
+                    .order_by(Entitlement.user_id).limit(500).all())
+            after = rows[-1][0] if rows else -1
+        except OperationalError:
+            with lock:
+                locked[0] += 1
+            continue
+        finally:
+            session.close()
+        with lock:
+            reads[0] += 1
+
+threads = [threading.Thread(target=writer) for _ in range({writers})]
+threads += [threading.Thread(target=reader) for _ in range({readers})]
+for t in threads:
+    t.start()
+for t in threads:
+    t.join()
+
+write_lat.sort()
+pick = lambda q: write_lat[min(len(write_lat) - 1, int(q * len(write_lat)))] * 1000 if write_lat else 0.0
+print(json.dumps({{
+    "journal": engine.connect().exec_driver_sql("PRAGMA journal_mode").scalar(),
+    "writes": len(write_lat) / {duration}, "p50": pick(0.5), "p99": pick(0.99),
+    "max": write_lat[-1] * 1000 if write_lat else 0.0, "reads": reads[0] / {duration}, "locked": locked[0],
+}}))
+"""
+
+
+def _run(profile: str, args: argparse.Namespace) -> dict:
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ, DB_ENGINE_PROFILE=profile, DATABASE_URL=f"sqlite:///{workdir}/contention.db")
+        code = _CHILD.format(root=ROOT, users=args.users, duration=args.duration,
+                             writers=args.writers, readers=args.readers)
+        out = subprocess.run([sys.executable, "-c", code], env=env, cwd=workdir,
+                             capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--writers", type=int, default=8, help="потоки-писатели (как потоки gunicorn)")
+    ap.add_argument("--readers", type=int, default=4, help="потоки-читатели страниц entitlements")
+    ap.add_argument("--users", type=int, default=50000)
+    ap.add_argument("--duration", type=float, default=10)
+    args = ap.parse_args()
+
+    print(f"writers={args.writers} readers={args.readers} users={args.users} duration={args.duration:.0f}s")
+    print("profile  journal   writes/s   p50 ms   p99 ms    max ms   reads/s   locked")
+    for profile in ("off", "auto"):
+        r = _run(profile, args)
+        print(f"{profile:7}  {r['journal']:7}  {r['writes']:9.0f}  {r['p50']:7.1f}  {r['p99']:7.1f}  "
+              f"{r['max']:8.1f}  {r['reads']:8.0f}  {r['locked']:7d}")
+
+
+if __name__ == "__main__":
+    main()
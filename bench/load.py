@@ -0,0 +1,308 @@
+# bench/load.py
+"""
+Нагрузочный прогон entry:app полностью офлайн: Bot API и WATA заменены
+заглушками из bench/stubs.py, бот запускается отдельным процессом
+(gunicorn gthread или SERVER_MODE=aiohttp) с временной SQLite-базой.
+
+Сценарии (open-loop, заданный темп --rate запросов/с в течение --duration с):
+  start     — /start от новых пользователей;
+  callback  — нажатия кнопок: buy / my_subs / help / plan_week (счёт в WATA);
+  payment   — подписанные webhook'и WATA об оплате (выдача доступа).
+
+Для каждого сценария печатаются пропускная способность, задержка HTTP-ответа
+и end-to-end задержка (от запроса до исходящего sendMessage на заглушке)
+в перцентилях p50/p95/p99. Код возврата 1, если p99 end-to-end любого
+сценария больше --max-p99-ms (если задан).
+
+    python bench/load.py --rate 50 --duration 10
+    python bench/load.py --mode aiohttp --tg-429 0.02 --max-p99-ms 2000
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import aiohttp
+
+from stubs import BotApiStub, WataStub, start_site
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("start", "callback", "payment")
+CALLBACKS = ("buy", "my_subs", "help", "plan_week")
+
+
+def _user(uid: int) -> dict:
+    return {"id": uid, "is_bot": False, "first_name": "bench"}
+
+
+def _start_update(update_id: int, uid: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": uid, "type": "private"},
+            "from": _user(uid),
+            "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+        },
+    }
+
+
+def _callback_update(update_id: int, uid: int, data: str) -> dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": _user(uid),
+            "chat_instance": str(uid),
+            "data": data,
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": uid, "type": "private"},
+                "from": {"id": 123456, "is_bot": True, "first_name": "FootBot"},
+                "text": "menu",
+            },
+        },
+    }
+
+
+def _percentile(values: List[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+class _Delivery:
+    """
+    Сопоставляет исходящие сообщения на заглушке Bot API с запросами драйвера:
+    у каждого запроса свой chat_id, первый sendMessage в него — момент завершения.
+    """
+
+    def __init__(self):
+        self._waiting: Dict[int, asyncio.Future] = {}
+
+    def expect(self, chat_id: int) -> asyncio.Future:
+        fut = asyncio.get_running_loop().create_future()
+        self._waiting[chat_id] = fut
+        return fut
+
+    def on_message(self, chat_id: int, method: str, ts: float) -> None:
+        fut = self._waiting.pop(chat_id, None)
+        if fut is not None and not fut.done():
+            fut.set_result(ts)
+
+
+def _start_server(args, workdir: str, bot_url: str, wata_url: str) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        TOKEN="123456:bench",
+        CHANNEL_ID="-100",
+        BASE_URL="",
+        TELEGRAM_API_URL=bot_url,
+        WATA_BASE_URL=wata_url,
+        WATA_TOKEN="bench",
+        PAYMENTS_MODE="real",
+        DATABASE_URL=f"sqlite:///{workdir}/bench_load.db",
+        METRICS_DIR=f"{workdir}/metrics",
+        PORT=str(args.port),
+        SERVER_MODE=args.mode,
+    )
+    if args.tg_global_rate:
+        env["TG_GLOBAL_RATE"] = str(args.tg_global_rate)
+    if args.mode == "aiohttp":
+        cmd = [sys.executable, "entry.py"]
+    else:
+        cmd = [
+            sys.executable, "-m", "gunicorn", "-w", "1", "-k", "gthread", "--threads", "8",
+            "--bind", f"127.0.0.1:{args.port}", "--log-level", "warning", "--access-logfile", "/dev/null",
+            "entry:app",
+        ]
+    out = None if args.verbose else subprocess.DEVNULL
+    return subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=out, stderr=out)
+
+
+async def _wait_ready(s: aiohttp.ClientSession, url: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with s.get(url + "/health") as r:
+                if r.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"server at {url} did not start")
+
+
+async def _run_scenario(
+    name: str,
+    s: aiohttp.ClientSession,
+    url: str,
+    wata: WataStub,
+    delivery: _Delivery,
+    rate: float,
+    duration: float,
+    timeout: float,
+    ids: "itertools.count",
+) -> dict:
+    http_ms: List[float] = []
+    e2e_ms: List[float] = []
+    errors = 0
+    timeouts = 0
+
+    async def one(n: int) -> None:
+        nonlocal errors, timeouts
+        uid = next(ids)
+        if name == "start":
+            req = dict(path="/telegram_webhook", json=_start_update(uid, uid))
+        elif name == "callback":
+            req = dict(path="/telegram_webhook", json=_callback_update(uid, uid, CALLBACKS[n % len(CALLBACKS)]))
+        else:
+            body, sig = wata.webhook(order_id=f"tg-{uid}-{n}", plan="Неделя", user_id=uid)
+            req = dict(path="/payment_webhook", data=body,
+                       headers={"X-Signature": sig, "Content-Type": "application/json"})
+
+        delivered = delivery.expect(uid)
+        path = req.pop("path")
+        started = time.perf_counter()
+        try:
+            async with s.post(url + path, **req) as r:
+                await r.read()
+                status = r.status
+        except aiohttp.ClientError:
+            status = 0
+        http_ms.append((time.perf_counter() - started) * 1000)
+        if status != 200:
+            errors += 1
+            delivered.cancel()
+            return
+        try:
+            ts = await asyncio.wait_for(delivered, timeout)
+            e2e_ms.append((ts - started) * 1000)
+        except asyncio.TimeoutError:
+            timeouts += 1
+
+    total = int(rate * duration)
+    tasks = []
+    started = time.perf_counter()
+    for n in range(total):
+        # open-loop: темп не зависит от того, как быстро отвечает бот
+        delay = started + n / rate - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(one(n)))
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    return {
+        "scenario": name,
+        "sent": total,
+        "done": len(e2e_ms),
+        "errors": errors,
+        "timeouts": timeouts,
+        "throughput": len(e2e_ms) / elapsed,
+        "http_p50": _percentile(http_ms, 50),
+        "http_p95": _percentile(http_ms, 95),
+        "http_p99": _percentile(http_ms, 99),
+        "e2e_p50": _percentile(e2e_ms, 50),
+        "e2e_p95": _percentile(e2e_ms, 95),
+        "e2e_p99": _percentile(e2e_ms, 99),
+    }
+
+
+def _print_report(results: List[dict], bot_api: BotApiStub, wata: WataStub) -> None:
+    print(f"{'scenario':9s} {'sent':>6s} {'done':>6s} {'err':>4s} {'t/o':>4s} {'ops/s':>8s}"
+          f" {'http p50':>9s} {'p95':>7s} {'p99':>7s} {'e2e p50':>9s} {'p95':>7s} {'p99':>7s}  (ms)")
+    for r in results:
+        print(f"{r['scenario']:9s} {r['sent']:6d} {r['done']:6d} {r['errors']:4d} {r['timeouts']:4d}"
+              f" {r['throughput']:8.1f} {r['http_p50']:9.1f} {r['http_p95']:7.1f} {r['http_p99']:7.1f}"
+              f" {r['e2e_p50']:9.1f} {r['e2e_p95']:7.1f} {r['e2e_p99']:7.1f}")
+    print(f"bot api calls: {dict(bot_api.calls)}  429 served: {bot_api.throttled}")
+    print(f"wata links: {wata.links}  errors served: {wata.errors}")
+
+
+async def _main(args) -> int:
+    delivery = _Delivery()
+    bot_api = BotApiStub(
+        latency=args.tg_latency_ms / 1000,
+        jitter=args.tg_latency_ms / 3000,
+        rate_429=args.tg_429,
+        retry_after=args.retry_after,
+        on_message=delivery.on_message,
+    )
+    wata = WataStub(latency=args.wata_latency_ms / 1000, jitter=args.wata_latency_ms / 3000)
+    runners = [
+        await start_site(bot_api.app(), "127.0.0.1", args.bot_port),
+        await start_site(wata.app(), "127.0.0.1", args.wata_port),
+    ]
+    url = f"http://127.0.0.1:{args.port}"
+    results: List[dict] = []
+
+    with tempfile.TemporaryDirectory() as workdir:
+        proc = _start_server(
+            args, workdir, f"http://127.0.0.1:{args.bot_port}", f"http://127.0.0.1:{args.wata_port}",
+        )
+        try:
+            connector = aiohttp.TCPConnector(limit=args.connections)
+            async with aiohttp.ClientSession(connector=connector) as s:
+                await _wait_ready(s, url)
+                ids = itertools.count(10_000_000)
+                for name in args.scenarios.split(","):
+                    # короткий прогрев: импорт хендлеров, соединения к заглушкам, ключ WATA
+                    await _run_scenario(name, s, url, wata, delivery, args.rate, 1.0, args.timeout, ids)
+                    results.append(await _run_scenario(
+                        name, s, url, wata, delivery, args.rate, args.duration, args.timeout, ids,
+                    ))
+        finally:
+            proc.terminate()
+            proc.wait(timeout=10)
+            for r in runners:
+                await r.cleanup()
+
+    _print_report(results, bot_api, wata)
+    if args.json:
+        print(json.dumps(results))
+
+    if args.max_p99_ms is not None:
+        slow = [r["scenario"] for r in results if not r["e2e_p99"] <= args.max_p99_ms]
+        if slow:
+            print(f"FAIL: e2e p99 above {args.max_p99_ms} ms in: {', '.join(slow)}")
+            return 1
+    return 0
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--mode", choices=("flask", "aiohttp"), default="flask")
+    ap.add_argument("--scenarios", default=",".join(SCENARIOS))
+    ap.add_argument("--rate", type=float, default=20.0, help="запросов в секунду на сценарий")
+    ap.add_argument("--duration", type=float, default=10.0, help="секунд на сценарий")
+    ap.add_argument("--timeout", type=float, default=30.0, help="сколько ждать исходящего сообщения")
+    ap.add_argument("--connections", type=int, default=64)
+    ap.add_argument("--port", type=int, default=18090)
+    ap.add_argument("--bot-port", type=int, default=18091)
+    ap.add_argument("--wata-port", type=int, default=18092)
+    ap.add_argument("--tg-latency-ms", type=float, default=30)
+    ap.add_argument("--tg-429", type=float, default=0.0, help="доля ответов 429 от Bot API")
+    ap.add_argument("--retry-after", type=int, default=1)
+    ap.add_argument("--tg-global-rate", type=float, default=None,
+                    help="переопределить TG_GLOBAL_RATE бота (по умолчанию — как в проде)")
+    ap.add_argument("--wata-latency-ms", type=float, default=50)
+    ap.add_argument("--max-p99-ms", type=float, default=None)
+    ap.add_argument("--json", action="store_true", help="дополнительно вывести результаты в JSON")
+    ap.add_argument("--verbose", action="store_true", help="показывать логи бота")
+    args = ap.parse_args()
+    sys.exit(asyncio.run(_main(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# bench/loop_stall.py
+"""
+Регрессионная проверка: медленный запрос к БД не должен останавливать event loop.
+
+Пока идёт медленный SQL (рекурсивный CTE в SQLite), на loop тикает «пульс»
+каждые 5 мс; максимальная задержка тика — это время остановки loop.
+Сравниваются прямой синхронный вызов (как было в хендлерах) и app.db.run_db.
+Код возврата 1, если через run_db остановка больше --max-stall-ms.
+
+    python bench/loop_stall.py
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.gettempdir()}/bench_loop_stall.db")
+
+from sqlalchemy import text  # noqa: E402
+
+from app.db import run_db  # noqa: E402
+from app.models import SessionLocal  # noqa: E402
+
+
+def _slow_query(n: int) -> int:
+    session = SessionLocal()
+    try:
+        return session.execute(
+            text("WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < :n) "
+                 "SELECT count(*) FROM c"),
+            {"n": n},
+        ).scalar_one()
+    finally:
+        session.close()
+
+
+async def _measure(call, n: int) -> float:
+    stall = 0.0
+    done = asyncio.Event()
+
+    async def heartbeat():
+        nonlocal stall
+        interval = 0.005
+        while not done.is_set():
+            t = time.perf_counter()
+            await asyncio.sleep(interval)
+            stall = max(stall, time.perf_counter() - t - interval)
+
+    hb = asyncio.ensure_future(heartbeat())
+    await asyncio.sleep(0.05)
+    await call(n)
+    done.set()
+    await hb
+    return stall * 1000
+
+
+async def _blocking(n: int) -> None:
+    _slow_query(n)
+
+
+async def _offloaded(n: int) -> None:
+    await run_db(_slow_query, n)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rows", type=int, default=2_000_000)
+    ap.add_argument("--max-stall-ms", type=float, default=50.0)
+    args = ap.parse_args()
+
+    blocking = asyncio.run(_measure(_blocking, args.rows))
+    offloaded = asyncio.run(_measure(_offloaded, args.rows))
+    print(f"sync in handler: max loop stall {blocking:8.1f} ms")
+    print(f"run_db:          max loop stall {offloaded:8.1f} ms")
+    if offloaded > args.max_stall_ms:
+        print(f"FAIL: run_db stalled the loop for more than {args.max_stall_ms} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
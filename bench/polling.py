@@ -0,0 +1,134 @@
+# bench/polling.py
+"""
+Polling-режим (UPDATES_MODE=polling) против заглушки Bot API: сколько
+апдейтов в секунду проходит getUpdates -> UpdateQueue -> dp.process_update
+при разных размерах пачки (POLLING_LIMIT).
+
+Заглушке заранее отдаётся бэклог из N апдейтов от U пользователей; меряется
+время до обработки последнего, проверяется порядок сообщений каждого
+пользователя и то, что сохранённый offset дошёл до конца.
+
+    python bench/polling.py --updates 5000 --batch-sizes 1,10,50,100 --tg-latency-ms 30
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def _update(update_id: int, user_id: int, seq: int) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": "bench"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": user,
+            "text": str(seq),
+        },
+    }
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--updates", type=int, default=5000)
+    ap.add_argument("--users", type=int, default=200)
+    ap.add_argument("--batch-sizes", default="1,10,50,100")
+    ap.add_argument("--tg-latency-ms", type=float, default=30, help="RTT getUpdates")
+    ap.add_argument("--handler-ms", type=float, default=5, help="время обработки апдейта")
+    ap.add_argument("--bot-port", type=int, default=18291)
+    args = ap.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_polling_")
+    os.environ["DATABASE_URL"] = f"sqlite:///{workdir}/polling.db"
+
+    # импорт после env: модули читают настройки при импорте
+    from aiogram import Bot, Dispatcher, types
+    from aiogram.bot.api import TelegramAPIServer
+
+    from app.ingress import UpdateQueue
+    from app.models import init_db
+    from app.outbound import RateLimitedBot
+    from app.polling import UpdatePoller, _load_offset_sync
+    from stubs import BotApiStub, start_site
+
+    init_db()
+
+    async def run(batch_size: int, first_update_id: int) -> dict:
+        stub = BotApiStub(latency=args.tg_latency_ms / 1000, jitter=0)
+        runner = await start_site(stub.app(), "127.0.0.1", args.bot_port)
+        bot = RateLimitedBot(
+            token="123456:bench",
+            server=TelegramAPIServer.from_base(f"http://127.0.0.1:{args.bot_port}"),
+        )
+        dp = Dispatcher(bot)
+
+        seen = defaultdict(list)
+        done = asyncio.Event()
+        processed = 0
+
+        async def on_message(message: types.Message):
+            nonlocal processed
+            await asyncio.sleep(args.handler_ms / 1000)
+            seen[message.from_user.id].append(int(message.text))
+            processed += 1
+            if processed == args.updates:
+                done.set()
+
+        dp.register_message_handler(on_message)
+
+        async def process(update: types.Update) -> None:
+            Bot.set_current(bot)
+            Dispatcher.set_current(dp)
+            await dp.process_update(update)
+
+        updates = UpdateQueue(process)
+        await updates.start()
+
+        stub.push_updates([
+            _update(first_update_id + i, 1000 + i % args.users, i) for i in range(args.updates)
+        ])
+        poller = UpdatePoller(bot, updates, limit=batch_size, timeout=1)
+        started = time.perf_counter()
+        task = asyncio.ensure_future(poller.run())
+        try:
+            await asyncio.wait_for(done.wait(), 300)
+            elapsed = time.perf_counter() - started
+        finally:
+            poller.stop()
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            await (await bot.get_session()).close()
+            await runner.cleanup()
+
+        ordered = all(seq == sorted(seq) for seq in seen.values())
+        return {
+            "batch": batch_size,
+            "elapsed": elapsed,
+            "rate": args.updates / elapsed,
+            "calls": stub.calls["getUpdates"],
+            "ordered": ordered,
+            "offset": _load_offset_sync(123456),
+            "expected_offset": first_update_id + args.updates,
+        }
+
+    print(f"updates={args.updates} users={args.users} rtt={args.tg_latency_ms:.0f}ms handler={args.handler_ms:.0f}ms")
+    print("batch   elapsed   updates/s   getUpdates   per-user order   offset")
+    next_id = 1
+    for batch_size in (int(b) for b in args.batch_sizes.split(",")):
+        r = asyncio.run(run(batch_size, next_id))
+        next_id += args.updates
+        offset_ok = "ok" if r["offset"] == r["expected_offset"] else f"{r['offset']} != {r['expected_offset']}"
+        print(f"{r['batch']:5d}  {r['elapsed']:7.2f}s  {r['rate']:10.0f}  {r['calls']:11d}   "
+              f"{'ok' if r['ordered'] else 'BROKEN':>14}   {offset_ok}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# bench/startup.py
+"""
+Время старта:
+  import   — `import entry` в чистом процессе: сколько длится и что после себя
+             оставляет (потоки, файл БД) — должно быть «ничего»;
+  start    — import + entry.start() (все START_HOOKS);
+  gunicorn — холодный старт gunicorn -c gunicorn_conf.py с --preload и без:
+             время до первого 200 на /health и start() каждого воркера
+             (строка "Entry started in N ms" из лога).
+
+    python bench/startup.py --workers 2
+"""
+import argparse
+import json
+import os
+import re
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_PROBE = r"""
+import json, os, sys, threading, time
+sys.path.insert(0, {root!r})
+t = time.perf_counter()
+import entry
+imported = time.perf_counter() - t
+threads = threading.active_count()
+db_exists = os.path.exists({db!r})
+started = None
+if {do_start!r}:
+    t = time.perf_counter()
+    entry.start()
+    started = time.perf_counter() - t
+print(json.dumps({{"import": imported, "threads": threads, "db_created": db_exists, "start": started}}))
+os._exit(0)
+"""
+
+
+def _env(workdir: str, port: int) -> dict:
+    return dict(
+        os.environ,
+        TOKEN="123456:bench",
+        CHANNEL_ID="-100",
+        BASE_URL="",
+        PAYMENTS_MODE="mock",
+        DATABASE_URL=f"sqlite:///{workdir}/bench_startup.db",
+        PORT=str(port),
+    )
+
+
+def _probe(workdir: str, do_start: bool) -> dict:
+    code = _PROBE.format(root=ROOT, db=f"{workdir}/bench_startup.db", do_start=do_start)
+    out = subprocess.run(
+        [sys.executable, "-c", code], cwd=workdir, env=_env(workdir, 0),
+        capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def _gunicorn(workdir: str, port: int, workers: int, preload: bool, timeout: float = 30.0) -> dict:
+    env = _env(workdir, port)
+    env["GUNICORN_PRELOAD"] = "1" if preload else "0"
+    cmd = [
+        sys.executable, "-m", "gunicorn", "-c", "gunicorn_conf.py", "-w", str(workers),
+        "--bind", f"127.0.0.1:{port}", "--access-logfile", "/dev/null", "entry:app",
+    ]
+    started = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, text=True, start_new_session=True)
+    worker_ms = []
+    got_all = threading.Event()
+
+    def read_log():
+        for line in proc.stderr:
+            m = re.search(r"Entry started in (\d+) ms", line)
+            if m:
+                worker_ms.append(int(m.group(1)))
+                if len(worker_ms) >= workers:
+                    got_all.set()
+
+    threading.Thread(target=read_log, daemon=True).start()
+    ready = None
+    try:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/health", timeout=1) as r:
+                    if r.status == 200:
+                        ready = time.perf_counter() - started
+                        break
+            except OSError:
+                time.sleep(0.02)
+        got_all.wait(timeout)
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            # TERM, пришедший воркеру ещё в post_fork, gunicorn обработает лишь по graceful_timeout
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+    return {"ready": ready, "worker_start_ms": sorted(worker_ms)}
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--workers", type=int, default=2)
+    ap.add_argument("--port", type=int, default=18100)
+    ap.add_argument("--runs", type=int, default=3)
+    args = ap.parse_args()
+
+    for do_start in (False, True):
+        samples = []
+        for _ in range(args.runs):
+            with tempfile.TemporaryDirectory() as workdir:
+                samples.append(_probe(workdir, do_start))
+        best = min(samples, key=lambda r: r["import"])
+        line = f"import entry: {best['import'] * 1000:7.1f} ms  threads={best['threads']} db_created={best['db_created']}"
+        if do_start:
+            line = f"import + start(): {(best['import'] + best['start']) * 1000:7.1f} ms (start {best['start'] * 1000:.1f} ms)"
+        print(line)
+
+    for n, preload in enumerate((True, False)):
+        with tempfile.TemporaryDirectory() as workdir:
+            r = _gunicorn(workdir, args.port + n, args.workers, preload)
+        ready = f"{r['ready'] * 1000:7.1f} ms" if r["ready"] is not None else "   n/a"
+        print(f"gunicorn {'--preload' if preload else 'no preload'}: first /health 200 after {ready}, "
+              f"worker start() ms: {r['worker_start_ms']}")
+
+
+if __name__ == "__main__":
+    main()
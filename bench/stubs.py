@@ -0,0 +1,268 @@
+# bench/stubs.py
+"""
+Локальные заглушки внешних сервисов для нагрузочных тестов — без сети.
+
+  BotApiStub  — Telegram Bot API (/bot<token>/<method>): задержка ответа,
+                доля 429 с retry_after, доля 403 «бот заблокирован», запись
+                исходящих сообщений по chat_id, очередь апдейтов для getUpdates
+                (long poll, offset подтверждает полученные);
+  WataStub    — WATA H2H: POST /links, GET /public-key и подпись webhook'ов
+                собственным RSA-ключом (RSA+SHA512, как у WATA).
+
+Бот направляется на заглушки переменными окружения:
+    TELEGRAM_API_URL=http://127.0.0.1:8081
+    WATA_BASE_URL=http://127.0.0.1:8082  WATA_TOKEN=bench  PAYMENTS_MODE=real
+
+Можно поднять отдельно и гонять бота вручную:
+    python bench/stubs.py --bot-port 8081 --wata-port 8082 --tg-latency-ms 30 --tg-429 0.01
+"""
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import random
+import time
+import uuid
+from collections import Counter, deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+from aiohttp import web
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import padding, rsa
+
+_BOT_USER = {"id": 123456, "is_bot": True, "first_name": "FootBot", "username": "foot_bench_bot"}
+
+
+def _jittered(latency: float, jitter: float) -> float:
+    return max(0.0, latency + random.uniform(-jitter, jitter))
+
+
+class BotApiStub:
+    """
+    Минимальный Bot API: отвечает на методы, которые вызывает бот,
+    правдоподобными объектами. on_message(chat_id, method, ts) вызывается
+    на каждое исходящее сообщение — по нему драйвер меряет end-to-end задержку.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.03,
+        jitter: float = 0.01,
+        rate_429: float = 0.0,
+        retry_after: int = 1,
+        on_message: Optional[Callable[[int, str, float], None]] = None,
+        rate_403: float = 0.0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.rate_403 = rate_403
+        self.blocked = 0
+        self.on_message = on_message
+        self.calls: Counter = Counter()
+        self.throttled = 0
+        self._message_ids = itertools.count(1)
+        self._pending_updates: deque = deque()
+        self._updates_ready: Optional[asyncio.Event] = None
+
+    def push_updates(self, updates: List[dict]) -> None:
+        """Апдейты для getUpdates (по возрастанию update_id). Вызывать на loop заглушки."""
+        self._pending_updates.extend(updates)
+        if self._updates_ready is not None:
+            self._updates_ready.set()
+
+    async def _get_updates(self, params: Dict[str, str]) -> List[dict]:
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        pending = self._pending_updates
+        while pending and pending[0]["update_id"] < offset:
+            pending.popleft()  # подтверждены offset'ом
+        if not pending and timeout:
+            if self._updates_ready is None:
+                self._updates_ready = asyncio.Event()
+            self._updates_ready.clear()
+            try:
+                await asyncio.wait_for(self._updates_ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return list(itertools.islice(pending, limit))
+
+    def _result(self, method: str, params: Dict[str, str]) -> object:
+        if method in ("sendMessage", "copyMessage", "forwardMessage", "sendPhoto"):
+            chat_id = int(params.get("chat_id", 0))
+            return {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "channel"},
+                "from": _BOT_USER,
+                "text": params.get("text", ""),
+            }
+        if method in ("createChatInviteLink", "revokeChatInviteLink"):
+            return {
+                "invite_link": params.get("invite_link") or f"https://t.me/+{uuid.uuid4().hex[:16]}",
+                "creator": _BOT_USER,
+                "creates_join_request": False,
+                "is_primary": False,
+                "is_revoked": method == "revokeChatInviteLink",
+                "name": params.get("name"),
+                "expire_date": int(params["expire_date"]) if params.get("expire_date") else None,
+                "member_limit": int(params["member_limit"]) if params.get("member_limit") else None,
+            }
+        if method == "getMe":
+            return _BOT_USER
+        # answerCallbackQuery, deleteMessage, ban/unban, setWebhook и прочее
+        return True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        self.calls[method] += 1
+
+        await asyncio.sleep(_jittered(self.latency, self.jitter))
+
+        if self.rate_429 and random.random() < self.rate_429:
+            self.throttled += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+
+        if self.rate_403 and method == "sendMessage" and random.random() < self.rate_403:
+            self.blocked += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 403,
+                "description": "Forbidden: bot was blocked by the user",
+            }, status=403)
+
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+
+        result = self._result(method, params)
+        if self.on_message and method in ("sendMessage", "copyMessage", "forwardMessage", "sendPhoto"):
+            self.on_message(int(params.get("chat_id", 0)), method, time.perf_counter())
+        return web.json_response({"ok": True, "result": result})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/bot{token}/{method}", self.handle)
+        return app
+
+
+class WataStub:
+    """
+    Заглушка WATA: платёжные ссылки, публичный ключ и подписанные webhook'и.
+    """
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.02, error_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.links = 0
+        self.errors = 0
+        self._key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        self.public_pem = self._key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo,
+        ).decode()
+
+    def sign(self, raw_body: bytes) -> str:
+        signature = self._key.sign(raw_body, padding.PKCS1v15(), hashes.SHA512())
+        return base64.b64encode(signature).decode()
+
+    def webhook(self, order_id: str, plan: str, user_id: int, amount: float = 100.0) -> Tuple[bytes, str]:
+        """
+        Тело и X-Signature события успешной оплаты — в формате, который ждёт /payment_webhook.
+        """
+        body = json.dumps({
+            "transactionType": "CardCrypto",
+            "transactionId": str(uuid.uuid4()),
+            "transactionStatus": "Paid",
+            "status": "Closed",
+            "orderId": order_id,
+            "amount": amount,
+            "currency": "RUB",
+            "description": f"{plan} user {user_id}",
+        }, ensure_ascii=False).encode()
+        return body, self.sign(body)
+
+    async def create_link(self, request: web.Request) -> web.Response:
+        payload = await request.json()
+        await asyncio.sleep(_jittered(self.latency, self.jitter))
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response({"error": "temporarily unavailable"}, status=503)
+        self.links += 1
+        link_id = str(uuid.uuid4())
+        return web.json_response({
+            "id": link_id,
+            "amount": payload.get("amount"),
+            "currency": payload.get("currency", "RUB"),
+            "status": "Opened",
+            "url": f"https://payment.wata.local/{link_id}",
+            "orderId": payload.get("orderId"),
+            "description": payload.get("description"),
+        })
+
+    async def public_key(self, request: web.Request) -> web.Response:
+        return web.json_response({"value": self.public_pem})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/links", self.create_link)
+        app.router.add_get("/public-key", self.public_key)
+        return app
+
+
+async def start_site(app: web.Application, host: str, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--bot-port", type=int, default=8081)
+    ap.add_argument("--wata-port", type=int, default=8082)
+    ap.add_argument("--tg-latency-ms", type=float, default=30)
+    ap.add_argument("--tg-429", type=float, default=0.0, help="доля ответов 429")
+    ap.add_argument("--retry-after", type=int, default=1)
+    ap.add_argument("--wata-latency-ms", type=float, default=50)
+    args = ap.parse_args()
+
+    bot_api = BotApiStub(latency=args.tg_latency_ms / 1000, rate_429=args.tg_429, retry_after=args.retry_after)
+    wata = WataStub(latency=args.wata_latency_ms / 1000)
+
+    async def run() -> None:
+        runners: List[web.AppRunner] = [
+            await start_site(bot_api.app(), args.host, args.bot_port),
+            await start_site(wata.app(), args.host, args.wata_port),
+        ]
+        print(f"Bot API stub: http://{args.host}:{args.bot_port}")
+        print(f"WATA stub:    http://{args.host}:{args.wata_port}")
+        try:
+            while True:
+                await asyncio.sleep(10)
+                print(f"calls={dict(bot_api.calls)} throttled={bot_api.throttled} links={wata.links}")
+        finally:
+            for r in runners:
+                await r.cleanup()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# bench/webhook_modes.py
+"""
+Сравнение пропускной способности /telegram_webhook в двух режимах:
+  - flask:   gunicorn gthread (как в Dockerfile), entry:app
+  - aiohttp: SERVER_MODE=aiohttp python entry.py
+
+Апдейты — обычные текстовые сообщения, на которые нет хендлеров, поэтому
+Bot API не вызывается и меряется именно ingress. Запуск:
+
+    python bench/webhook_modes.py --requests 5000 --concurrency 64
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _update(i: int) -> dict:
+    return {
+        "update_id": i,
+        "message": {
+            "message_id": i,
+            "date": int(time.time()),
+            "chat": {"id": 1000 + i % 500, "type": "private"},
+            "from": {"id": 1000 + i % 500, "is_bot": False, "first_name": "bench"},
+            "text": "hello",
+        },
+    }
+
+
+def _start_server(mode: str, port: int, workdir: str) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        TOKEN="123456:bench",
+        CHANNEL_ID="-100",
+        BASE_URL="",
+        PAYMENTS_MODE="mock",
+        DATABASE_URL=f"sqlite:///{workdir}/bench_{mode}.db",
+        PORT=str(port),
+        SERVER_MODE=mode,
+    )
+    if mode == "aiohttp":
+        cmd = [sys.executable, "entry.py"]
+    else:
+        cmd = [
+            sys.executable, "-m", "gunicorn", "-w", "1", "-k", "gthread", "--threads", "8",
+            "--bind", f"127.0.0.1:{port}", "--log-level", "warning", "--access-logfile", "/dev/null",
+            "entry:app",
+        ]
+    return subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def _wait_ready(url: str, timeout: float = 20.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as s:
+        while time.monotonic() < deadline:
+            try:
+                async with s.get(url + "/health") as r:
+                    if r.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"server at {url} did not start")
+
+
+async def _drive(url: str, total: int, concurrency: int) -> float:
+    counter = iter(range(total))
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as s:
+        async def worker():
+            for i in counter:
+                async with s.post(url + "/telegram_webhook", json=_update(i)) as r:
+                    await r.read()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return time.perf_counter() - started
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--requests", type=int, default=5000)
+    ap.add_argument("--concurrency", type=int, default=64)
+    ap.add_argument("--modes", default="flask,aiohttp")
+    ap.add_argument("--port", type=int, default=18080)
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for n, mode in enumerate(args.modes.split(",")):
+            port = args.port + n
+            url = f"http://127.0.0.1:{port}"
+            proc = _start_server(mode, port, workdir)
+            try:
+                asyncio.run(_wait_ready(url))
+                asyncio.run(_drive(url, min(500, args.requests), args.concurrency))  # прогрев
+                elapsed = asyncio.run(_drive(url, args.requests, args.concurrency))
+                print(f"{mode:8s} {args.requests / elapsed:10.1f} updates/s  ({elapsed:.2f}s)")
+            finally:
+                proc.terminate()
+                proc.wait(timeout=10)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,159 +1,357 @@
 # entry.py
+"""
+Точка входа. Импорт модуля дешёвый и без побочных эффектов: БД, бот, loop,
+планировщик и вебхук поднимает start() — упорядоченными хуками START_HOOKS,
+один раз на процесс. Тяжёлые зависимости (aiogram, SQLAlchemy, cryptography)
+импортируются лениво.
+
+    gunicorn -c gunicorn_conf.py --preload entry:app   # start() в post_fork
+    python entry.py                                     # start() + свой сервер
+"""
 import os
+import json
 import time
 import asyncio
 import threading
 import logging
+from concurrent.futures import Future
 from datetime import datetime, timedelta, timezone
+from typing import Callable, List, Optional, Tuple
 
-from flask import Flask, request, jsonify, abort, render_template_string
 from dotenv import load_dotenv
 
-from aiogram import Bot, Dispatcher, types
-from aiogram.dispatcher import Dispatcher as AiogramDispatcher
+# .env — до импорта модулей app.*, они читают окружение при импорте
+load_dotenv()
 
-from app.models import init_db, SessionLocal, Subscription
-from app.payments import verify_signature
-from app.handlers import register_handlers
-from app.scheduler import start_scheduler  # <- используем колбэк on_expire
+from flask import Blueprint, Flask, request, jsonify, abort, render_template_string  # noqa: E402
 
-PLAN_TO_DELTA = {
-    "Неделя": timedelta(days=7),
-    "Месяц": timedelta(days=30),
-    "Чат": timedelta(days=1),
-    "Тест1м": timedelta(minutes=1),
-}
+from app.metrics import DB_SECONDS, WEBHOOK_SECONDS, GaugeFunc, CONTENT_TYPE, render as render_metrics  # noqa: E402
+from app.plans import PLANS, plan_by_name  # noqa: E402
+from app.logs import dump, setup_logging  # noqa: E402
+from app import profiler  # noqa: E402
 
 # ── logging ───────────────────────────────────────────────────────────────────
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s %(levelname)s %(name)s: %(message)s",
-    handlers=[logging.StreamHandler()],
-)
+# обработчики (очередь + поток записи) ставит хук start(); см. app.logs
 log = logging.getLogger("entry")
 
 # ── env ───────────────────────────────────────────────────────────────────────
-load_dotenv()
 TOKEN      = os.getenv("TOKEN")
 CHANNEL_ID = os.getenv("CHANNEL_ID")
 BASE_URL   = (os.getenv("BASE_URL", "").rstrip("/"))
 TEST_MODE  = os.getenv("TEST_MODE", "1") == "1"
+# flask — совместимый режим (gunicorn entry:app); aiohttp — `python entry.py`,
+# все эндпойнты на loop диспетчера
+SERVER_MODE = os.getenv("SERVER_MODE", "flask").lower()
+# свой Bot API сервер (telegram-bot-api или заглушка из bench/stubs.py)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip("/")
+# webhook — апдейты приходят на /telegram_webhook (нужен BASE_URL); polling — лидер тянет getUpdates
+UPDATES_MODE = os.getenv("UPDATES_MODE", "webhook").lower()
+
+# ── состояние процесса (заполняется хуками start()) ──────────────────────────
+bot = None
+dp = None
+updates = None
+invite_pool = None
+payment_inbox = None
+broadcasts = None
+poller = None
+_poller_future = None
+leader = None
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
 
-if not TOKEN or not CHANNEL_ID:
-    raise RuntimeError("Не заданы TOKEN или CHANNEL_ID")
-log.info("Environment loaded")
+def run_coro(coro):
+    return asyncio.run_coroutine_threadsafe(coro, _loop)
 
-# ── db ────────────────────────────────────────────────────────────────────────
-init_db()
-log.info("Database initialized")
 
-# ── aiogram ───────────────────────────────────────────────────────────────────
-bot = Bot(token=TOKEN)
-dp  = Dispatcher(bot)
-register_handlers(dp)
-log.info("Aiogram dispatcher ready")
+async def _process_update_with_ctx(update):
+    from aiogram import Bot
+    from aiogram.dispatcher import Dispatcher as AiogramDispatcher
 
-# ── общий asyncio-loop в отдельном потоке ─────────────────────────────────────
-_loop = asyncio.new_event_loop()
+    from app.timing import run_metered
 
-async def _process_update_with_ctx(update: types.Update):
     Bot.set_current(bot)
     AiogramDispatcher.set_current(dp)
-    await dp.process_update(update)
-
-def _loop_worker():
-    asyncio.set_event_loop(_loop)
-    log.info("Background asyncio loop started")
-    _loop.run_forever()
-
-threading.Thread(target=_loop_worker, name="aiogram-loop", daemon=True).start()
-
-def run_coro(coro):
-    return asyncio.run_coroutine_threadsafe(coro, _loop)
-
-# ── Flask (WSGI) ──────────────────────────────────────────────────────────────
-app = Flask(__name__)
-log.info("Flask app created")
+    # CPU считается только по шагам этой задачи — для HandlerTimingMiddleware
+    await run_metered(dp.process_update(update))
 
 
 # ── выдача подписки и инвайта ─────────────────────────────────────────────────
-def _grant_subscription(user_id: int, plan: str):
-    delta = PLAN_TO_DELTA.get(plan)
-    if not user_id or not delta:
+# сколько PaymentInbox ждёт доставки ссылки; столько же дубли не начинают повторную
+GRANT_DELIVERY_TIMEOUT = float(os.getenv("GRANT_DELIVERY_TIMEOUT", "30"))
+
+
+def _grant_subscription(user_id: int, plan: str, order_id: Optional[str] = None) -> Optional[Future]:
+    """
+    Выдаёт подписку и шлёт инвайт. С order_id — идемпотентно: повтор того же
+    заказа отсекается LRU, а после рестарта — уникальным ключом processed_payments;
+    повтор выданного, но не доставленного заказа только заново шлёт ссылку.
+    Возвращает Future доставки (ошибка в нём — повод повторить событие)
+    или None, если подписка не выдана (невалидные данные или дубль).
+    """
+    from sqlalchemy.exc import IntegrityError
+
+    from app.entitlements import extend_entitlement
+    from app.invoices import open_invoices
+    from app.ledger import recent_orders
+    from app.models import SessionLocal, Subscription, ProcessedPayment, PaymentDelivery
+    from app.scheduler import schedule_expiry
+    from app.subs_cache import record_invalidation, subscriptions_cache
+
+    plan_info = plan_by_name(plan)
+    if not user_id or plan_info is None:
         log.warning("grant: invalid args user_id=%s plan=%s", user_id, plan)
-        return
+        return None
+
+    if order_id in recent_orders:
+        log.info("grant: duplicate orderId=%s skipped (recent)", order_id)
+        return None
 
     # naive UTC
-    expires = datetime.utcnow() + delta
+    now = datetime.utcnow()
+    lease_until = now + timedelta(seconds=GRANT_DELIVERY_TIMEOUT)
 
-    # записываем в БД
+    # записываем в БД: продление доступа, история покупки, журнал и открытые счета — одной транзакцией
     session = SessionLocal()
     try:
-        sub = Subscription(user_id=user_id, plan=plan, expires_at=expires)
-        session.add(sub)
-        session.commit()
+        with DB_SECONDS.time("grant_subscription"):
+            if order_id:
+                session.add(ProcessedPayment(order_id=order_id, user_id=user_id, plan=plan, processed_at=now))
+                session.flush()  # дубль orderId — IntegrityError до любых других записей
+            expires = extend_entitlement(session, user_id, plan, plan_info.duration, now)
+            session.add(Subscription(user_id=user_id, plan=plan, expires_at=expires))
+            invite_link = invite_pool.claim(session, plan, user_id, now)
+            # оплаченный счёт больше не отдаём, «Мои подписки» перечитываем — во всех воркерах
+            open_invoices.invalidate_user(session, user_id)
+            record_invalidation(session, user_id)
+            if order_id:
+                session.add(PaymentDelivery(order_id=order_id, user_id=user_id, plan=plan,
+                                            invite_link=invite_link, expires_at=expires,
+                                            next_attempt_at=lease_until))
+            session.commit()
+    except IntegrityError:
+        session.rollback()
+        return _redeliver(session, order_id, now, lease_until)
     finally:
         session.close()
 
-    async def _unban_and_send():
-        # на случай повторной оплаты — снимаем бан
+    # точный кик без полного скана: сразу отдаём дедлайн движку истечений
+    schedule_expiry(user_id, expires)
+    subscriptions_cache.invalidate(user_id)
+    log.info("Subscription granted: user_id=%s plan=%s until=%s",
+             user_id, plan, expires.isoformat() + "Z")
+    return _deliver_grant(user_id, plan, expires, invite_link, order_id)
+
+
+def _redeliver(session, order_id: str, now: datetime, lease_until: datetime) -> Optional[Future]:
+    """
+    Заказ уже в processed_payments. Если ссылка не доставлена и прошлая попытка
+    закончилась (аренда истекла или снята) — берём аренду и доставляем заново.
+    """
+    from sqlalchemy import update
+
+    from app.ledger import recent_orders
+    from app.models import PaymentDelivery
+
+    row = session.execute(
+        update(PaymentDelivery)
+        .where(PaymentDelivery.order_id == order_id, PaymentDelivery.next_attempt_at <= now)
+        .values(next_attempt_at=lease_until)
+        .returning(PaymentDelivery.user_id, PaymentDelivery.plan,
+                   PaymentDelivery.invite_link, PaymentDelivery.expires_at)
+        .execution_options(synchronize_session=False)
+    ).first()
+    session.commit()
+    if row is not None:
+        log.info("grant: redelivering orderId=%s to user_id=%s", order_id, row.user_id)
+        return _deliver_grant(row.user_id, row.plan, row.expires_at, row.invite_link, order_id)
+
+    if session.get(PaymentDelivery, order_id) is not None:
+        # доставка идёт прямо сейчас; если она упадёт, повторит исходное событие
+        log.info("grant: duplicate orderId=%s skipped (delivery in progress)", order_id)
+    else:
+        recent_orders.add(order_id)
+        log.info("grant: duplicate orderId=%s skipped (ledger)", order_id)
+    return None
+
+
+def _deliver_grant(user_id: int, plan: str, expires: datetime, invite_link: Optional[str],
+                   order_id: Optional[str]) -> Future:
+    """
+    Анбан и сообщение со ссылкой на loop бота. С order_id успех удаляет строку
+    payment_deliveries, ошибка снимает аренду и остаётся в Future — событие
+    повторится. Без order_id повторять нечего: ошибка только логируется.
+    """
+    from aiogram.utils.exceptions import ChatNotFound, Unauthorized
+
+    from app.db import run_db
+    from app.ledger import recent_orders
+    from app.outbound import with_priority, PRIORITY_PAYMENT
+
+    async def _unban():
+        # на случай повторной оплаты после кика; only_if_banned — не выкинуть текущего участника
         try:
-            await bot.unban_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
+            await bot.unban_chat_member(chat_id=CHANNEL_ID, user_id=user_id, only_if_banned=True)
         except Exception:
             pass
 
-        # Telegram API ожидает unix ts (int) для expire_date
-        expire_ts = int(expires.replace(tzinfo=timezone.utc).timestamp())
-
-        invite = await bot.create_chat_invite_link(
-            chat_id=CHANNEL_ID,
-            name=f"{plan} {user_id}",
-            expire_date=expire_ts,
-            member_limit=1,
-        )
+    async def _unban_and_send():
+        link = invite_link
+        if link is None:
+            # пул пуст — старый путь: анбан и ссылка прямо сейчас
+            log.info("grant: invite pool empty for plan=%s, creating link inline", plan)
+            await _unban()
+            # Telegram API ожидает unix ts (int) для expire_date
+            expire_ts = int(expires.replace(tzinfo=timezone.utc).timestamp())
+            invite = await bot.create_chat_invite_link(
+                chat_id=CHANNEL_ID,
+                name=f"{plan} {user_id}",
+                expire_date=expire_ts,
+                member_limit=1,
+            )
+            link = invite.invite_link
 
         text = (
             "✅ Оплата получена!\n\n"
-            f"Ссылка в канал:\n{invite.invite_link}\n\n"
+            f"Ссылка в канал:\n{link}\n\n"
             f"Действует до: {expires:%d.%m.%Y %H:%M} UTC"
         )
         try:
             await bot.send_message(chat_id=user_id, text=text)
-        except Exception as e:
-            log.warning("send_message failed for user %s: %s", user_id, e)
+        except (Unauthorized, ChatNotFound) as e:
+            # бот заблокирован или чата нет — повтор не поможет
+            log.warning("send_message failed for user %s, not retrying: %s", user_id, e)
+
+        if invite_link is not None:
+            # ответ уже ушёл — анбан не задерживает пользователя
+            await _unban()
+
+    async def _deliver():
+        try:
+            await _unban_and_send()
+        except (Exception, asyncio.CancelledError) as e:
+            if order_id is None:
+                log.warning("grant: delivery failed for user %s: %r", user_id, e)
+                return
+            await run_db(_release_delivery, order_id)
+            raise
+        if order_id:
+            await run_db(_forget_delivery, order_id)
+            recent_orders.add(order_id)
+
+    return run_coro(with_priority(PRIORITY_PAYMENT, _deliver()))
 
-    run_coro(_unban_and_send())
-    log.info("Subscription granted: user_id=%s plan=%s until=%s",
-             user_id, plan, expires.isoformat() + "Z")
+
+def _forget_delivery(order_id: str) -> None:
+    from sqlalchemy import delete
+
+    from app.models import SessionLocal, PaymentDelivery
+
+    session = SessionLocal()
+    try:
+        session.execute(delete(PaymentDelivery).where(PaymentDelivery.order_id == order_id))
+        session.commit()
+    finally:
+        session.close()
+
+
+def _release_delivery(order_id: str) -> None:
+    # попытка не удалась — повтор события может начинать новую сразу
+    from sqlalchemy import update
+
+    from app.models import SessionLocal, PaymentDelivery
+
+    session = SessionLocal()
+    try:
+        session.execute(
+            update(PaymentDelivery)
+            .where(PaymentDelivery.order_id == order_id)
+            .values(next_attempt_at=datetime.utcnow())
+        )
+        session.commit()
+    finally:
+        session.close()
 
 
 # ── автоотключение (бан→анбан) по завершению подписки ─────────────────────────
+EXPIRE_CONCURRENCY = int(os.getenv("EXPIRE_CONCURRENCY", "8"))
+
+# волны киков идут на loop по одной: планировщик только ставит их в очередь
+_expire_lock = asyncio.Lock()
+
+
+async def _kick(user_id: int) -> None:
+    from app.db import run_db
+    from app.entitlements import has_access
+
+    # строку entitlements удалили при истечении, но до кика пользователь мог продлиться
+    try:
+        if await run_db(has_access, user_id):
+            log.info("Kick skipped user_id=%s: access renewed", user_id)
+            return
+    except Exception as e:
+        log.warning("Kick re-check failed user_id=%s, kicking anyway: %s", user_id, e)
+    try:
+        # неиспользованная ссылка из пула живёт дольше короткого плана — до кика
+        await invite_pool.revoke_issued(user_id)
+    except Exception as e:
+        log.warning("Invite revoke failed user_id=%s: %s", user_id, e)
+    try:
+        # «выкинуть»: бан, затем сразу анбан
+        await bot.ban_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
+        await bot.unban_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
+    except Exception as e:
+        log.warning("Kick failed user_id=%s: %s", user_id, e)
+    try:
+        await bot.send_message(
+            chat_id=user_id,
+            text="⏰ Срок вашей подписки истёк. Доступ к каналу отключён.\n"
+                 "Вы можете оформить новую подписку в боте."
+        )
+    except Exception:
+        pass
+
+
 def on_expire(user_id: int, plan: str) -> None:
+    from app.outbound import with_priority, PRIORITY_NOTICE
+
+    run_coro(with_priority(PRIORITY_NOTICE, _kick(user_id)))
+
+
+def on_expire_batch(items: List[Tuple[int, str]]) -> None:
+    # пачка кик-ов через ограниченный пул корутин, а не N задач разом. Поток
+    # планировщика не ждёт рассылку (1000 киков — это минуты при лимите Bot API):
+    # пачки выстраиваются в очередь на _expire_lock и идут по одной, так что
+    # одновременно в работе не больше EXPIRE_CONCURRENCY киков
+    from app.batching import run_bounded
+    from app.outbound import priority, PRIORITY_NOTICE
+
     async def _do():
-        try:
-            # «выкинуть»: бан, затем сразу анбан
-            await bot.ban_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-            await bot.unban_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
-        except Exception as e:
-            log.warning("Kick failed user_id=%s: %s", user_id, e)
-        try:
-            await bot.send_message(
-                chat_id=user_id,
-                text="⏰ Срок вашей подписки истёк. Доступ к каналу отключён.\n"
-                     "Вы можете оформить новую подписку в боте."
-            )
-        except Exception:
-            pass
-    run_coro(_do())
+        async with _expire_lock:
+            with priority(PRIORITY_NOTICE):
+                failed = await run_bounded(lambda item: _kick(item[0]), items, limit=EXPIRE_CONCURRENCY)
+        log.info("Expire batch done: users=%d failed=%d", len(items), failed)
+
+    def _done(fut):
+        if not fut.cancelled() and fut.exception() is not None:
+            log.error("Expire batch failed: users=%d: %r", len(items), fut.exception())
+    run_coro(_do()).add_done_callback(_done)
 
-# запускаем планировщик ТЕПЕРЬ, когда есть run_coro и bot
-start_scheduler(on_expire=on_expire, interval_seconds=60)
-log.info("Scheduler started")
+
+# ── HTTP (Flask) ──────────────────────────────────────────────────────────────
+web = Blueprint("web", __name__)
 
 
 # ── Telegram webhook ──────────────────────────────────────────────────────────
-@app.post("/telegram_webhook")
+@web.post("/telegram_webhook")
 def telegram_webhook():
+    with WEBHOOK_SECONDS.time("telegram"):
+        return _telegram_webhook()
+
+
+def _telegram_webhook():
+    from aiogram import types
+
     payload = request.get_json(silent=True) or {}
     try:
         update = types.Update(**payload)
@@ -161,28 +359,69 @@ def telegram_webhook():
         log.exception("Bad Telegram update payload")
         return jsonify(ok=False), 200
 
-    try:
-        run_coro(_process_update_with_ctx(update))
-    except Exception:
-        log.exception("Failed to schedule update")
-        return jsonify(ok=False), 200
+    if not updates.offer(update):
+        # очередь полна — пусть Telegram доставит апдейт повторно позже
+        log.warning("Update queue full, rejecting update %s", update.update_id)
+        return jsonify(ok=False), 503
 
     return jsonify(ok=True), 200
 
 
 # ── WATA payment webhook ──────────────────────────────────────────────────────
-@app.post("/payment_webhook")
+@web.post("/payment_webhook")
 def payment_webhook():
+    with WEBHOOK_SECONDS.time("payment"):
+        return _payment_webhook()
+
+
+def _payment_webhook():
+    from app.payments import verify_signature
+
     raw = request.get_data()
     sig = request.headers.get("X-Signature")
     if not sig or not verify_signature(raw, sig):
         log.warning("Invalid signature on /payment_webhook")
         abort(400, "Invalid signature")
 
-    data = request.get_json(silent=True) or {}
-    log.info("Payment webhook: %s", data)
+    accept_payment(raw)
+    return jsonify(ok=True), 200
+
+
+def accept_payment(raw: bytes) -> None:
+    """
+    Приём проверенного webhook'а WATA: один INSERT в payment_inbox — и ответ.
+    Выдачу подписки делают воркеры PaymentInbox. Ретрай уже обработанного
+    заказа отсекается LRU без записи в БД.
+    """
+    from app.ledger import recent_orders
+
+    try:
+        order_id = (json.loads(raw) or {}).get("orderId")
+    except (ValueError, AttributeError):
+        order_id = None
+    if order_id is not None and str(order_id) in recent_orders:
+        log.info("Payment webhook: duplicate orderId=%s", order_id)
+        return
+    payment_inbox.add(raw)
+
+
+def handle_payment_event(data: dict) -> Optional[Future]:
+    """
+    Обработка уже проверенного события WATA — вызывается воркерами PaymentInbox.
+    Исключение (БД, сеть) или ошибка в возвращённом Future доставки — событие
+    останется в inbox и будет повторено.
+    """
+    from app.ledger import recent_orders
+
+    log.info("Payment webhook: %s", dump(data))
 
     if data.get("status") == "Closed":
+        order_id = data.get("orderId")
+        if order_id in recent_orders:
+            # ретрай WATA — без БД и Telegram
+            log.info("Payment webhook: duplicate orderId=%s", order_id)
+            return None
+
         try:
             user_id = int((data.get("orderId") or "").split("-")[1])
         except Exception:
@@ -194,80 +433,383 @@ def payment_webhook():
 
         desc = data.get("description") or ""
         plan  = desc.split()[0] if desc else None
-        _grant_subscription(user_id, plan)
-
-    return jsonify(ok=True), 200
+        return _grant_subscription(user_id, plan, order_id=str(order_id) if order_id else None)
+    return None
 
 
 # ── тестовая заглушка оплаты (/testpay) ───────────────────────────────────────
-if TEST_MODE:
-    @app.get("/testpay")
-    def testpay_page():
-        user_id  = request.args.get("user_id", type=int)
-        plan     = request.args.get("plan", type=str) or "Не указан"
-        amount   = request.args.get("amount", type=float)
-        order_id = request.args.get("orderId") or f"tg-{user_id}-{int(time.time())}"
-
-        html = """
-        <!doctype html><meta charset="utf-8">
-        <title>Тестовая оплата</title>
-        <h2>Тестовая оплата</h2>
-        <p>Пользователь: <b>{{ user_id }}</b></p>
-        <p>План: <b>{{ plan }}</b> — сумма: <b>{{ amount or "?" }} ₽</b></p>
-        <p>orderId: <code>{{ order_id }}</code></p>
-        <p>
-          <a href="/testpay/success?user_id={{ user_id }}&plan={{ plan }}&orderId={{ order_id }}">✅ Оплатить (успех)</a>
-          &nbsp;&nbsp;
-          <a href="/testpay/fail">❌ Отмена</a>
-        </p>
-        """
-        return render_template_string(html, user_id=user_id, plan=plan, amount=amount, order_id=order_id)
-
-    @app.get("/testpay/success")
-    def testpay_success():
-        user_id = request.args.get("user_id", type=int)
-        plan    = request.args.get("plan", type=str)
-        _grant_subscription(user_id, plan)
-        return "<h3>Оплата смоделирована как УСПЕШНАЯ. Вернитесь в бота.</h3>", 200
-
-    @app.get("/testpay/fail")
-    def testpay_fail():
-        return "<h3>Оплата смоделирована как ОТМЕНЁННАЯ.</h3>", 200
+# регистрируется в create_app() только при TEST_MODE
+testpay = Blueprint("testpay", __name__)
+
+
+@testpay.get("/testpay")
+def testpay_page():
+    user_id  = request.args.get("user_id", type=int)
+    plan     = request.args.get("plan", type=str) or "Не указан"
+    amount   = request.args.get("amount", type=float)
+    order_id = request.args.get("orderId") or f"tg-{user_id}-{int(time.time())}"
+
+    html = """
+    <!doctype html><meta charset="utf-8">
+    <title>Тестовая оплата</title>
+    <h2>Тестовая оплата</h2>
+    <p>Пользователь: <b>{{ user_id }}</b></p>
+    <p>План: <b>{{ plan }}</b> — сумма: <b>{{ amount or "?" }} ₽</b></p>
+    <p>orderId: <code>{{ order_id }}</code></p>
+    <p>
+      <a href="/testpay/success?user_id={{ user_id }}&plan={{ plan }}&orderId={{ order_id }}">✅ Оплатить (успех)</a>
+      &nbsp;&nbsp;
+      <a href="/testpay/fail">❌ Отмена</a>
+    </p>
+    """
+    return render_template_string(html, user_id=user_id, plan=plan, amount=amount, order_id=order_id)
+
+
+@testpay.get("/testpay/success")
+def testpay_success():
+    user_id = request.args.get("user_id", type=int)
+    plan    = request.args.get("plan", type=str)
+    order_id = request.args.get("orderId")
+    try:
+        delivery = _grant_subscription(user_id, plan, order_id=order_id)
+        if delivery is not None:
+            delivery.result(timeout=GRANT_DELIVERY_TIMEOUT)
+    except Exception:
+        log.exception("testpay: grant failed user_id=%s orderId=%s", user_id, order_id)
+        return "<h3>Оплата записана, но ссылку отправить не удалось.</h3>", 500
+    return "<h3>Оплата смоделирована как УСПЕШНАЯ. Вернитесь в бота.</h3>", 200
+
+
+@testpay.get("/testpay/fail")
+def testpay_fail():
+    return "<h3>Оплата смоделирована как ОТМЕНЁННАЯ.</h3>", 200
 
 
 # ── тех. эндпойнты ────────────────────────────────────────────────────────────
-@app.get("/health")
+@web.get("/health")
 def health():
-    return jsonify(ok=True, ts=datetime.utcnow().isoformat() + "Z"), 200
+    return jsonify(ok=True, ts=datetime.utcnow().isoformat() + "Z", updates=updates.stats()), 200
 
-@app.get("/")
+@web.get("/metrics")
+def metrics():
+    return render_metrics(), 200, {"Content-Type": CONTENT_TYPE}
+
+@web.get("/")
 def root():
     return "ok", 200
 
-@app.get("/favicon.ico")
+@web.get("/favicon.ico")
 def favicon():
     return ("", 204, {"Cache-Control": "public, max-age=86400"})
 
+@web.get("/debug/profile")
+def debug_profile():
+    # без PROFILER_TOKEN эндпойнта как бы нет
+    if not profiler.authorized(request.headers.get("X-Profile-Token")):
+        abort(404)
+    try:
+        seconds, hz, thread = profiler.parse_params(request.args)
+    except ValueError:
+        abort(400)
+    try:
+        stacks = profiler.sample_stacks(seconds, hz, thread)
+    except profiler.ProfilerBusy:
+        return "profiler busy\n", 409
+    return stacks, 200, {"Content-Type": "text/plain; charset=utf-8"}
+
 
 # ── автоустановка вебхука в TG ────────────────────────────────────────────────
 WEBHOOK_URL = f"{BASE_URL}/telegram_webhook" if BASE_URL else ""
-if WEBHOOK_URL:
-    def _set_webhook_once():
-        async def _do():
-            try:
-                ok = await bot.set_webhook(
-                    WEBHOOK_URL,
-                    allowed_updates=["message", "callback_query"],
-                    drop_pending_updates=True,
-                )
-                log.info("Webhook set to %s (ok=%s)", WEBHOOK_URL, ok)
-            except Exception:
-                log.exception("Failed to set webhook")
-        run_coro(_do())
 
-    run_coro(asyncio.sleep(0.05))
-    _set_webhook_once()
-else:
-    log.warning("BASE_URL не задан — вебхук не выставляется автоматически.")
 
-log.info("Entry.py loaded, ready to serve")
+def _set_webhook_once():
+    async def _do():
+        try:
+            ok = await bot.set_webhook(
+                WEBHOOK_URL,
+                allowed_updates=["message", "callback_query"],
+                drop_pending_updates=True,
+            )
+            log.info("Webhook set to %s (ok=%s)", WEBHOOK_URL, ok)
+        except Exception:
+            log.exception("Failed to set webhook")
+    run_coro(_do())
+
+
+# ── polling (UPDATES_MODE=polling): getUpdates вместо вебхука ──────────────────
+def _start_polling():
+    global poller, _poller_future
+    from app.polling import UpdatePoller
+
+    poller = UpdatePoller(bot, updates, allowed_updates=["message", "callback_query"])
+    _poller_future = run_coro(poller.run())
+
+    def _done(fut):
+        if not fut.cancelled() and fut.exception() is not None:
+            log.error("Polling crashed: %r", fut.exception())
+    _poller_future.add_done_callback(_done)
+
+
+def _stop_polling():
+    global poller, _poller_future
+    if poller is not None:
+        poller.stop()
+        _poller_future.cancel()
+        poller = _poller_future = None
+
+
+# ── лидер: планировщик и вебхук — ровно в одном воркере ───────────────────────
+def refill_invite_pool() -> None:
+    try:
+        run_coro(invite_pool.refill()).result()
+    except Exception:
+        log.exception("Invite pool refill failed")
+
+
+def _on_elected():
+    global broadcasts
+    from app.broadcast import BroadcastEngine, BROADCAST_POLL_INTERVAL
+    from app.invites import INVITE_POOL_REFILL_INTERVAL
+    from app.scheduler import start_scheduler, add_interval_job
+    from app.subs_cache import prune_invalidations
+
+    # запускаем планировщик ТЕПЕРЬ, когда есть run_coro и bot
+    start_scheduler(on_expire=on_expire, on_expire_batch=on_expire_batch, interval_seconds=60)
+    log.info("Scheduler started")
+    add_interval_job(refill_invite_pool, INVITE_POOL_REFILL_INTERVAL, "invite_pool_refill")
+    add_interval_job(prune_invalidations, 600, "subs_cache_prune")
+    # рассылки (в т.ч. прерванные рестартом) идут только у лидера
+    broadcasts = BroadcastEngine(bot, run_coro)
+    add_interval_job(broadcasts.tick, BROADCAST_POLL_INTERVAL, "broadcasts")
+
+    if UPDATES_MODE == "polling":
+        _start_polling()
+    elif WEBHOOK_URL:
+        _set_webhook_once()
+    else:
+        log.warning("BASE_URL не задан — вебхук не выставляется автоматически "
+                    "(UPDATES_MODE=polling — получать апдейты через getUpdates).")
+
+
+def _on_demoted():
+    from app.scheduler import stop_scheduler
+
+    stop_scheduler()
+    if broadcasts is not None:
+        broadcasts.stop()
+    _stop_polling()
+
+
+# ── запуск: хуки по порядку ───────────────────────────────────────────────────
+def _start_logging() -> None:
+    # stdout пишет отдельный поток: горячие пути только кладут запись в очередь
+    setup_logging()
+
+
+def _start_metrics() -> None:
+    from app.metrics import start_flusher
+
+    # снимок метрик воркера для /metrics соседей (gunicorn -w N)
+    start_flusher()
+
+
+def _start_env() -> None:
+    if not TOKEN or not CHANNEL_ID:
+        raise RuntimeError("Не заданы TOKEN или CHANNEL_ID")
+    log.info("Environment loaded")
+
+
+def _start_db() -> None:
+    from app.models import init_db
+
+    init_db()
+    log.info("Database initialized")
+
+
+def _start_subs_cache() -> None:
+    from app.subs_cache import subscriptions_cache
+
+    # покупки в других воркерах сбрасывают кэш «Моих подписок» и здесь
+    subscriptions_cache.start_sync()
+
+
+def _start_public_key() -> None:
+    from app.payments import prefetch_public_key
+
+    # ключ WATA грузим заранее, чтобы первый webhook не ждал сеть
+    prefetch_public_key()
+
+
+def _start_bot() -> None:
+    global bot, dp
+    from aiogram import Dispatcher
+    from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
+
+    from app.handlers import register_handlers
+    from app.outbound import RateLimitedBot
+
+    # все исходящие вызовы идут через общий лимитер (глобальный + per-chat, приоритеты)
+    bot = RateLimitedBot(
+        token=TOKEN,
+        server=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else TELEGRAM_PRODUCTION,
+    )
+    dp = Dispatcher(bot)
+    register_handlers(dp)
+    log.info("Aiogram dispatcher ready")
+
+
+def _start_loop() -> None:
+    global _loop
+    # общий asyncio-loop в отдельном потоке
+    _loop = asyncio.new_event_loop()
+
+    def _loop_worker():
+        asyncio.set_event_loop(_loop)
+        log.info("Background asyncio loop started")
+        _loop.run_forever()
+
+    threading.Thread(target=_loop_worker, name="aiogram-loop", daemon=True).start()
+
+
+def _start_updates() -> None:
+    global updates
+    from app.ingress import UpdateQueue
+
+    # ограниченная очередь апдейтов: порядок per-user, общий лимит одновременных
+    updates = UpdateQueue(_process_update_with_ctx)
+    run_coro(updates.start()).result()
+
+    GaugeFunc("footbot_update_queue_depth", "Updates waiting in the ingress queue",
+              lambda: updates.stats()["depth"])
+    GaugeFunc("footbot_outbound_waiting", "Bot API calls waiting for the global rate limiter",
+              lambda: bot.limiter.stats()["waiting"])
+
+
+def _start_invites() -> None:
+    global invite_pool
+    from app.invites import InvitePool
+
+    # заранее созданные одноразовые ссылки в канал: оплата не ждёт createChatInviteLink
+    invite_pool = InvitePool(bot, CHANNEL_ID, [p.name for p in PLANS])
+
+
+def _start_inbox() -> None:
+    global payment_inbox
+    from app.inbox import PaymentInbox
+
+    # webhook WATA только пишет событие; выдачу делают воркеры inbox (в каждом процессе)
+    payment_inbox = PaymentInbox(handle_payment_event, result_timeout=GRANT_DELIVERY_TIMEOUT)
+    payment_inbox.start()
+    GaugeFunc("footbot_payment_inbox_depth", "Payment events waiting in the inbox", payment_inbox.depth,
+              shared=True)
+
+
+def _start_leader() -> None:
+    global leader
+    from app.leader import LeaderElector
+
+    # лидер поднимает планировщик и ставит вебхук, поэтому — последним
+    leader = LeaderElector(on_elected=_on_elected, on_demoted=_on_demoted)
+    leader.start()
+    if not leader.is_leader:
+        log.info("Not a leader — serving requests only (pid=%s)", os.getpid())
+
+
+# порядок важен: каждый хук опирается на предыдущие
+START_HOOKS: List[Tuple[str, Callable[[], None]]] = [
+    ("logging", _start_logging),
+    ("metrics", _start_metrics),
+    ("env", _start_env),
+    ("db", _start_db),
+    ("subs_cache", _start_subs_cache),
+    ("public_key", _start_public_key),
+    ("bot", _start_bot),
+    ("loop", _start_loop),
+    ("updates", _start_updates),
+    ("invites", _start_invites),
+    ("inbox", _start_inbox),
+    ("leader", _start_leader),
+]
+
+_started_pid: Optional[int] = None
+_start_lock = threading.Lock()
+
+
+def start() -> None:
+    """
+    Поднимает процесс: выполняет START_HOOKS по порядку. Идемпотентна в пределах
+    процесса; после fork (gunicorn --preload) в воркере выполняется заново —
+    потоки, loop и соединения родителя в дочерний процесс не переходят.
+    """
+    global _started_pid
+    if _started_pid == os.getpid():
+        return
+    with _start_lock:
+        if _started_pid == os.getpid():
+            return
+        started = time.perf_counter()
+        for name, hook in START_HOOKS:
+            t = time.perf_counter()
+            hook()
+            log.debug("start hook %s: %.1f ms", name, (time.perf_counter() - t) * 1000)
+        _started_pid = os.getpid()
+        log.info("Entry started in %.0f ms (pid=%s)", (time.perf_counter() - started) * 1000, os.getpid())
+
+
+def warm_imports() -> None:
+    """
+    Импортирует тяжёлые модули без запуска чего-либо. Для мастера gunicorn
+    с --preload: воркеры получают их уже загруженными (copy-on-write).
+    """
+    import aiogram.bot.api  # noqa: F401
+    import aiogram.dispatcher  # noqa: F401
+    import sqlalchemy.dialects.postgresql  # noqa: F401
+    import sqlalchemy.dialects.sqlite  # noqa: F401
+    import cryptography.hazmat.primitives.asymmetric.rsa  # noqa: F401
+    import apscheduler.schedulers.background  # noqa: F401
+
+    import app.entitlements, app.handlers, app.ingress, app.invites  # noqa: E401, F401
+    import app.leader, app.models, app.outbound, app.payments, app.scheduler  # noqa: E401, F401
+
+
+def create_app() -> Flask:
+    """
+    Фабрика WSGI-приложения. Сама ничего не запускает: start() вызывает
+    post_fork в gunicorn_conf.py; если его не было (gunicorn без -c),
+    процесс поднимется на первом запросе.
+    """
+    flask_app = Flask(__name__)
+    flask_app.register_blueprint(web)
+    if TEST_MODE:
+        flask_app.register_blueprint(testpay)
+    flask_app.before_request(start)
+    return flask_app
+
+
+app = create_app()
+
+
+# ── нативный async-режим (SERVER_MODE=aiohttp) ────────────────────────────────
+def run_aiohttp(host: str = "0.0.0.0", port: int = 8080) -> None:
+    """
+    Поднимает aiohttp-сервер на общем loop и блокирует текущий поток.
+    """
+    from app.aio_server import create_aiohttp_app, serve
+
+    # /testpay — при TEST_MODE, как и в Flask: на него ведут mock-счета
+    aio_app = create_aiohttp_app(updates, accept_payment, grant=_grant_subscription if TEST_MODE else None)
+    run_coro(serve(aio_app, host, port)).result()
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    host = os.getenv("HOST", "0.0.0.0")
+    port = int(os.getenv("PORT", "8080"))
+    from app.metrics import reset_dir
+
+    reset_dir()  # один процесс — снимки прошлого запуска не нужны
+    start()
+    if SERVER_MODE == "aiohttp":
+        run_aiohttp(host, port)
+    else:
+        app.run(host=host, port=port, threaded=True)
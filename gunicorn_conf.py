@@ -1,10 +1,43 @@
+import os
+
 bind = "0.0.0.0:5000"
-workers = 1                # важно: один воркер, чтобы не было двойной инициализации
+
+# планировщик и установку вебхука выполняет только воркер-лидер (app/leader.py),
+# поэтому воркеров может быть несколько; для общих эфемерных сообщений между
+# воркерами включите EPHEMERAL_STORE=db
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
 worker_class = "gthread"
-threads = 8
+# тот же GUNICORN_THREADS учитывается в размере пула БД (app.models)
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
 timeout = 60
 keepalive = 2
 
 accesslog = "-"            # будем видеть каждый HTTP-запрос
 errorlog  = "-"
 loglevel  = "info"
+
+
+# --preload: мастер импортирует entry:app (без побочных эффектов) и тяжёлые
+# модули один раз, воркеры получают их через fork
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+
+def on_starting(server):
+    # снимки метрик воркеров прошлого запуска не должны попасть в суммы
+    from app.metrics import reset_dir
+
+    reset_dir()
+
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        import entry
+
+        entry.warm_imports()
+
+
+def post_fork(server, worker):
+    # БД, бот, loop и выборы лидера — в каждом воркере уже после fork
+    import entry
+
+    entry.start()
@@ -0,0 +1,82 @@
+# tests/conftest.py
+import asyncio
+import os
+import sys
+import tempfile
+from concurrent.futures import Future
+
+import pytest
+
+# окружение — до импорта app.* и entry: модули читают его при импорте
+_WORKDIR = tempfile.mkdtemp(prefix="footbot-tests-")
+os.environ.update(
+    DATABASE_URL=f"sqlite:///{_WORKDIR}/test.db",
+    TOKEN="123456:test",
+    CHANNEL_ID="-100",
+    BASE_URL="",
+    APP_BASE_URL="http://bot.test",
+    PAYMENTS_MODE="mock",
+    METRICS_DIR=f"{_WORKDIR}/metrics",
+)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session", autouse=True)
+def db():
+    from app.models import init_db
+
+    init_db()
+
+
+class FakeBot:
+    """Bot API без сети: запоминает отправленное и отозванное, send_error — ошибка sendMessage."""
+
+    def __init__(self):
+        self.sent = []
+        self.banned = []
+        self.revoked = []
+        self.send_error = None
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.send_error is not None:
+            raise self.send_error
+        self.sent.append((chat_id, text))
+
+    async def ban_chat_member(self, chat_id, user_id, **kwargs):
+        self.banned.append(user_id)
+
+    async def unban_chat_member(self, **kwargs):
+        pass
+
+    async def revoke_chat_invite_link(self, chat_id, invite_link):
+        self.revoked.append(invite_link)
+
+
+class FakeInvitePool:
+    def claim(self, session, plan, user_id, now):
+        return f"https://t.me/+{user_id}"
+
+    async def revoke_issued(self, user_id):
+        return 0
+
+
+def _run_now(coro) -> Future:
+    # вместо run_coro: корутина выполняется сразу, результат — как у run_coroutine_threadsafe
+    future = Future()
+    try:
+        future.set_result(asyncio.run(coro))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+@pytest.fixture
+def grant_bot(monkeypatch) -> FakeBot:
+    """entry._grant_subscription без Telegram, loop'а и пула инвайтов."""
+    import entry
+
+    bot = FakeBot()
+    monkeypatch.setattr(entry, "bot", bot)
+    monkeypatch.setattr(entry, "invite_pool", FakeInvitePool())
+    monkeypatch.setattr(entry, "run_coro", _run_now)
+    return bot
@@ -0,0 +1,81 @@
+# tests/test_expiry.py
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta
+
+import entry
+from app.entitlements import extend_entitlement
+from app.models import SessionLocal
+
+
+def _entitle(user_id: int, delta: timedelta) -> None:
+    session = SessionLocal()
+    try:
+        extend_entitlement(session, user_id, "Неделя", delta, datetime.utcnow())
+        session.commit()
+    finally:
+        session.close()
+
+
+def test_kick_skips_user_who_renewed_while_queued(grant_bot):
+    # 6161 истёк и удалён из entitlements, но успел продлиться; 6262 — нет
+    _entitle(6161, timedelta(days=7))
+    asyncio.run(entry._kick(6161))
+    asyncio.run(entry._kick(6262))
+    assert grant_bot.banned == [6262]
+
+
+class _Scheduler:
+    def __init__(self):
+        self.jobs = []
+
+    def add_job(self, func, **kwargs):
+        self.jobs.append(kwargs["run_date"])
+
+
+def test_near_refill_picks_up_grant_from_other_worker():
+    from app.expiry import ExpiryEngine
+
+    scheduler = _Scheduler()
+    engine = ExpiryEngine(scheduler, lambda items: None, horizon_seconds=600)
+    engine.refill()
+    # выдача короткого плана в другом воркере: push() лидеру не пришёл
+    _entitle(6363, timedelta(seconds=30))
+    assert 6363 not in engine._deadline
+
+    engine.refill_near(65)
+    assert 6363 in engine._deadline
+    assert scheduler.jobs and min(scheduler.jobs) <= datetime.utcnow() + timedelta(seconds=31)
+
+
+class _SlowScheduler:
+    """Первый add_job «зависает» — как поток, вытесненный между локом и планированием."""
+
+    def __init__(self):
+        self.run_date = None
+        self.entered = threading.Event()
+
+    def add_job(self, func, **kwargs):
+        if not self.entered.is_set():
+            self.entered.set()
+            time.sleep(0.2)
+        self.run_date = kwargs["run_date"]
+
+
+def test_concurrent_arm_keeps_earliest_wakeup():
+    from app.expiry import ExpiryEngine
+
+    scheduler = _SlowScheduler()
+    engine = ExpiryEngine(scheduler, lambda items: None)
+    now = datetime.utcnow()
+    later, sooner = now + timedelta(minutes=5), now + timedelta(minutes=1)
+
+    # _fire перевзводит на T2, пока inbox-поток push()'ит более ранний T1
+    arming = threading.Thread(target=engine.push, args=(6464, later))
+    arming.start()
+    scheduler.entered.wait(5)
+    engine.push(6565, sooner)
+    arming.join(5)
+
+    assert scheduler.run_date == sooner
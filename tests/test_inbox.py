@@ -0,0 +1,55 @@
+# tests/test_inbox.py
+import pytest
+from sqlalchemy import event
+
+import entry
+from app.entitlements import load_subscriptions
+from app.inbox import PaymentInbox
+from app.models import PaymentDelivery, SessionLocal, engine
+
+
+def test_idle_poll_does_not_write():
+    statements = []
+
+    def _capture(conn, cursor, statement, *args):
+        statements.append(statement.split(None, 1)[0].upper())
+
+    inbox = PaymentInbox(lambda data: None)
+    event.listen(engine, "before_cursor_execute", _capture)
+    try:
+        assert inbox._claim() == []
+    finally:
+        event.remove(engine, "before_cursor_execute", _capture)
+    assert statements == ["SELECT"]
+
+
+def test_failed_delivery_is_retried_without_second_grant(grant_bot):
+    order_id = "tg-5151-1"
+    grant_bot.send_error = ConnectionError("Telegram unavailable")
+    delivery = entry._grant_subscription(5151, "Неделя", order_id=order_id)
+    with pytest.raises(ConnectionError):
+        delivery.result()
+
+    session = SessionLocal()
+    try:
+        pending = session.get(PaymentDelivery, order_id)
+        assert pending is not None
+        expires = pending.expires_at
+    finally:
+        session.close()
+
+    # повтор события из inbox: доступ не продлевается, ссылка уходит
+    grant_bot.send_error = None
+    entry.handle_payment_event({"status": "Closed", "orderId": order_id, "description": "Неделя user 5151"}).result()
+    assert [chat_id for chat_id, _text in grant_bot.sent] == [5151]
+
+    session = SessionLocal()
+    try:
+        assert session.get(PaymentDelivery, order_id) is None
+    finally:
+        session.close()
+    assert load_subscriptions(5151)[0][1] == expires
+
+    # дальнейшие ретраи WATA — дубль
+    assert entry._grant_subscription(5151, "Неделя", order_id=order_id) is None
+    assert len(grant_bot.sent) == 1
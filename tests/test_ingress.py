@@ -0,0 +1,67 @@
+# tests/test_ingress.py
+import asyncio
+
+from aiogram import types
+
+from app.ingress import UpdateQueue
+
+
+def _update(update_id: int, user_id: int) -> types.Update:
+    return types.Update.to_object({
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "text": str(update_id),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "test"},
+        },
+    })
+
+
+def test_slow_user_does_not_block_others_and_order_is_kept():
+    slow_user, gate = 1, None
+    done = []
+    running = peak = 0
+
+    async def process(update: types.Update) -> None:
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        if update.message.from_user.id == slow_user:
+            await gate.wait()  # счёт WATA висит
+        else:
+            await asyncio.sleep(0.01)
+        done.append((update.message.from_user.id, update.update_id))
+        running -= 1
+
+    async def _do():
+        nonlocal gate
+        gate = asyncio.Event()
+        updates = UpdateQueue(process, workers=4)
+        await updates.start()
+
+        # первым идёт апдейт «медленного» пользователя; 17 % 4 == 1 — при шардировании
+        # по user_id пользователь 17 стоял бы за ним
+        assert updates.offer(_update(1, slow_user))
+        assert updates.offer(_update(2, slow_user))
+        for i in range(3, 23):
+            assert updates.offer(_update(i, 17 + i % 3))
+
+        for _ in range(200):
+            if len(done) == 20:
+                break
+            await asyncio.sleep(0.01)
+        others_done = len(done)
+        gate.set()
+        for _ in range(100):
+            if len(done) == 22:
+                break
+            await asyncio.sleep(0.01)
+        return others_done, updates.stats()
+
+    others_done, stats = asyncio.run(_do())
+    assert others_done == 20  # остальные не ждали медленного пользователя
+    assert peak <= 4
+    for user_id in {uid for uid, _ in done}:
+        ids = [update_id for uid, update_id in done if uid == user_id]
+        assert ids == sorted(ids)
+    assert stats["depth"] == 0 and stats["processed"] == 22 and stats["users"] == 0
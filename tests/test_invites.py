@@ -0,0 +1,51 @@
+# tests/test_invites.py
+import asyncio
+from datetime import datetime, timedelta
+
+import entry
+from app.entitlements import extend_entitlement
+from app.invites import InvitePool
+from app.models import InviteLink, SessionLocal
+
+
+def _issue(pool: InvitePool, link: str, user_id: int, access: timedelta) -> None:
+    # оплата короткого плана: ссылка пула живёт неделю, доступ — access
+    now = datetime.utcnow()
+    session = SessionLocal()
+    try:
+        session.add(InviteLink(link=link, plan="Неделя", created_at=now, expires_at=now + timedelta(days=7)))
+        session.flush()
+        extend_entitlement(session, user_id, "Неделя", access, now)
+        assert pool.claim(session, "Неделя", user_id, now) == link
+        session.commit()
+    finally:
+        session.close()
+
+
+def _links() -> set:
+    session = SessionLocal()
+    try:
+        return {link for (link,) in session.query(InviteLink.link).filter(InviteLink.issued_to.isnot(None))}
+    finally:
+        session.close()
+
+
+def test_kick_revokes_unused_pool_link(grant_bot, monkeypatch):
+    pool = InvitePool(grant_bot, -100, ["Неделя"], size=0)
+    monkeypatch.setattr(entry, "invite_pool", pool)
+    _issue(pool, "https://t.me/+kick", 8181, timedelta(seconds=-1))
+
+    asyncio.run(entry._kick(8181))
+    assert grant_bot.revoked == ["https://t.me/+kick"]
+    assert grant_bot.banned == [8181]
+    assert "https://t.me/+kick" not in _links()
+
+
+def test_refill_revokes_links_of_users_without_access(grant_bot):
+    pool = InvitePool(grant_bot, -100, ["Неделя"], size=0)
+    _issue(pool, "https://t.me/+expired", 8282, timedelta(seconds=-1))
+    _issue(pool, "https://t.me/+active", 8383, timedelta(days=1))
+
+    asyncio.run(pool.refill())
+    assert grant_bot.revoked == ["https://t.me/+expired"]
+    assert "https://t.me/+active" in _links()
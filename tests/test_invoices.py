@@ -0,0 +1,33 @@
+# tests/test_invoices.py
+import asyncio
+from urllib.parse import parse_qs, urlparse
+
+import entry
+from app.invoices import OpenInvoiceCache
+from app.payments import create_invoice_async
+
+USER_ID = 4242
+PLAN = "Неделя"
+
+
+def _tap(cache: OpenInvoiceCache, order_id: str) -> str:
+    async def _do():
+        invoice = await cache.get_or_create(
+            USER_ID, PLAN,
+            lambda: create_invoice_async(user_id=USER_ID, amount=100.0, plan=PLAN, order_id=order_id),
+        )
+        return parse_qs(urlparse(invoice["url"]).query)["orderId"][0]
+    return asyncio.run(_do())
+
+
+def test_reuse_after_payment_creates_new_order(grant_bot):
+    # два воркера: счёт открыт в одном, оплату берёт из inbox другой
+    worker_a, worker_b = OpenInvoiceCache(), OpenInvoiceCache()
+
+    assert _tap(worker_a, "tg-4242-1") == "tg-4242-1"
+    assert _tap(worker_b, "tg-4242-2") == "tg-4242-1"  # повторное нажатие — та же ссылка
+
+    assert entry._grant_subscription(USER_ID, PLAN, order_id="tg-4242-1")
+
+    assert _tap(worker_a, "tg-4242-3") == "tg-4242-3"
+    assert _tap(worker_b, "tg-4242-4") == "tg-4242-3"
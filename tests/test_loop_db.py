@@ -0,0 +1,116 @@
+# tests/test_loop_db.py
+import asyncio
+import itertools
+import threading
+
+import pytest
+from aiogram import Bot, types
+from aiohttp.test_utils import TestClient, TestServer
+from sqlalchemy import event
+
+from app import handlers
+from app.aio_server import create_aiohttp_app
+from app.ephemeral import DbLastInfoStore
+from app.inbox import PaymentInbox
+from app.metrics import REGISTRY, GaugeFunc
+from app.models import engine
+from app.plans import PLANS_BY_CODE
+
+USER_ID = 5151
+_USER = {"id": USER_ID, "is_bot": False, "first_name": "test"}
+_CHAT = {"id": USER_ID, "type": "private"}
+_ids = itertools.count(1)
+
+
+def _callback(data: str) -> types.CallbackQuery:
+    return types.CallbackQuery.to_object({
+        "id": str(next(_ids)), "data": data, "from": _USER,
+        "message": {"message_id": next(_ids), "chat": _CHAT, "date": 0},
+    })
+
+
+def _message(text: str) -> types.Message:
+    return types.Message.to_object({"message_id": next(_ids), "chat": _CHAT, "from": _USER, "text": text, "date": 0})
+
+
+def _bot() -> Bot:
+    """Bot без сети: вызовы API, которые делают хендлеры, ничего не отправляют."""
+    bot = Bot("123456:test")
+
+    async def send_message(*args, **kwargs):
+        return types.Message.to_object({"message_id": next(_ids), "chat": _CHAT, "date": 0})
+
+    async def noop(*args, **kwargs):
+        return True
+
+    bot.send_message = send_message
+    bot.delete_message = noop
+    bot.answer_callback_query = noop
+    return bot
+
+
+@pytest.fixture
+def db_threads(monkeypatch):
+    """Имена потоков, из которых шли запросы к БД (любой путь: SessionLocal, engine.begin)."""
+    threads = []
+
+    def _record(conn, cursor, statement, parameters, context, executemany):
+        threads.append(threading.current_thread().name)
+
+    # служебные сообщения — в таблице: в памяти этот путь БД не трогает
+    monkeypatch.setattr(handlers, "_LAST_INFO_MSG", DbLastInfoStore())
+    event.listen(engine, "before_cursor_execute", _record)
+    yield threads
+    event.remove(engine, "before_cursor_execute", _record)
+
+
+def _run_on_loop_thread(coro) -> None:
+    # как в entry: хендлеры крутятся на loop в потоке "aiogram-loop"
+    errors = []
+
+    def _run():
+        try:
+            asyncio.run(coro)
+        except BaseException as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=_run, name="aiogram-loop")
+    thread.start()
+    thread.join(30)
+    assert not thread.is_alive()
+    if errors:
+        raise errors[0]
+
+
+def test_handlers_never_touch_db_on_loop_thread(db_threads):
+    async def _handlers():
+        Bot.set_current(_bot())
+        await handlers.cmd_start(_message("/start"))
+        for data in ("buy", "my_subs", "help", next(iter(PLANS_BY_CODE))):
+            await handlers.route_callback(_callback(data))
+        await handlers.cmd_broadcast(_message("/broadcast привет"))
+        await handlers.cmd_broadcast_status(_message("/broadcast_status"))
+        await handlers.cmd_broadcast_cancel(_message("/broadcast_cancel 1"))
+
+    _run_on_loop_thread(_handlers())
+
+    assert db_threads, "хендлеры не сделали ни одного запроса — проверка ничего не проверила"
+    assert "aiogram-loop" not in db_threads
+
+
+def test_metrics_scrape_never_touches_db_on_loop_thread(db_threads, monkeypatch):
+    # SERVER_MODE=aiohttp: /metrics на loop диспетчера, глубина inbox — COUNT в БД
+    monkeypatch.setattr(REGISTRY, "_metrics", dict(REGISTRY._metrics))
+    GaugeFunc("footbot_payment_inbox_depth", "Payment events waiting in the inbox", PaymentInbox(None).depth,
+              shared=True)
+
+    async def _scrape():
+        app = create_aiohttp_app(updates=None, accept_payment=None)
+        async with TestClient(TestServer(app)) as client:
+            resp = await client.get("/metrics")
+            assert "footbot_payment_inbox_depth 0" in await resp.text()
+
+    _run_on_loop_thread(_scrape())
+
+    assert db_threads
+    assert "aiogram-loop" not in db_threads
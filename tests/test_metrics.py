@@ -0,0 +1,58 @@
+# tests/test_metrics.py
+import json
+import os
+import subprocess
+import threading
+
+import pytest
+
+from app import metrics
+from app.metrics import REGISTRY, Counter, GaugeFunc, render
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    """Пустой реестр и свой каталог снимков."""
+    monkeypatch.setattr(metrics, "METRICS_DIR", str(tmp_path))
+    monkeypatch.setattr(REGISTRY, "_metrics", {})
+    return tmp_path
+
+
+def _dead_pid() -> int:
+    proc = subprocess.Popen(["true"])
+    proc.wait()
+    return proc.pid
+
+
+def test_shards_of_finished_threads_are_folded(registry):
+    calls = Counter("t_calls_total", "calls")
+    # как Timer обновления ключа WATA: новый короткий поток на каждое обращение
+    for _ in range(50):
+        t = threading.Thread(target=calls.inc)
+        t.start()
+        t.join()
+
+    assert calls.collect() == {(): 50.0}
+    assert calls._shards == []
+
+
+def test_render_sums_workers_and_keeps_dead_worker_counters(registry):
+    requests = Counter("t_requests_total", "requests", ["route"])
+    GaugeFunc("t_depth", "queue depth", lambda: 2)
+    GaugeFunc("t_inbox", "shared depth", lambda: 3, shared=True)
+    requests.inc(1, "a")
+
+    snapshot = {
+        "t_requests_total": {"kind": "counter", "samples": [[["a"], 10]]},
+        "t_depth": {"kind": "gauge", "samples": [[[], 5]]},
+    }
+    dead = _dead_pid()
+    for pid in (os.getppid(), dead):
+        (registry / f"{pid}.json").write_text(json.dumps(snapshot))
+
+    for _ in range(2):  # умерший воркер переносится в архив один раз
+        text = render()
+        assert 't_requests_total{route="a"} 21.0' in text
+        assert "t_depth 7.0" in text  # gauge умершего не учитывается
+        assert "t_inbox 3" in text    # общий — только свой, без суммирования
+    assert not (registry / f"{dead}.json").exists()
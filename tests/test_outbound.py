@@ -0,0 +1,48 @@
+# tests/test_outbound.py
+import asyncio
+import time
+
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter
+
+from app.outbound import PRIORITY_PAYMENT, OutboundLimiter, RateLimitedBot
+
+
+def test_retry_after_on_unlimited_method_does_not_block_messages(monkeypatch):
+    calls = []
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        calls.append(method)
+        if calls.count(method) == 1:
+            raise RetryAfter(1)
+        return {}
+
+    monkeypatch.setattr(Bot, "request", request)
+
+    async def _do():
+        bot = RateLimitedBot("123456:test")
+        invite = asyncio.ensure_future(bot.request("createChatInviteLink", {"chat_id": -100}))
+        await asyncio.sleep(0.05)  # 429 получен, вызов ждёт повтора
+
+        started = time.monotonic()
+        await bot.limiter.acquire(777, PRIORITY_PAYMENT)
+        waited = time.monotonic() - started
+
+        await invite
+        return waited
+
+    assert asyncio.run(_do()) < 0.1
+    assert calls == ["createChatInviteLink", "createChatInviteLink"]
+
+
+def test_repeated_retry_after_does_not_stack():
+    async def _do():
+        limiter = OutboundLimiter(global_rate=30)
+        limiter.penalize(None, 1)
+        limiter.penalize(None, 1)  # второй 429 из того же окна
+
+        started = time.monotonic()
+        await limiter.acquire(None, PRIORITY_PAYMENT)
+        return time.monotonic() - started
+
+    assert 0.9 < asyncio.run(_do()) < 1.3
@@ -0,0 +1,19 @@
+# tests/test_subs_cache.py
+import entry
+from app.entitlements import load_subscriptions
+from app.subs_cache import SubscriptionCache
+
+
+def test_grant_in_another_worker_invalidates_after_sync(grant_bot):
+    user_id = 7171
+    other_worker = SubscriptionCache()
+    other_worker.sync()
+    other_worker.put(user_id, load_subscriptions(user_id), other_worker.generation())
+    assert other_worker.get(user_id) == ()
+
+    assert entry._grant_subscription(user_id, "Месяц", order_id="tg-7171-1")
+    assert other_worker.get(user_id) == ()  # до опроса — ещё старое
+
+    other_worker.sync()
+    assert other_worker.get(user_id) is None
+    assert [plan for plan, _exp in load_subscriptions(user_id)] == ["Месяц"]